@@ -23,7 +23,25 @@ def create_app(test_config=None):
         REQUESTS_CACHE_ON=True,
         FILE_CACHE=os.environ.get(
             "FILE_CACHE", "filesystem"
-        ),  # use 'redis' or 'filesystem'
+        ),  # use 'redis', 'filesystem', 'parquet' or 'arrow'
+        # with FILE_CACHE=redis files are compressed ('lz4', 'zstd' or 'none')
+        # and split into chunks of this many bytes
+        REDIS_COMPRESSION=os.environ.get("REDIS_COMPRESSION", "lz4").lower(),
+        REDIS_CHUNK_SIZE=int(os.environ.get("REDIS_CHUNK_SIZE", 16000000)),
+        # expired files are removed every CACHE_SWEEP_INTERVAL seconds (0 to turn
+        # off), along with the files used longest ago if the files use more than
+        # CACHE_MAX_SIZE bytes (0 for no limit)
+        CACHE_SWEEP_INTERVAL=int(os.environ.get("CACHE_SWEEP_INTERVAL", 60 * 60)),
+        CACHE_MAX_SIZE=int(os.environ.get("CACHE_MAX_SIZE", 0)),
+        # bytes of processed files kept in memory by each process (0 to turn off)
+        DATAFRAME_CACHE_SIZE=int(os.environ.get("DATAFRAME_CACHE_SIZE", 250000000)),
+        # dashboard results for each set of filters are cached for RESULTS_CACHE_TTL
+        # seconds after they were last used (0 to turn off), keeping at most
+        # RESULTS_CACHE_MAX_ENTRIES sets of results (0 for no limit)
+        RESULTS_CACHE_TTL=int(os.environ.get("RESULTS_CACHE_TTL", 60 * 60 * 24)),
+        RESULTS_CACHE_MAX_ENTRIES=int(
+            os.environ.get("RESULTS_CACHE_MAX_ENTRIES", 10000)
+        ),
         # Newsletter
         NEWSLETTER_FORM_ACTION=os.environ.get("NEWSLETTER_FORM_ACTION"),
         NEWSLETTER_FORM_U=os.environ.get("NEWSLETTER_FORM_U"),
@@ -43,6 +61,28 @@ def create_app(test_config=None):
         REDIS_DEFAULT_URL="redis://localhost:6379/0",  # default URL for redis instance
         REDIS_ENV_VAR="REDIS_URL",  # name of the environmental variable that will be looked up for the redis url
         CACHE_DEFAULT_PREFIX="file_",  # name of the prefix for saving a file to redis
+        # concurrent lookups of charity, company and postcode data
+        LOOKUP_MAX_WORKERS=int(os.environ.get("LOOKUP_MAX_WORKERS", 16)),
+        LOOKUP_HOST_LIMIT=int(os.environ.get("LOOKUP_HOST_LIMIT", 4)),
+        LOOKUP_RETRIES=int(os.environ.get("LOOKUP_RETRIES", 3)),
+        LOOKUP_BACKOFF=float(os.environ.get("LOOKUP_BACKOFF", 0.5)),
+        # seconds before a lookup that failed (eg not found) is tried again
+        NEGATIVE_CACHE_TTL=int(os.environ.get("NEGATIVE_CACHE_TTL", 60 * 60 * 24 * 7)),
+        # seconds before cached charity, company and postcode data is refreshed
+        LOOKUP_MAX_AGE={
+            "charity": int(os.environ.get("CHARITY_MAX_AGE", 60 * 60 * 24 * 30)),
+            "company": int(os.environ.get("COMPANY_MAX_AGE", 60 * 60 * 24 * 30)),
+            "postcode": int(os.environ.get("POSTCODE_MAX_AGE", 60 * 60 * 24 * 365)),
+        },
+        # maximum number of cached charity, company and postcode records
+        LOOKUP_MAX_ENTRIES=int(os.environ.get("LOOKUP_MAX_ENTRIES", 1000000)),
+        # look up companies in a background job when a file has too many to
+        # look up straight away
+        DEFER_COMPANY_LOOKUPS=os.environ.get("DEFER_COMPANY_LOOKUPS", "true").lower()
+        in ("true", "1", "yes"),
+        # bulk postcode lookup - postcodes are POSTed in batches if this is set
+        PC_BATCH_URL=os.environ.get("PC_BATCH_URL"),
+        PC_BATCH_SIZE=int(os.environ.get("PC_BATCH_SIZE", 250)),
         URL_FETCH_ALLOW_LIST=[
             "grantnav.threesixtygiving.org"
         ],  # domain names allowed to fetch data from
@@ -55,6 +95,23 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    # local postcode index, created with `flask data import-postcodes`
+    app.config.setdefault(
+        "POSTCODE_INDEX",
+        os.environ.get(
+            "POSTCODE_INDEX", os.path.join(app.config["UPLOADS_FOLDER"], "postcodes")
+        ),
+    )
+
+    # local charity and company register snapshots, created with
+    # `flask data import-register`
+    app.config.setdefault(
+        "REGISTER_INDEX",
+        os.environ.get(
+            "REGISTER_INDEX", os.path.join(app.config["UPLOADS_FOLDER"], "registers")
+        ),
+    )
+
     # set the redis URL
     app.config["REDIS_URL"] = os.environ.get(
         app.config["REDIS_ENV_VAR"], app.config["REDIS_DEFAULT_URL"]
@@ -1,25 +1,119 @@
 import json
 
-from flask import Blueprint, jsonify, render_template, request
+from flask import Blueprint, current_app, jsonify, render_template, request
 
-from ..data.cache import delete_from_cache, get_cache
-from ..data.process import fetch_geocodes
+from ..data.cache import (
+    CUBE_KEY_PREFIX,
+    FILES_ACCESSED_KEY,
+    RESULTS_ACCESSED_KEY,
+    RESULTS_KEY_PREFIX,
+    RESULTS_STATS_KEY,
+    delete_from_cache,
+    get_cache,
+    get_file_sizes,
+)
+from ..data.process import LOOKUP_STATS_KEY, fetch_geocodes
 from .fetch import get_registry_file
 
 bp = Blueprint("cache", __name__)
 
 
+# hashes that hold cached lookups and data
+CACHE_HASHES = [
+    "charity",
+    "company",
+    "postcode",
+    "geocodes",
+    "files",
+    LOOKUP_STATS_KEY,
+    RESULTS_STATS_KEY,
+]
+MAX_PAGE_SIZE = 10000
+
+
+def get_key_prefix(key):
+    # group keys like `negative:charity:GB-CHC-123` or `file_abc:chunk:0`
+    for prefix in [
+        current_app.config.get("CACHE_DEFAULT_PREFIX", "file_"),
+        CUBE_KEY_PREFIX,
+        RESULTS_KEY_PREFIX,
+    ]:
+        if key.startswith(prefix):
+            return prefix
+    parts = key.split(":")
+    if len(parts) > 2:
+        return ":".join(parts[:2])
+    return parts[0]
+
+
+def get_page_args(default_count=1000):
+    cursor = request.args.get("cursor", 0, type=int)
+    count = min(request.args.get("count", default_count, type=int), MAX_PAGE_SIZE)
+    return cursor, count
+
+
 @bp.route("/redis_cache")
 def check_redis_cache():
+    """
+    Summarise one page of the keys in redis, using SCAN so redis isn't
+    blocked. Request the next page using the `cursor` returned, until it
+    is 0. Memory usage is sampled for each key in the page (unless
+    `memory=0`).
+    """
     r = get_cache()
-    cache_contents = {
-        "keys": {x.decode("utf8"): r.type(x).decode("utf8") for x in r.keys()},
-        "files": {
-            k.decode("utf8"): json.loads(v.decode("utf8"))
-            for k, v in r.hgetall("files").items()
-        },
-    }
-    return json.dumps(cache_contents)
+    cursor, count = get_page_args()
+    cursor, keys = r.scan(cursor=cursor, match=request.args.get("match"), count=count)
+
+    memory = [None] * len(keys)
+    if keys and request.args.get("memory", 1, type=int):
+        pipeline = r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.memory_usage(key, samples=5)
+        memory = [
+            m if isinstance(m, int) else None
+            for m in pipeline.execute(raise_on_error=False)
+        ]
+
+    prefixes = {}
+    for key, key_memory in zip(keys, memory):
+        prefix = prefixes.setdefault(
+            get_key_prefix(key.decode("utf8")), {"keys": 0, "memory": None}
+        )
+        prefix["keys"] += 1
+        if key_memory is not None:
+            prefix["memory"] = (prefix["memory"] or 0) + key_memory
+
+    pipeline = r.pipeline(transaction=False)
+    for h in CACHE_HASHES:
+        pipeline.hlen(h)
+
+    return jsonify(
+        {
+            "cursor": cursor,
+            "keys": len(keys),
+            "prefixes": prefixes,
+            "hashes": dict(zip(CACHE_HASHES, pipeline.execute())),
+        }
+    )
+
+
+@bp.route("/files")
+def check_cached_files():
+    """
+    One page of the files in the cache, with their metadata, size in bytes
+    and when they were last used. Request the next page using the `cursor`
+    returned, until it is 0.
+    """
+    r = get_cache()
+    cursor, count = get_page_args(100)
+    cursor, files = r.hscan("files", cursor=cursor, count=count)
+    files = {k.decode("utf8"): json.loads(v.decode("utf8")) for k, v in files.items()}
+    last_accessed = r.hmget(FILES_ACCESSED_KEY, list(files.keys())) if files else []
+    sizes = get_file_sizes(list(files.keys())) if files else []
+    for (fileid, metadata), accessed, size in zip(files.items(), last_accessed, sizes):
+        metadata["size"] = size
+        metadata["last_accessed"] = int(accessed) if accessed else None
+    return jsonify({"cursor": cursor, "files": files})
 
 
 @bp.route("/reload/", methods=("GET", "POST"))
@@ -43,3 +137,31 @@ def view_geocodes():
     return jsonify(
         {k.decode("utf8"): c.decode("utf8") for k, c in cache.hscan_iter("geocodes")}
     )
+
+
+@bp.route("/lookup_stats")
+def view_lookup_stats():
+    cache = get_cache()
+    stats = {}
+    for k, v in cache.hgetall(LOOKUP_STATS_KEY).items():
+        source, stat = k.decode("utf8").split(":", 1)
+        stats.setdefault(source, {})[stat] = int(v)
+    return jsonify(stats)
+
+
+@bp.route("/results_stats")
+def view_results_stats():
+    cache = get_cache()
+    stats = {
+        k.decode("utf8"): int(v) for k, v in cache.hgetall(RESULTS_STATS_KEY).items()
+    }
+    hits = stats.get("hit", 0)
+    misses = stats.get("miss", 0)
+    return jsonify(
+        {
+            "hit": hits,
+            "miss": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else None,
+            "entries": cache.zcard(RESULTS_ACCESSED_KEY),
+        }
+    )
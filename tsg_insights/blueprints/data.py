@@ -6,8 +6,7 @@ from flask import Blueprint, Response, abort
 from flask import current_app as app
 from flask import jsonify, render_template, request
 
-from tsg_insights_dash.data.filters import get_filtered_df
-from tsg_insights_dash.data.results import CHARTS, get_statistics
+from tsg_insights_dash.data.filters import get_filtered_df, get_filtered_results
 
 from ..data.utils import format_currency
 
@@ -17,21 +16,33 @@ bp = Blueprint("data", __name__)
 @bp.route("/map/<fileid>")
 def create_grants_map(fileid):
 
-    df = get_filtered_df(fileid, **dict(request.args.lists()))
+    df = get_filtered_df(
+        fileid,
+        columns=[
+            "__geo_lat",
+            "__geo_long",
+            "Recipient Org:0:Name",
+            "Funding Org:0:Name",
+            "Amount Awarded",
+            "Currency",
+            "Award Date",
+        ],
+        **dict(request.args.lists())
+    )
 
     if df is None:
         abort(404)
 
     df.dropna(subset=["__geo_lat", "__geo_long"])
-    df.loc[:, "__geo_lat"] = df["__geo_lat"].astype(float)
-    df.loc[:, "__geo_long"] = df["__geo_long"].astype(float)
-    df.loc[:, "Amount String"] = df.apply(
+    df["__geo_lat"] = df["__geo_lat"].astype(float)
+    df["__geo_long"] = df["__geo_long"].astype(float)
+    df["Amount String"] = df.apply(
         lambda x: format_currency(x["Amount Awarded"], x["Currency"], humanize_=False)[
             0
         ],
         axis=1,
     )
-    df.loc[:, "Award Date"] = df["Award Date"].dt.strftime("%d %B %Y")
+    df["Award Date"] = df["Award Date"].dt.strftime("%d %B %Y")
 
     geo = (
         df[
@@ -63,7 +74,16 @@ def create_grants_map(fileid):
 def fetch_file_geojson(fileid):
 
     # @TODO: fetch filters
-    df = get_filtered_df(fileid, **dict(request.args.lists()))
+    df = get_filtered_df(
+        fileid,
+        columns=[
+            "__geo_lat",
+            "__geo_long",
+            "Recipient Org:0:Name",
+            "Recipient Org:0:Identifier",
+        ],
+        **dict(request.args.lists())
+    )
 
     popup_col = "Recipient Org:0:Name"
     if popup_col not in df.columns and "Recipient Org:0:Identifier" in df.columns:
@@ -71,7 +91,7 @@ def fetch_file_geojson(fileid):
 
     geo = df[["__geo_lat", "__geo_long", popup_col]].dropna()
     geo = (
-        geo.groupby(["__geo_lat", "__geo_long", popup_col])
+        geo.groupby(["__geo_lat", "__geo_long", popup_col], observed=True)
         .size()
         .rename("grants")
         .reset_index()
@@ -102,13 +122,11 @@ def fetch_file_geojson(fileid):
 def fetch_file(fileid):
 
     # @TODO: fetch filters
-    df = get_filtered_df(fileid, **request.form.get("filters", {}))
+    results = get_filtered_results(fileid, **request.form.get("filters", {}))
+    if results is None:
+        abort(404)
 
-    results = {
-        chart_id: chart_def["get_results"](df) for chart_id, chart_def in CHARTS.items()
-    }
-    results["statistics"] = get_statistics(df)
-    return jsonify(results)
+    return jsonify({**results.results, "statistics": results.statistics})
 
 
 @bp.route("/download/<fileid>.<format>")
@@ -119,6 +137,7 @@ def download_file(fileid, format):
         "Recipient Org:0:Identifier:Scheme",
         "Recipient Org:0:Identifier:Clean",
         "__org_orgid",
+        "__org_type",
         "__org_charity_number",
         "__org_company_number",
         # '__geo_ctry',
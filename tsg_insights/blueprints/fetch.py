@@ -5,9 +5,10 @@ from flask import Blueprint, current_app, jsonify, request
 from rq import Queue
 from werkzeug.utils import secure_filename
 
-from ..data.cache import get_cache
+from ..data.cache import get_cache, get_metadata_from_cache, is_expired
 from ..data.process import get_dataframe_from_file, get_dataframe_from_url
 from ..data.registry import get_reg_file
+from ..data.utils import get_content_fileid
 
 bp = Blueprint("fetch", __name__)
 
@@ -68,6 +69,14 @@ def process_uploaded_file():
         return jsonify(error=500, text="No file selected"), 500
 
     filename = secure_filename(file_.filename)
+
+    # if the same file has already been processed then use that
+    fileid = get_content_fileid(file_.stream, filename)
+    metadata = get_metadata_from_cache(fileid)
+    if metadata and not is_expired(metadata):
+        return jsonify({"job": None, "fileid": fileid})
+
+    file_.stream.seek(0)
     content = file_.read()
 
     # a query was submitted, so queue it up and return job_id
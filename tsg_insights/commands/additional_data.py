@@ -5,9 +5,16 @@ import click
 import pandas as pd
 from flask import Flask, current_app
 from flask.cli import AppGroup, with_appcontext
+from rq import Queue
 
 from ..data.cache import delete_from_cache, get_cache, get_from_cache, save_to_cache
-from ..data.process import get_dataframe_from_url
+from ..data.process import (
+    LOOKUP_STAGES,
+    evict_lookups,
+    get_dataframe_from_url,
+    refresh_lookups,
+)
+from ..data.records import RECORD_FIELDS, migrate_record
 from ..data.registry import get_reg_file, process_registry
 
 cli = AppGroup("additional_data")
@@ -30,3 +37,66 @@ def cli_remove_all_files():
         ):
             cache.delete(k)
             click.echo(f"Deleted {keys_to_delete:,.0f} keys from {k}")
+
+
+@cli.command("migrate")
+@click.option("--batch-size", default=1000, help="number of records written at once")
+@with_appcontext
+def cli_migrate_records(batch_size):
+    cache = get_cache()
+    for k in RECORD_FIELDS:
+        converted = 0
+        removed = 0
+        pipeline = cache.pipeline(transaction=False)
+        for field, value in cache.hscan_iter(k, count=batch_size):
+            new_value = migrate_record(k, value)
+            if new_value is None:
+                # records that can't be converted are fetched again when needed
+                pipeline.hdel(k, field)
+                removed += 1
+            elif new_value != value:
+                pipeline.hset(k, field, new_value)
+                converted += 1
+            if len(pipeline) >= batch_size:
+                pipeline.execute()
+        pipeline.execute()
+        click.echo(f"Converted {converted:,.0f} and removed {removed:,.0f} {k} records")
+
+
+@cli.command("refresh")
+@click.option(
+    "--source",
+    "sources",
+    multiple=True,
+    type=click.Choice(list(LOOKUP_STAGES.keys())),
+    help="only refresh this source (can be used more than once)",
+)
+@click.option("--limit", default=None, type=int, help="maximum records per source")
+@click.option("--queue", is_flag=True, help="run as a job on the worker")
+@with_appcontext
+def cli_refresh(sources, limit, queue):
+    if queue:
+        q = Queue("low", connection=get_cache())
+        job = q.enqueue_call(
+            func=refresh_lookups,
+            args=(list(sources), limit),
+            timeout="6h",
+        )
+        click.echo(f"Refresh queued as job {job.id}")
+        return
+
+    result = refresh_lookups(list(sources), limit)
+    for source, count in result["refreshed"].items():
+        click.echo(f"Refreshed {count:,.0f} {source} records")
+    for source, count in result["evicted"].items():
+        click.echo(f"Evicted {count:,.0f} {source} records")
+
+
+@cli.command("evict")
+@click.option(
+    "--max-entries", default=None, type=int, help="maximum records per source"
+)
+@with_appcontext
+def cli_evict(max_entries):
+    for source, count in evict_lookups(max_entries=max_entries).items():
+        click.echo(f"Evicted {count:,.0f} {source} records")
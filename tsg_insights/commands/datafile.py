@@ -1,13 +1,28 @@
 import logging
+import os
 import sys
+import time
 
 import click
 import pandas as pd
 from flask import Flask, current_app
 from flask.cli import AppGroup, with_appcontext
 
-from ..data.cache import delete_from_cache, get_cache, get_from_cache, save_to_cache
-from ..data.process import get_dataframe_from_url
+from ..data.cache import (
+    delete_from_cache,
+    get_cache,
+    get_from_cache,
+    repack_files,
+    schedule_cache_sweep,
+    sweep_cache,
+)
+from ..data.index import import_postcodes
+from ..data.process import (
+    NEGATIVE_CACHE_PREFIX,
+    POSTCODE_FIELDS,
+    get_dataframe_from_url,
+    import_register,
+)
 from ..data.registry import get_reg_file, process_registry
 
 cli = AppGroup("data")
@@ -111,26 +126,129 @@ def cli_remove_all_files():
         delete_from_cache(k)
 
 
+CACHE_TYPES = ["filesystem", "redis", "parquet", "arrow"]
+
+
+def repack(from_type, to_type, workers=None, restart=False):
+    start = time.time()
+    files = rows = size = errors = 0
+    for result in repack_files(from_type, to_type, workers=workers, restart=restart):
+        if "error" in result:
+            errors += 1
+            click.echo("Error: {}".format(result["error"]), err=True)
+            continue
+        files += 1
+        rows += result["rows"]
+        size += result["size"]
+        click.echo(
+            "Repacked [{}]: {:,.0f} rows, {:,.0f} bytes in {:.2f} seconds".format(
+                result["fileid"], result["rows"], result["size"], result["seconds"]
+            )
+        )
+
+    seconds = max(time.time() - start, 0.001)
+    click.echo(
+        "Repacked {:,.0f} files ({:,.0f} rows, {:,.0f} bytes) from {} to {} in {:.1f} seconds".format(
+            files, rows, size, from_type, to_type, seconds
+        )
+    )
+    click.echo(
+        "{:,.1f} files, {:,.0f} rows and {:,.1f} MB per second".format(
+            files / seconds, rows / seconds, size / seconds / 1000000
+        )
+    )
+    if errors:
+        click.echo("{:,.0f} files could not be repacked".format(errors), err=True)
+        sys.exit(1)
+    click.echo("Set FILE_CACHE={} to use the repacked files".format(to_type))
+
+
+@cli.command("repack")
+@click.option("--from", "from_type", required=True, type=click.Choice(CACHE_TYPES))
+@click.option("--to", "to_type", required=True, type=click.Choice(CACHE_TYPES))
+@click.option(
+    "--workers", default=os.cpu_count(), type=int, help="number of processes to use"
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    help="repack files again even if they were repacked by an earlier run",
+)
+@with_appcontext
+def cli_repack(from_type, to_type, workers, restart):
+    repack(from_type, to_type, workers=workers, restart=restart)
+
+
 @cli.command("redistofile")
 @with_appcontext
 def cli_redistofile():
-    cache = get_cache()
-    for k, c in cache.hscan_iter("files"):
-        k = k.decode("utf8")
-        df = get_from_cache(k, cache_type="redis")
-        if df is not None:
-            save_to_cache(k, df, cache_type="filesystem")
+    repack("redis", "filesystem")
 
 
 @cli.command("filetoredis")
 @with_appcontext
-def cli_redistofile():
-    cache = get_cache()
-    for k, c in cache.hscan_iter("files"):
-        k = k.decode("utf8")
-        df = get_from_cache(k, cache_type="filesystem")
-        if df is not None:
-            save_to_cache(k, df, cache_type="redis")
+def cli_filetoredis():
+    repack("filesystem", "redis")
+
+
+@cli.command("import-postcodes")
+@click.argument("csv_file", type=click.Path(exists=True))
+@with_appcontext
+def cli_import_postcodes(csv_file):
+    index = import_postcodes(
+        csv_file, current_app.config["POSTCODE_INDEX"], POSTCODE_FIELDS
+    )
+    click.echo(
+        "Imported {:,.0f} postcodes to {}".format(
+            len(index), current_app.config["POSTCODE_INDEX"]
+        )
+    )
+
+
+@cli.command("import-register")
+@click.argument("source", type=click.Choice(["charity", "company"]))
+@click.argument("csv_file", type=click.Path(exists=True))
+@with_appcontext
+def cli_import_register(source, csv_file):
+    path = os.path.join(current_app.config["REGISTER_INDEX"], source)
+    index = import_register(csv_file, path, source)
+    click.echo("Imported {:,.0f} organisations to {}".format(len(index), path))
+
+
+@cli.command("clear-negative-cache")
+@click.argument("source", required=False)
+@with_appcontext
+def cli_clear_negative_cache(source=None):
+    r = get_cache()
+    match = "{}{}:*".format(NEGATIVE_CACHE_PREFIX, source if source else "*")
+    count = 0
+    for k in r.scan_iter(match=match):
+        r.delete(k)
+        count += 1
+    click.echo("Removed {:,.0f} failed lookups from the cache".format(count))
+
+
+@cli.command("sweep")
+@click.option("--max-size", type=int, help="maximum bytes used by files in the cache")
+@click.option(
+    "--schedule", is_flag=True, help="keep sweeping the cache as a job on the worker"
+)
+@with_appcontext
+def cli_sweep(max_size=None, schedule=False):
+    if schedule:
+        job = schedule_cache_sweep()
+        if job:
+            click.echo("Cache sweep scheduled as job {}".format(job.id))
+        else:
+            click.echo("Cache sweep already scheduled (or CACHE_SWEEP_INTERVAL is 0)")
+        return
+    result = sweep_cache(max_size=max_size)
+    click.echo(
+        "Removed {:,.0f} expired files, {:,.0f} files over the size limit and {:,.0f} orphaned files".format(
+            result["expired"], result["evicted"], result["orphaned"]
+        )
+    )
+    click.echo("Files in the cache use {:,.0f} bytes".format(result["size"]))
 
 
 @cli.command("preview")
@@ -8,7 +8,7 @@ from flask import Flask
 from flask.cli import AppGroup, with_appcontext
 from rq import Connection, Queue, Worker
 
-from ..data.cache import get_cache
+from ..data.cache import get_cache, schedule_cache_sweep
 
 cli = AppGroup("worker")
 
@@ -20,6 +20,9 @@ def cli_start_worker():
     listen = ["high", "default", "low"]
     conn = get_cache()
 
+    # start removing expired files from the cache
+    schedule_cache_sweep()
+
     with Connection(conn):
         if hasattr(os, "fork"):
             worker = Worker(map(Queue, listen), log_job_description=False)
@@ -27,4 +30,4 @@ def cli_start_worker():
             from rq_win import WindowsWorker
 
             worker = WindowsWorker(map(Queue, listen), log_job_description=False)
-        worker.work()
+        worker.work(with_scheduler=True)
@@ -3,14 +3,39 @@ import json
 import logging
 import os
 import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
-from flask import current_app
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Flask, current_app
 from redis import StrictRedis, from_url
+from rq import Queue
+from rq.registry import ScheduledJobRegistry
 
-from .utils import CustomJSONEncoder
+from .cube import CUBE_CELL_COLUMN, CUBE_VERSION, build_indexed_cube
+from .utils import DERIVED_COLUMNS, CustomJSONEncoder, add_derived_columns
 
 REDIS_DEFAULT_URL = "redis://localhost:6379/0"
 REDIS_ENV_VAR = "REDIS_URL"
+FILES_ACCESSED_KEY = "files_accessed"  # when each file was last loaded
+CACHE_SWEEP_JOB_ID = "cache-sweeper"
+CACHE_SWEEP_LOCK_KEY = "cache-sweeper-scheduled"  # set while a sweep is scheduled
+CUBE_KEY_PREFIX = "cube_"  # prefix of the aggregation cube saved for each file
+REPACK_KEY = "repack:{}:{}"  # files copied from one type of cache to another
+RESULTS_KEY_PREFIX = "results_"  # prefix of the dashboard results for a set of filters
+RESULTS_ACCESSED_KEY = "results_accessed"  # when each set of results was last used
+RESULTS_STATS_KEY = "results_stats"  # hits and misses of the results cache
+
+# dataframes (and cubes) loaded by this process, as
+# `{(fileid, cache_type): (etag, df, size)}` in the order they were last used
+_dataframes = OrderedDict()
+_dataframes_lock = threading.Lock()
 
 
 def get_cache(strict=False):
@@ -20,35 +45,225 @@ def get_cache(strict=False):
     return from_url(redis_url)
 
 
-def get_filename(fileid):
+# file extension used for each type of file cache (pickle is used by default)
+FILE_EXTENSIONS = {
+    "parquet": "parquet",
+    "arrow": "arrow",
+}
+
+
+def get_filename(fileid, cache_type=None):
     uploads_folder = current_app.config.get("UPLOADS_FOLDER")
-    return os.path.join(uploads_folder, "{}.pkl".format(fileid))
+    extension = FILE_EXTENSIONS.get(cache_type, "pkl")
+    return os.path.join(uploads_folder, "{}.{}".format(fileid, extension))
 
 
-def save_to_cache(fileid, df, metadata=None, cache_type=None):
+def get_compressor(compression):
+    """
+    Get the functions to compress and decompress data with `compression`
+    ("lz4", "zstd" or `None`). The compression libraries are only imported
+    when they are used.
+    """
+    if compression == "lz4":
+        import lz4.frame
+
+        return (lz4.frame.compress, lz4.frame.decompress)
+    if compression == "zstd":
+        import zstandard
+
+        return (
+            zstandard.ZstdCompressor().compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    if compression in (None, "", "none"):
+        return (bytes, bytes)
+    raise ValueError("Unknown compression: {}".format(compression))
+
+
+# bytes at the start of a value in redis that are read to get its manifest
+MANIFEST_MAX_SIZE = 1024
+
+
+def get_chunk_key(key, chunk):
+    return "{}:chunk:{}".format(key, chunk)
+
+
+def save_to_redis(r, key, data, compression=None, chunk_size=None):
+    """
+    Save data to redis, compressed and split into chunks of `chunk_size`
+    bytes, so values aren't limited by redis's maximum value size.
+
+    `key` holds a JSON description of the chunks, and all the keys are
+    changed in one transaction.
+    """
+    start = time.time()
+    compressed = get_compressor(compression)[0](data)
+    chunk_size = chunk_size or len(compressed) or 1
+    chunks = [
+        compressed[i : i + chunk_size] for i in range(0, len(compressed), chunk_size)
+    ]
+    previous = get_redis_manifest(r, key)
+
+    pipeline = r.pipeline()
+    for i, chunk in enumerate(chunks):
+        pipeline.set(get_chunk_key(key, i), chunk)
+    for i in range(len(chunks), previous.get("chunks", 0) if previous else 0):
+        pipeline.delete(get_chunk_key(key, i))
+    manifest = {
+        "compression": compression,
+        "chunks": len(chunks),
+        "size": len(compressed),
+        "raw_size": len(data),
+    }
+    pipeline.set(key, json.dumps(manifest))
+    pipeline.execute()
+    logging.info(
+        "Saved [{}] to redis: {:,.0f} bytes compressed to {:,.0f} bytes".format(
+            key, len(data), len(compressed)
+        )
+        + " (ratio {:.1f}, {} compression) in {:,.0f} chunks in {:.2f} seconds".format(
+            len(data) / max(len(compressed), 1),
+            compression or "no",
+            len(chunks),
+            time.time() - start,
+        )
+    )
+    return manifest
+
+
+def get_redis_manifest(r, key, value=None):
+    """
+    Get the manifest saved by `save_to_redis`, or `None` if there isn't one.
+
+    Values saved before chunks were introduced are a pickle, not a manifest,
+    so only the start of the value is fetched (which holds all of a
+    manifest) rather than the whole pickle.
+    """
+    if value is None:
+        value = r.getrange(key, 0, MANIFEST_MAX_SIZE - 1)
+        if value[:1] == b"{" and len(value) >= MANIFEST_MAX_SIZE:
+            value = r.get(key)
+    if not value or value[:1] != b"{":
+        return None
+    return json.loads(value)
+
+
+def get_from_redis(r, key):
+    # get data saved with `save_to_redis`, or `None` if it isn't found
+    start = time.time()
+    value = r.get(key)
+    manifest = get_redis_manifest(r, key, value)
+    if manifest is None:
+        return value
+
+    pipeline = r.pipeline(transaction=False)
+    for i in range(manifest["chunks"]):
+        pipeline.get(get_chunk_key(key, i))
+    chunks = pipeline.execute()
+    if any(chunk is None for chunk in chunks):
+        logging.info("Missing chunks for [{}] in redis".format(key))
+        return None
+    data = get_compressor(manifest["compression"])[1](b"".join(chunks))
+    logging.info(
+        "Loaded [{}] from redis: {:,.0f} bytes in {:,.0f} chunks in {:.2f} seconds".format(
+            key, len(data), len(chunks), time.time() - start
+        )
+    )
+    return data
+
+
+def delete_from_redis(r, key):
+    manifest = get_redis_manifest(r, key)
+    keys = [key]
+    if manifest:
+        keys += [get_chunk_key(key, i) for i in range(manifest["chunks"])]
+    r.delete(*keys)
+
+
+def to_arrow_table(df):
+    """
+    Convert a dataframe to an arrow table.
+
+    Columns that mix text and numbers (eg charity numbers) can't be stored
+    in a single arrow type, so their values are stored as text.
+    """
+    df = df.copy()
+    for c in df.select_dtypes(["object"]).columns:
+        if pd.api.types.infer_dtype(df[c], skipna=True) in ("mixed", "mixed-integer"):
+            df[c] = df[c].where(df[c].isnull(), df[c].astype(str))
+    return pa.Table.from_pandas(df)
+
+
+def select_columns(df, columns=None):
+    # only keep the columns asked for, ignoring any that aren't in the data
+    if columns is None:
+        return df
+    return df.drop(columns=[c for c in df.columns if c not in columns])
+
+
+def write_dataframe(fileid, df, cache_type=None):
+    # save a dataframe to the file cache, without changing its metadata
     r = get_cache()
     prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
     cache_type = cache_type or current_app.config.get("FILE_CACHE")
 
     if cache_type == "redis":
-        r.set("{}{}".format(prefix, fileid), pickle.dumps(df))
+        save_to_redis(
+            r,
+            "{}{}".format(prefix, fileid),
+            pickle.dumps(df),
+            compression=current_app.config.get("REDIS_COMPRESSION"),
+            chunk_size=current_app.config.get("REDIS_CHUNK_SIZE"),
+        )
         logging.info("Dataframe [{}] saved to redis".format(fileid))
+    elif cache_type == "parquet":
+        pq.write_table(to_arrow_table(df), get_filename(fileid, cache_type))
+        logging.info("Dataframe [{}] saved to filesystem as parquet".format(fileid))
+    elif cache_type == "arrow":
+        # the file is written to a new path and then moved into place, so any
+        # process that has the old file mapped can carry on reading it
+        filename = get_filename(fileid, cache_type)
+        table = to_arrow_table(df)
+        with pa.OSFile(filename + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(filename + ".tmp", filename)
+        logging.info("Dataframe [{}] saved to filesystem as arrow".format(fileid))
     else:
         with open(get_filename(fileid), "wb") as pkl_file:
             pickle.dump(df, pkl_file)
         logging.info("Dataframe [{}] saved to filesystem".format(fileid))
 
+
+def save_to_cache(fileid, df, metadata=None, cache_type=None):
+    r = get_cache()
+
+    # the cell of the cube each row is in is saved with the data
+    cube, cell_ids = build_indexed_cube(df)
+    cube.indexed = True
+    write_dataframe(fileid, df.assign(**{CUBE_CELL_COLUMN: cell_ids}), cache_type)
+
     if not metadata:
         metadata = {}
 
+    # the version increases each time the file is saved
+    previous_metadata = get_metadata_from_cache(fileid) or {}
+
     metadata = {
         "fileid": fileid,
         "funders": df["Funding Org:0:Name"].unique().tolist(),
         "max_date": df["Award Date"].max().isoformat(),
         "min_date": df["Award Date"].min().isoformat(),
         **metadata,
+        "version": previous_metadata.get("version", 0) + 1,
+        # changes each time the file is saved, so other processes know to
+        # reload it
+        "etag": uuid.uuid4().hex,
     }
+    cube.etag = metadata["etag"]
+    save_cube(fileid, cube)
     r.hset("files", fileid, json.dumps(metadata, default=CustomJSONEncoder().default))
+    forget_dataframe(fileid)
     logging.info("Dataframe [{}] metadata saved to redis".format(fileid))
 
 
@@ -58,47 +273,160 @@ def delete_from_cache(fileid, cache_type=None):
     cache_type = cache_type or current_app.config.get("FILE_CACHE")
 
     if cache_type == "redis":
-        r.delete("{}{}".format(prefix, fileid))
+        delete_from_redis(r, "{}{}".format(prefix, fileid))
         logging.info("Dataframe [{}] removed from redis".format(fileid))
     else:
-        filename = get_filename(fileid)
+        filename = get_filename(fileid, cache_type)
         if os.path.exists(filename):
             os.remove(filename)
         logging.info("Dataframe [{}] removed from filesystem".format(fileid))
 
+    delete_from_redis(r, get_cube_key(fileid))
     r.hdel("files", fileid)
+    r.hdel(FILES_ACCESSED_KEY, fileid)
+    forget_dataframe(fileid)
     logging.info("Dataframe [{}] metadata removed from redis".format(fileid))
 
 
-def get_from_cache(fileid, cache_type=None):
-    r = get_cache()
-    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+def get_from_cache(fileid, cache_type=None, columns=None, cube_cells=False):
+    """
+    Get a dataframe from the cache, or `None` if it isn't found.
+
+    If `columns` is given then only those columns are returned. With the
+    parquet cache only those columns are read from the file. If
+    `cube_cells` is true the cell of the file's cube that each row is in
+    is included (as `CUBE_CELL_COLUMN`).
+
+    Dataframes are kept in memory by each process (up to
+    `DATAFRAME_CACHE_SIZE` bytes), and checked against the `etag` in the
+    file metadata so a file that's been fetched again or removed isn't used.
+    A shallow copy is returned: columns can be added, replaced or removed
+    without affecting the cache, but values mustn't be changed in place.
+    With the parquet cache, a subset of columns is read from the file
+    (and not kept in memory) unless the whole file is already in memory.
+
+    The arrow cache memory-maps the file instead, so every process shares
+    one copy of it through the page cache. Numeric and date columns without
+    missing values are read-only views of the file, so the dataframe should
+    be copied before it's changed in place.
+    """
     cache_type = cache_type or current_app.config.get("FILE_CACHE")
 
     metadata = get_metadata_from_cache(fileid)
     if not metadata:
         logging.info("Dataframe [{}] not found".format(fileid))
+        forget_dataframe(fileid)
         return None
-    if "expires" in metadata:
-        if (
-            datetime.datetime.strptime(metadata["expires"], "%Y-%m-%dT%H:%M:%S.%f")
-            < datetime.datetime.now()
-        ):
-            logging.info(
-                "Dataframe [{}] expired on {}".format(fileid, metadata["expires"])
-            )
+    if is_expired(metadata):
+        logging.info("Dataframe [{}] expired on {}".format(fileid, metadata["expires"]))
+        return None
+    get_cache().hset(FILES_ACCESSED_KEY, fileid, int(time.time()))
+    if cube_cells and columns is not None:
+        columns = list(columns) + [CUBE_CELL_COLUMN]
+
+    max_size = current_app.config.get("DATAFRAME_CACHE_SIZE", 0)
+    if cache_type == "arrow" or not max_size or "etag" not in metadata:
+        return drop_cube_cells(
+            load_derived_dataframe(fileid, cache_type, columns), cube_cells
+        )
+
+    df = _get_memory_cached(fileid, cache_type, metadata["etag"])
+    if df is None and columns is not None and cache_type == "parquet":
+        # only read the columns asked for, rather than the whole file
+        return drop_cube_cells(
+            load_derived_dataframe(fileid, cache_type, columns), cube_cells
+        )
+    if df is None:
+        df = load_derived_dataframe(fileid, cache_type)
+        if df is None:
             return None
+        _add_memory_cached(fileid, cache_type, metadata["etag"], df, max_size)
+    else:
+        logging.info("Retrieved dataframe [{}] from memory".format(fileid))
+
+    # removing columns from a shallow copy doesn't copy the data in the others
+    df = df.copy(deep=False)
+    if columns is not None:
+        for c in [c for c in df.columns if c not in columns]:
+            del df[c]
+    return drop_cube_cells(df, cube_cells)
+
+
+def drop_cube_cells(df, cube_cells=False):
+    # the cell of each row in the cube is only kept if it's asked for
+    if df is not None and not cube_cells and CUBE_CELL_COLUMN in df.columns:
+        del df[CUBE_CELL_COLUMN]
+    return df
+
+
+def load_derived_dataframe(fileid, cache_type, columns=None):
+    """
+    Read a dataframe from the file cache, adding any derived columns that
+    are missing because the file was saved by an older version.
+
+    If a derived column is asked for but isn't in the file, the columns
+    it's worked out from are read as well.
+    """
+    df = load_dataframe(fileid, cache_type, columns)
+    if df is not None and columns is not None:
+        missing = [c for c in columns if c in DERIVED_COLUMNS and c not in df.columns]
+        if missing:
+            source_columns = [s for c in missing for s in DERIVED_COLUMNS[c]]
+            df = load_dataframe(fileid, cache_type, list(columns) + source_columns)
+    if df is None:
+        return None
+    return select_columns(add_derived_columns(df), columns)
+
+
+def load_dataframe(fileid, cache_type, columns=None):
+    # read a dataframe from the file cache, without using the memory cache
+    r = get_cache()
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
 
     if cache_type == "redis":
-        df = r.get("{}{}".format(prefix, fileid))
+        df = get_from_redis(r, "{}{}".format(prefix, fileid))
         if df:
             try:
                 logging.info("Retrieved dataframe [{}] from redis".format(fileid))
-                return pickle.loads(df)
+                return select_columns(pickle.loads(df), columns)
             except ImportError as error:
                 logging.info("Dataframe [{}] could not be loaded".format(fileid))
                 return None
 
+    elif cache_type == "parquet":
+        filename = get_filename(fileid, cache_type)
+        if os.path.exists(filename):
+            parquet_file = pq.ParquetFile(filename)
+            if columns is not None:
+                columns = [c for c in parquet_file.schema_arrow.names if c in columns]
+            df = parquet_file.read(columns=columns, use_pandas_metadata=True)
+            logging.info(
+                "Retrieved dataframe [{}] from filesystem as parquet".format(fileid)
+            )
+            return df.to_pandas()
+        logging.info("File [{}] doesn't exist".format(filename))
+
+    elif cache_type == "arrow":
+        filename = get_filename(fileid, cache_type)
+        if os.path.exists(filename):
+            table = pa.ipc.open_file(pa.memory_map(filename, "r")).read_all()
+            if columns is not None:
+                index_columns = (table.schema.pandas_metadata or {}).get(
+                    "index_columns", []
+                )
+                table = table.select(
+                    [
+                        c
+                        for c in table.schema.names
+                        if c in columns or c in index_columns
+                    ]
+                )
+            logging.info(
+                "Retrieved dataframe [{}] from filesystem as arrow".format(fileid)
+            )
+            return table.to_pandas(split_blocks=True)
+        logging.info("File [{}] doesn't exist".format(filename))
+
     else:
         filename = get_filename(fileid)
         if os.path.exists(filename):
@@ -108,7 +436,7 @@ def get_from_cache(fileid, cache_type=None):
                     logging.info(
                         "Retrieved dataframe [{}] from filesystem".format(fileid)
                     )
-                    return df
+                    return select_columns(df, columns)
                 except ImportError as error:
                     logging.info("Dataframe [{}] could not be loaded".format(fileid))
                     return None
@@ -117,6 +445,184 @@ def get_from_cache(fileid, cache_type=None):
     return None
 
 
+def _get_memory_cached(fileid, cache_type, etag):
+    with _dataframes_lock:
+        cached = _dataframes.get((fileid, cache_type))
+        if cached is None or cached[0] != etag:
+            return None
+        _dataframes.move_to_end((fileid, cache_type))
+        return cached[1]
+
+
+def _add_memory_cached(fileid, cache_type, etag, df, max_size, size=None):
+    if size is None:
+        size = df.memory_usage(index=True, deep=True).sum()
+    if size > max_size:
+        return
+    with _dataframes_lock:
+        _dataframes[(fileid, cache_type)] = (etag, df, size)
+        _dataframes.move_to_end((fileid, cache_type))
+        # remove the dataframes used longest ago until under the size limit
+        while sum(cached[2] for cached in _dataframes.values()) > max_size:
+            _dataframes.popitem(last=False)
+
+
+def forget_dataframe(fileid):
+    # remove a file from this process's memory cache
+    with _dataframes_lock:
+        for key in [k for k in _dataframes if k[0] == fileid]:
+            del _dataframes[key]
+
+
+def get_cube_key(fileid):
+    return "{}{}".format(CUBE_KEY_PREFIX, fileid)
+
+
+def save_cube(fileid, cube):
+    # cubes are small, so they're kept in redis whatever the file cache is
+    save_to_redis(
+        get_cache(),
+        get_cube_key(fileid),
+        pickle.dumps(cube),
+        compression=current_app.config.get("REDIS_COMPRESSION"),
+    )
+    logging.info(
+        "Cube [{}] saved to redis ({:,.0f} cells)".format(fileid, len(cube.cells))
+    )
+
+
+def load_cube(fileid):
+    # read a cube from redis, or `None` if it isn't found or can't be used
+    data = get_from_redis(get_cache(), get_cube_key(fileid))
+    if not data:
+        return None
+    try:
+        cube = pickle.loads(data)
+    except (ImportError, AttributeError, pickle.UnpicklingError):
+        logging.info("Cube [{}] could not be loaded".format(fileid))
+        return None
+    if getattr(cube, "version", None) != CUBE_VERSION:
+        return None
+    return cube
+
+
+def get_cube_from_cache(fileid):
+    """
+    Get the aggregation cube for a file, or `None` if the file isn't found.
+
+    The cube is built when the file is saved. If the cube is missing or
+    doesn't match the file's `etag` (eg files saved by an older version)
+    it's built again from the dataframe and saved. Cubes are kept in the
+    same memory cache as dataframes.
+    """
+    metadata = get_metadata_from_cache(fileid)
+    if not metadata:
+        forget_dataframe(fileid)
+        return None
+    if is_expired(metadata):
+        return None
+    get_cache().hset(FILES_ACCESSED_KEY, fileid, int(time.time()))
+
+    etag = metadata.get("etag")
+    cube = _get_memory_cached(fileid, "cube", etag)
+    if cube is not None:
+        return cube
+
+    cube = load_cube(fileid)
+    if cube is None or cube.etag != etag:
+        df = get_from_cache(fileid)
+        if df is None:
+            return None
+        cube, cell_ids = build_indexed_cube(df, etag=etag)
+
+        # the cells saved with the data can only be used if they're the same
+        saved_cells = get_from_cache(fileid, columns=[], cube_cells=True)
+        cube.indexed = (
+            saved_cells is not None
+            and CUBE_CELL_COLUMN in saved_cells.columns
+            and np.array_equal(saved_cells[CUBE_CELL_COLUMN].to_numpy(), cell_ids)
+        )
+        save_cube(fileid, cube)
+    else:
+        logging.info("Retrieved cube [{}] from redis".format(fileid))
+
+    max_size = current_app.config.get("DATAFRAME_CACHE_SIZE", 0)
+    if max_size:
+        _add_memory_cached(
+            fileid, "cube", etag, cube, max_size, size=cube.memory_usage()
+        )
+    return cube
+
+
+def get_results_key(fileid, etag, filters_key):
+    return "{}{}:{}:{}".format(RESULTS_KEY_PREFIX, fileid, etag, filters_key)
+
+
+def get_results_from_cache(fileid, etag, filters_key):
+    """
+    Get the dashboard results saved for a version of a file (its `etag`)
+    and a set of filters, or `None` if they haven't been saved.
+
+    Results that are used have their expiry reset, so the results used
+    most often stay in the cache. Hits and misses are counted in
+    `RESULTS_STATS_KEY`.
+    """
+    ttl = current_app.config.get("RESULTS_CACHE_TTL", 0)
+    if not ttl:
+        return None
+
+    r = get_cache()
+    key = get_results_key(fileid, etag, filters_key)
+    results = None
+    data = r.get(key)
+    if data:
+        try:
+            results = pickle.loads(data)
+        except (ImportError, AttributeError, pickle.UnpicklingError):
+            logging.info("Results [{}] could not be loaded".format(key))
+
+    pipeline = r.pipeline(transaction=False)
+    if results is not None:
+        now = time.time()
+        pipeline.expire(key, ttl)
+        pipeline.zadd(RESULTS_ACCESSED_KEY, {key: now})
+        pipeline.hset(FILES_ACCESSED_KEY, fileid, int(now))
+    pipeline.hincrby(RESULTS_STATS_KEY, "hit" if results is not None else "miss")
+    pipeline.execute()
+    return results
+
+
+def save_results_to_cache(fileid, etag, filters_key, results):
+    """
+    Save the dashboard results for a version of a file and a set of filters.
+
+    Results expire after `RESULTS_CACHE_TTL` seconds without being used, and
+    the results used longest ago are removed once there are more than
+    `RESULTS_CACHE_MAX_ENTRIES`.
+    """
+    ttl = current_app.config.get("RESULTS_CACHE_TTL", 0)
+    if not ttl:
+        return
+
+    r = get_cache()
+    key = get_results_key(fileid, etag, filters_key)
+    now = time.time()
+    pipeline = r.pipeline(transaction=False)
+    pipeline.set(key, pickle.dumps(results), ex=ttl)
+    pipeline.zadd(RESULTS_ACCESSED_KEY, {key: now})
+    # forget results that have already expired
+    pipeline.zremrangebyscore(RESULTS_ACCESSED_KEY, "-inf", now - ttl)
+    pipeline.execute()
+
+    max_entries = current_app.config.get("RESULTS_CACHE_MAX_ENTRIES", 0)
+    if max_entries:
+        excess = r.zcard(RESULTS_ACCESSED_KEY) - max_entries
+        if excess > 0:
+            evicted = r.zrange(RESULTS_ACCESSED_KEY, 0, excess - 1)
+            r.zrem(RESULTS_ACCESSED_KEY, *evicted)
+            r.delete(*evicted)
+
+
 def get_metadata_from_cache(fileid):
     r = get_cache()
 
@@ -124,3 +630,268 @@ def get_metadata_from_cache(fileid):
         return None
 
     return json.loads(r.hget("files", fileid).decode("utf8"))
+
+
+def is_expired(metadata, now=None):
+    if "expires" not in metadata:
+        return False
+    now = now or datetime.datetime.now()
+    return datetime.datetime.fromisoformat(metadata["expires"]) < now
+
+
+def get_file_size(fileid, cache_type=None):
+    # bytes used to store a file in the cache
+    return get_file_sizes([fileid], cache_type)[0]
+
+
+def get_file_sizes(fileids, cache_type=None):
+    """
+    Bytes used to store each of a list of files in the cache.
+
+    With the redis cache, the start of each value (which holds all of a
+    manifest) and its length are fetched in one pipeline, so the values of
+    files saved before manifests were added aren't fetched.
+    """
+    prefix = current_app.config.get("CACHE_DEFAULT_PREFIX", "file_")
+    cache_type = cache_type or current_app.config.get("FILE_CACHE")
+
+    if cache_type == "redis":
+        r = get_cache()
+        keys = ["{}{}".format(prefix, fileid) for fileid in fileids]
+        pipeline = r.pipeline(transaction=False)
+        for key in keys:
+            pipeline.getrange(key, 0, MANIFEST_MAX_SIZE - 1)
+            pipeline.strlen(key)
+        results = pipeline.execute()
+
+        sizes = []
+        for key, value, length in zip(keys, results[::2], results[1::2]):
+            if value[:1] == b"{" and length >= MANIFEST_MAX_SIZE:
+                manifest = get_redis_manifest(r, key)
+            else:
+                manifest = get_redis_manifest(r, key, value)
+            sizes.append(manifest["size"] if manifest else length)
+        return sizes
+
+    sizes = []
+    for fileid in fileids:
+        filename = get_filename(fileid, cache_type)
+        sizes.append(os.path.getsize(filename) if os.path.exists(filename) else 0)
+    return sizes
+
+
+def get_dataframe_checksum(df):
+    """
+    Checksum of the column names and values in a dataframe.
+
+    Values are compared as text, so the checksum is the same whichever type
+    of cache the dataframe was loaded from (eg where numbers in a text
+    column are stored as text, or text is stored as categories).
+    """
+    values = df.astype(object)
+    values = values.where(values.notnull(), None).astype(str)
+    hashes = pd.util.hash_pandas_object(values, index=False).to_numpy()
+    columns = pd.util.hash_pandas_object(pd.Series(df.columns.astype(str)), index=False)
+    checksum = int(hashes.sum() + columns.to_numpy().sum()) % (2 ** 64)
+    return "{:016x}".format(checksum)
+
+
+def repack_file(fileid, from_type, to_type):
+    """
+    Copy a file from one type of cache to another, keeping its metadata, and
+    check that the new copy has the same number of rows and the same checksum.
+
+    Raises a `ValueError` if the file isn't found or the copy doesn't match.
+    """
+    start = time.time()
+    df = load_dataframe(fileid, from_type)
+    if df is None:
+        raise ValueError("File [{}] not found in {} cache".format(fileid, from_type))
+    checksum = get_dataframe_checksum(df)
+
+    write_dataframe(fileid, df, to_type)
+    repacked = load_dataframe(fileid, to_type)
+    if repacked is None or len(repacked) != len(df):
+        raise ValueError(
+            "File [{}] has the wrong number of rows in {} cache".format(fileid, to_type)
+        )
+    if get_dataframe_checksum(repacked) != checksum:
+        raise ValueError(
+            "File [{}] has the wrong checksum in {} cache".format(fileid, to_type)
+        )
+    forget_dataframe(fileid)
+
+    return {
+        "fileid": fileid,
+        "rows": len(df),
+        "size": get_file_size(fileid, to_type),
+        "checksum": checksum,
+        "seconds": time.time() - start,
+    }
+
+
+def _init_repack_worker(config):
+    # each worker process has its own app context to use the cache from
+    app = Flask(__name__)
+    app.config.update(config)
+    app.app_context().push()
+
+
+def _repack_file_job(fileid, from_type, to_type):
+    try:
+        return repack_file(fileid, from_type, to_type)
+    except Exception as error:
+        return {"fileid": fileid, "error": str(error)}
+
+
+def repack_files(from_type, to_type, workers=None, restart=False):
+    """
+    Copy all the files in the cache from one type of cache to another, using
+    a pool of `workers` processes (or in this process if `workers` is 1).
+
+    Files that have been copied are recorded in redis, along with their
+    `etag`, so if the repack is stopped it carries on from where it got to
+    unless `restart` is true. Yields a dictionary for each file copied, with
+    an `error` if the copy failed.
+    """
+    r = get_cache()
+    done_key = REPACK_KEY.format(from_type, to_type)
+    if restart:
+        r.delete(done_key)
+
+    fileids = []
+    for fileid, metadata in r.hscan_iter("files"):
+        etag = json.loads(metadata.decode("utf8")).get("etag", "")
+        done = r.hget(done_key, fileid)
+        if done is None or done.decode("utf8") != etag:
+            fileids.append((fileid.decode("utf8"), etag))
+
+    def record(result, etag):
+        if "error" not in result:
+            r.hset(done_key, result["fileid"], etag)
+        return result
+
+    if workers == 1:
+        for fileid, etag in fileids:
+            yield record(_repack_file_job(fileid, from_type, to_type), etag)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_repack_worker,
+        initargs=(dict(current_app.config),),
+    ) as executor:
+        futures = {
+            executor.submit(_repack_file_job, fileid, from_type, to_type): etag
+            for fileid, etag in fileids
+        }
+        for future in as_completed(futures):
+            yield record(future.result(), futures[future])
+
+
+def sweep_cache(max_size=None, cache_type=None):
+    """
+    Remove files that have expired from the cache, and then remove the files
+    loaded longest ago until the files in the cache use less than `max_size`
+    bytes. Files in the uploads folder that aren't in the cache any more are
+    also removed.
+    """
+    r = get_cache()
+    cache_type = cache_type or current_app.config.get("FILE_CACHE")
+    if max_size is None:
+        max_size = current_app.config.get("CACHE_MAX_SIZE", 0)
+    result = {"expired": 0, "evicted": 0, "orphaned": 0, "size": 0}
+
+    files = []
+    for fileid, metadata in r.hscan_iter("files"):
+        fileid = fileid.decode("utf8")
+        if is_expired(json.loads(metadata.decode("utf8"))):
+            delete_from_cache(fileid, cache_type)
+            result["expired"] += 1
+            continue
+        last_access = r.hget(FILES_ACCESSED_KEY, fileid)
+        size = get_file_size(fileid, cache_type)
+        files.append((int(last_access or 0), fileid, size))
+        result["size"] += size
+
+    if max_size:
+        for last_access, fileid, size in sorted(files):
+            if result["size"] <= max_size:
+                break
+            delete_from_cache(fileid, cache_type)
+            result["evicted"] += 1
+            result["size"] -= size
+
+    result["orphaned"] = remove_orphaned_files()
+    logging.info(
+        "Cache sweep: {expired:,.0f} expired and {evicted:,.0f} evicted files removed, "
+        "{orphaned:,.0f} orphaned files removed, {size:,.0f} bytes used".format(
+            **result
+        )
+    )
+    return result
+
+
+def remove_orphaned_files(min_age=60 * 60):
+    """
+    Remove files from the uploads folder that aren't in the `files` hash.
+    Files modified in the last `min_age` seconds are kept, as they may
+    still be being saved.
+    """
+    r = get_cache()
+    uploads_folder = current_app.config.get("UPLOADS_FOLDER")
+    if not os.path.isdir(uploads_folder):
+        return 0
+    extensions = set(FILE_EXTENSIONS.values()) | {"pkl"}
+    removed = 0
+    for entry in os.scandir(uploads_folder):
+        fileid, _, extension = entry.name.rpartition(".")
+        if not entry.is_file() or extension not in extensions:
+            continue
+        if r.hexists("files", fileid):
+            continue
+        if time.time() - entry.stat().st_mtime < min_age:
+            continue
+        os.remove(entry.path)
+        logging.info("Orphaned file [{}] removed".format(entry.path))
+        removed += 1
+    return removed
+
+
+def sweep_cache_job(interval=None):
+    """
+    Sweep the cache and then schedule the next sweep in `interval` seconds.
+    Needs a worker that runs scheduled jobs.
+    """
+    result = sweep_cache()
+    get_cache().delete(CACHE_SWEEP_LOCK_KEY)
+    schedule_cache_sweep(interval)
+    return result
+
+
+def schedule_cache_sweep(interval=None):
+    """
+    Schedule a sweep of the cache in `interval` seconds, unless one is
+    already scheduled. Returns the new job, or `None`.
+
+    Every worker calls this when it starts, so a lock is taken in redis
+    (until the sweep runs, or twice the interval) so that only one of them
+    schedules the sweep.
+    """
+    if interval is None:
+        interval = current_app.config.get("CACHE_SWEEP_INTERVAL", 0)
+    if not interval:
+        return None
+    r = get_cache()
+    if not r.set(CACHE_SWEEP_LOCK_KEY, int(time.time()), nx=True, ex=interval * 2):
+        return None
+    q = Queue("low", connection=r)
+    scheduled = ScheduledJobRegistry(queue=q).get_job_ids()
+    if any(job_id.startswith(CACHE_SWEEP_JOB_ID) for job_id in scheduled):
+        return None
+    return q.enqueue_in(
+        datetime.timedelta(seconds=interval),
+        sweep_cache_job,
+        interval,
+        job_id="{}-{}".format(CACHE_SWEEP_JOB_ID, uuid.uuid4().hex),
+    )
@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+
+from .utils import add_derived_columns, parse_identifiers
+
+# version of the cube format - increase this if the dimensions or measures
+# change, so that cubes saved by older versions are built again
+CUBE_VERSION = 5
+
+# column of the saved data holding the cell of the cube each row is in
+CUBE_CELL_COLUMN = "__cube_cell"
+
+# columns of the data used as dimensions of the cube (if they're in the data)
+CUBE_COLUMNS = [
+    "Funding Org:0:Name",
+    "Grant Programme:0:Title",
+    "Currency",
+    "Amount Awarded:Bands",
+    "__geo_ctry",
+    "__geo_rgn",
+    "__org_latest_income_bands",
+    "__org_age_bands",
+    "__org_type",
+]
+
+# maximum rank of LSOAs by IMD in England (1 = most deprived)
+# from: https://www.arcgis.com/sharing/rest/content/items/0a404beab6f544be8fb72d0c2b12d62b/data
+IMD_TOTAL_ENG = 32844
+
+
+def get_imd_deciles(df):
+    # IMD decile (1 = most deprived) of grants in England
+    imd = df["__geo_imd"].where(df["__geo_ctry"] == "England")
+    return np.ceil((imd.astype(float) / IMD_TOTAL_ENG) * 10)
+
+
+def get_cube_dimensions(df):
+    """
+    Get the columns that grants are grouped by in the cube.
+
+    As well as the columns in `CUBE_COLUMNS`, the month of the award, the
+    identifier scheme and the IMD decile are added.
+    """
+    # files saved by older versions don't include the derived columns
+    df = add_derived_columns(df.copy(deep=False))
+
+    dims = pd.DataFrame(index=df.index)
+    for c in CUBE_COLUMNS:
+        if c in df.columns:
+            dims[c] = df[c]
+
+    if "Award Date" in df.columns:
+        award_date = df["Award Date"]
+        if award_date.dt.tz is not None:
+            award_date = award_date.dt.tz_convert(None)
+        dims["award_month"] = award_date.dt.to_period("M").dt.to_timestamp()
+
+    if "Recipient Org:0:Identifier" in df.columns:
+        dims["identifier_scheme"] = parse_identifiers(df["Recipient Org:0:Identifier"])[
+            "scheme"
+        ]
+
+    if "__geo_imd" in df.columns and "__geo_ctry" in df.columns:
+        dims["imd_decile"] = get_imd_deciles(df)
+
+    return dims
+
+
+def build_cube(df, etag=None):
+    """
+    Aggregate a dataframe of grants into a `GrantsCube`.
+
+    Grants are grouped by every combination of the dimensions found in the
+    data, holding the number of grants, the total amount awarded and the
+    number of distinct recipients for each combination.
+    """
+    return build_indexed_cube(df, etag=etag)[0]
+
+
+def build_indexed_cube(df, etag=None):
+    """
+    Aggregate a dataframe of grants into a `GrantsCube`, also returning the
+    cell of each row of the data (which is saved with the data, as
+    `CUBE_CELL_COLUMN`).
+    """
+    dims = get_cube_dimensions(df)
+    if len(dims.columns):
+        codes = np.column_stack([pd.factorize(dims[c])[0] for c in dims.columns])
+        _, first_rows, cell_ids = np.unique(
+            codes, axis=0, return_index=True, return_inverse=True
+        )
+        cell_ids = cell_ids.reshape(-1)
+    else:
+        first_rows = np.arange(min(len(dims), 1))
+        cell_ids = np.zeros(len(dims), dtype=int)
+
+    cells = dims.iloc[first_rows].reset_index(drop=True)
+    cell_count = len(cells)
+
+    amounts = np.zeros(len(df))
+    if "Amount Awarded" in df.columns:
+        amounts = df["Amount Awarded"].to_numpy(dtype=float)
+    cells["Grants"] = np.bincount(cell_ids, minlength=cell_count)
+    cells["Amount Awarded"] = np.bincount(
+        cell_ids, weights=np.nan_to_num(amounts), minlength=cell_count
+    )
+
+    # distinct amounts in each cell, and the number of grants of each amount
+    has_amount = ~np.isnan(amounts)
+    amount_pairs, amount_counts = np.unique(
+        np.column_stack([cell_ids[has_amount], amounts[has_amount]]),
+        axis=0,
+        return_counts=True,
+    )
+    cells["Amounts"] = np.bincount(amount_pairs[:, 0].astype(int), minlength=cell_count)
+
+    # distinct recipients in each cell, in the order of the cells
+    recipients = np.zeros(len(df), dtype=int)
+    if "Recipient Org:0:Identifier" in df.columns:
+        recipients = pd.factorize(df["Recipient Org:0:Identifier"])[0]
+    pairs = np.unique(np.column_stack([cell_ids, recipients]), axis=0)
+    pairs = pairs[pairs[:, 1] >= 0]
+    cells["Recipients"] = np.bincount(pairs[:, 0], minlength=cell_count)
+
+    cube = GrantsCube(
+        cells,
+        amount_pairs[:, 1],
+        amount_counts.astype(np.int32),
+        pairs[:, 1].astype(np.int32),
+        etag=etag,
+    )
+    return cube, cell_ids.astype(np.int32)
+
+
+def weighted_median(values, counts):
+    # median of `values` where each value appears `counts` times
+    order = np.argsort(values, kind="stable")
+    values = values[order]
+    cumulative = np.cumsum(counts[order])
+    total = cumulative[-1]
+    lower = values[np.searchsorted(cumulative, (total - 1) // 2, side="right")]
+    upper = values[np.searchsorted(cumulative, total // 2, side="right")]
+    return (lower + upper) / 2
+
+
+class GrantsCube(object):
+    """
+    Grants aggregated by a set of dimensions.
+
+    `cells` is a dataframe with a row for each combination of dimensions
+    found in the data, and the number of grants (`Grants`), the total
+    amount awarded (`Amount Awarded`), the number of distinct amounts
+    (`Amounts`) and the number of distinct recipients (`Recipients`) in each.
+
+    The distinct amounts in each cell (with the number of grants of each
+    amount, in `amount_counts`) and the distinct recipients in each cell are
+    also kept (in the same order as the cells) so that medians and distinct
+    counts can be worked out for any selection of cells.
+
+    Nothing is kept for each grant, so the size of the cube depends on the
+    number of distinct combinations of dimensions, amounts and recipients
+    rather than the number of grants. As the month of the award is one of
+    the dimensions, a file can have up to one cell for each month for every
+    combination of the other dimensions.
+
+    `indexed` is true if the data was saved with the cell of each row (in
+    `CUBE_CELL_COLUMN`), which is used to find the rows in any selection of
+    cells.
+    """
+
+    version = CUBE_VERSION
+    measures = ["Grants", "Amount Awarded", "Amounts", "Recipients"]
+
+    def __init__(
+        self, cells, amounts, amount_counts, recipients, etag=None, indexed=False
+    ):
+        self.cells = cells
+        self.amounts = amounts
+        self.amount_counts = amount_counts
+        self.recipients = recipients
+        self.etag = etag
+        self.indexed = indexed
+
+    def __len__(self):
+        return int(self.cells["Grants"].sum())
+
+    @property
+    def columns(self):
+        return [c for c in self.cells.columns if c not in self.measures]
+
+    def memory_usage(self):
+        return (
+            self.cells.memory_usage(index=True, deep=True).sum()
+            + self.amounts.nbytes
+            + self.amount_counts.nbytes
+            + self.recipients.nbytes
+        )
+
+    def select(self, mask):
+        # a cube with only the cells where `mask` is true
+        mask = np.asarray(mask, dtype=bool)
+        amounts = np.repeat(mask, self.cells["Amounts"])
+        return GrantsCube(
+            self.cells[mask],
+            self.amounts[amounts],
+            self.amount_counts[amounts],
+            self.recipients[np.repeat(mask, self.cells["Recipients"])],
+            etag=self.etag,
+        )
+
+    def get_row_mask(self, cells, rows):
+        """
+        Get a boolean array of whether each row of the data is in one of
+        `cells` (an index of cells from this cube), from the cell of each
+        row (`rows`).
+        """
+        selected = np.zeros(len(self.cells), dtype=bool)
+        selected[cells] = True
+        return selected[rows]
+
+    def value_counts(self, dimension):
+        # number of grants for each value of a dimension, like `Series.value_counts`
+        return (
+            self.cells.groupby(dimension, observed=False)["Grants"]
+            .sum()
+            .sort_values(ascending=False)
+        )
+
+    def median_amounts(self, dimension):
+        # median amount of the grants for each value of a dimension
+        values = np.repeat(
+            self.cells[dimension].to_numpy(dtype=object), self.cells["Amounts"]
+        )
+        amounts = pd.DataFrame({"amount": self.amounts, "count": self.amount_counts})
+        return pd.Series(
+            {
+                value: weighted_median(
+                    group["amount"].to_numpy(), group["count"].to_numpy()
+                )
+                for value, group in amounts.groupby(values)
+            },
+            dtype=float,
+        )
+
+    def recipient_values(self, dimension):
+        # value of a dimension for each of the recipients in `self.recipients`
+        return np.repeat(
+            self.cells[dimension].to_numpy(dtype=object), self.cells["Recipients"]
+        )
+
+    def unique_recipients(self):
+        return np.unique(self.recipients).size
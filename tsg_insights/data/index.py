@@ -0,0 +1,221 @@
+import datetime
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+from flask import current_app, has_app_context
+
+from .utils import normalise_postcode
+
+INDEX_META = "meta.json"
+INDEX_KEYS = "keys.npy"
+
+# indexes that have been opened by this process, so they're only mapped once
+_open_indexes = {}
+
+
+class SortedIndex(object):
+    """
+    A read-only lookup table stored as a directory of numpy arrays.
+
+    Keys are stored as a sorted fixed-width byte array, so lookups are a
+    vectorised binary search. Text columns with up to `max_categories`
+    distinct values are stored as integer codes into a list of categories,
+    and other text columns (eg company numbers or postcodes) are stored as
+    fixed-width UTF-8 byte arrays. Dates are stored in UTC. The arrays are
+    memory-mapped, so every process using the index shares the same copy
+    through the page cache.
+    """
+
+    # text columns with more distinct values than this are stored as bytes,
+    # so the categories don't need to be loaded by every process
+    max_categories = 5000
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_META)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.keys = np.load(os.path.join(path, INDEX_KEYS), mmap_mode="r")
+        self.columns = {}
+        for column in self.meta["columns"]:
+            self.columns[column["name"]] = (
+                np.load(os.path.join(path, column["file"]), mmap_mode="r"),
+                np.array(column["categories"], dtype=object)
+                if column["categories"] is not None
+                else None,
+                column.get("timezone"),
+                column.get("encoding"),
+            )
+
+    def __len__(self):
+        return len(self.keys)
+
+    @staticmethod
+    def normalise_key(key):
+        if not isinstance(key, str):
+            return None
+        return key.strip().upper()
+
+    @classmethod
+    def build(cls, df, path):
+        """
+        Create an index at `path` from a dataframe, using the dataframe's
+        index as the keys. Any existing index at `path` is replaced.
+        """
+        keys = df.index.map(cls.normalise_key)
+        valid = keys.map(lambda k: isinstance(k, str) and k.isascii()).to_numpy(bool)
+        df = df[valid]
+        keys = keys[valid]
+        df = df[~keys.duplicated()]
+        keys = keys[~keys.duplicated()]
+
+        keys = np.array(keys.tolist(), dtype="S")
+        order = np.argsort(keys, kind="stable")
+
+        build_path = path + ".building"
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path)
+        os.makedirs(build_path)
+
+        np.save(os.path.join(build_path, INDEX_KEYS), keys[order])
+        meta = {
+            "created": datetime.datetime.now().isoformat(),
+            "rows": len(keys),
+            "columns": [],
+        }
+        for i, c in enumerate(df.columns):
+            column = {"name": c, "file": "column_{}.npy".format(i), "categories": None}
+            values = df[c]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                column["timezone"] = "UTC"
+                values = pd.to_datetime(values, utc=True).dt.tz_localize(None)
+                values = values.to_numpy("datetime64[ns]")
+            elif pd.api.types.is_numeric_dtype(values):
+                values = values.to_numpy()
+            else:
+                values = values.astype("category")
+                if len(values.cat.categories) <= cls.max_categories:
+                    column["categories"] = values.cat.categories.astype(str).tolist()
+                    values = values.cat.codes.to_numpy()
+                else:
+                    # missing values are stored as empty strings
+                    column["encoding"] = "utf-8"
+                    values = np.array(
+                        [
+                            b"" if pd.isnull(v) else str(v).encode("utf-8")
+                            for v in values.astype(object)
+                        ],
+                        dtype="S",
+                    )
+            np.save(os.path.join(build_path, column["file"]), values[order])
+            meta["columns"].append(column)
+
+        with open(os.path.join(build_path, INDEX_META), "w") as meta_file:
+            json.dump(meta, meta_file)
+
+        # swap the new index in place of the old one. Processes that already
+        # have the old index mapped keep using it until they reopen it
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(build_path, path)
+        logging.info("Index of {:,.0f} rows saved to {}".format(len(keys), path))
+        return cls(path)
+
+    def _find(self, keys):
+        # returns the position of each key in the index, and whether it was found
+        keys = pd.Series(keys, dtype=object).map(self.normalise_key)
+        width = self.keys.dtype.itemsize
+        fits = keys.map(
+            lambda k: isinstance(k, str) and k.isascii() and len(k) <= width
+        ).to_numpy(bool)
+        query = np.array(keys.where(fits, "").tolist(), dtype=self.keys.dtype)
+        positions = np.searchsorted(self.keys, query)
+        positions = np.clip(positions, 0, max(len(self.keys) - 1, 0))
+        found = fits & (len(self.keys) > 0)
+        found[found] = self.keys[positions[found]] == query[found]
+        return positions, found
+
+    def contains(self, keys):
+        return self._find(keys)[1]
+
+    def lookup(self, keys):
+        """
+        Find a list of keys in the index.
+
+        Returns a dataframe with a row for each key that was found, indexed
+        by the key as it was given.
+        """
+        keys = np.asarray(keys, dtype=object)
+        positions, found = self._find(keys)
+        positions = positions[found]
+        result = {}
+        for name, (values, categories, timezone, encoding) in self.columns.items():
+            values = values[positions]
+            if categories is not None:
+                codes = values
+                values = np.full(len(codes), None, dtype=object)
+                values[codes >= 0] = categories[codes[codes >= 0]]
+            elif encoding is not None:
+                values = np.array(
+                    [v.decode(encoding) if v else None for v in values], dtype=object
+                )
+            elif timezone is not None:
+                values = pd.DatetimeIndex(values).tz_localize(timezone)
+            result[name] = values
+        return pd.DataFrame(result, index=pd.Index(keys[found]))
+
+
+class PostcodeIndex(SortedIndex):
+    @staticmethod
+    def normalise_key(key):
+        return normalise_postcode(key)
+
+
+def import_postcodes(csv_file, path, fields, key_field="pcds"):
+    """
+    Build a postcode index from a CSV file with one row per postcode, such
+    as the National Statistics Postcode Lookup (NSPL).
+    """
+    numeric_fields = ["lat", "long", "imd"]
+    df = pd.read_csv(
+        csv_file,
+        usecols=[key_field] + fields,
+        index_col=key_field,
+        dtype={f: "category" for f in fields if f not in numeric_fields},
+    )
+    return PostcodeIndex.build(df[fields], path)
+
+
+def open_index(path, index_class=SortedIndex):
+    # open an index, reusing it if this process has already mapped it
+    meta_file = os.path.join(path, INDEX_META)
+    if not os.path.exists(meta_file):
+        return None
+    modified = os.path.getmtime(meta_file)
+    if path in _open_indexes and _open_indexes[path][0] == modified:
+        return _open_indexes[path][1]
+    index = index_class(path)
+    _open_indexes[path] = (modified, index)
+    return index
+
+
+def get_register_index(source):
+    # `source` is the name of the register, eg "charity" or "company"
+    if not has_app_context():
+        return None
+    path = current_app.config.get("REGISTER_INDEX")
+    if not path:
+        return None
+    return open_index(os.path.join(path, source))
+
+
+def get_postcode_index():
+    if not has_app_context():
+        return None
+    path = current_app.config.get("POSTCODE_INDEX")
+    if not path:
+        return None
+    return open_index(path, PostcodeIndex)
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+
+import requests
+from flask import current_app, has_app_context
+
+# default settings for the lookup engine - can be overridden in the app config
+LOOKUP_MAX_WORKERS = 16  # total number of concurrent requests
+LOOKUP_HOST_LIMIT = 4  # concurrent requests to any one host
+LOOKUP_RETRIES = 3  # number of times a failed request is retried
+LOOKUP_BACKOFF = 0.5  # seconds to wait before the first retry (doubles each time)
+LOOKUP_TIMEOUT = 30  # seconds before a request times out
+
+# status codes that are worth trying again
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class LookupEngine(object):
+    """
+    Fetch JSON from a set of URLs concurrently.
+
+    Requests are made from a thread pool, with a limit on the number of
+    requests made to any one host at the same time. Requests that fail
+    with a connection error or a temporary server error are retried with
+    an exponential backoff.
+    """
+
+    def __init__(
+        self,
+        max_workers=LOOKUP_MAX_WORKERS,
+        host_limit=LOOKUP_HOST_LIMIT,
+        retries=LOOKUP_RETRIES,
+        backoff=LOOKUP_BACKOFF,
+        timeout=LOOKUP_TIMEOUT,
+    ):
+        self.max_workers = max_workers
+        self.host_limit = host_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    def _get_semaphore(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.host_limit
+                )
+            return self._host_semaphores[host]
+
+    def request(self, url, method="GET", **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        semaphore = self._get_semaphore(url)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * (2 ** (attempt - 1)))
+            try:
+                with semaphore:
+                    r = requests.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt == self.retries:
+                    raise
+                logging.info("Retrying {} [{}]".format(url, error))
+                continue
+            if r.status_code not in RETRY_STATUS_CODES or attempt == self.retries:
+                return r
+            logging.info("Retrying {} [HTTP {}]".format(url, r.status_code))
+
+    def _fetch_json(self, url, method="GET", **kwargs):
+        r = self.request(url, method, **kwargs)
+        r.raise_for_status()
+        return r.json()
+
+    def _run(self, tasks):
+        # run a dictionary of `{key: (url, method, kwargs)}` in the thread pool
+        if not tasks:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._fetch_json, url, method, **kwargs): key
+                for key, (url, method, kwargs) in tasks.items()
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    yield (key, future.result(), None)
+                except (requests.RequestException, ValueError) as error:
+                    yield (key, None, error)
+
+    def fetch_json(self, urls, method="GET", **kwargs):
+        """
+        Fetch a dictionary of `{key: url}`.
+
+        Yields a `(key, data, error)` tuple for each url, in the order that
+        they complete. `data` is `None` if the request failed.
+        """
+        return self._run({key: (url, method, kwargs) for key, url in urls.items()})
+
+    def post_json(self, url, payloads):
+        """
+        Send each of a dictionary of `{key: payload}` to the same url as a
+        JSON POST request.
+
+        Yields a `(key, data, error)` tuple for each payload, in the order that
+        they complete. `data` is `None` if the request failed.
+        """
+        return self._run(
+            {key: (url, "POST", {"json": payload}) for key, payload in payloads.items()}
+        )
+
+
+def get_error_reason(error):
+    """
+    Reason code for a failed lookup that won't succeed if it is tried again
+    soon, or `None` if the failure may be temporary.
+    """
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code
+        if status_code in RETRY_STATUS_CODES:
+            return None
+        if status_code == 404:
+            return "not-found"
+        return "http-{}".format(status_code)
+    if isinstance(error, ValueError):
+        return "invalid-json"
+    return None
+
+
+def get_lookup_engine():
+    if not has_app_context():
+        return LookupEngine()
+    config = current_app.config
+    return LookupEngine(
+        max_workers=config.get("LOOKUP_MAX_WORKERS", LOOKUP_MAX_WORKERS),
+        host_limit=config.get("LOOKUP_HOST_LIMIT", LOOKUP_HOST_LIMIT),
+        retries=config.get("LOOKUP_RETRIES", LOOKUP_RETRIES),
+        backoff=config.get("LOOKUP_BACKOFF", LOOKUP_BACKOFF),
+    )
@@ -1,24 +1,62 @@
-import base64
 import datetime
+import heapq
 import io
+import itertools
 import json
 import logging
 import os
+import time
 
 import pandas as pd
 import requests
 import tqdm
-from rq import get_current_job
+from flask import current_app, has_app_context
+from rq import Queue, get_current_job
 from threesixty import ThreeSixtyGiving
 
 from .cache import get_cache, get_from_cache, get_metadata_from_cache, save_to_cache
+from .index import SortedIndex, get_postcode_index, get_register_index
+from .lookup import get_error_reason, get_lookup_engine
+from .records import (
+    COMPANY_REPLACE,
+    ORG_FIELDS,
+    POSTCODE_FIELDS,
+    RECORD_FIELDS,
+    decode_record,
+    encode_record,
+    get_fetched_at,
+    get_org_type,
+    is_current_record,
+)
 from .registry import fetch_reg_file, get_reg_file_from_url
-from .utils import charity_number_to_org_id, get_fileid
+from .utils import (
+    GEO_COLUMNS,
+    add_derived_columns,
+    charity_number_to_org_id,
+    decode_contents,
+    get_content_fileid,
+    get_fileid,
+    normalise_postcode,
+    parse_identifiers,
+)
 
 FTC_URL = "https://findthatcharity.uk/orgid/{}/canonical.json"
 CH_URL = "http://data.companieshouse.gov.uk/doc/company/{}.json"
 PC_URL = "https://findthatpostcode.uk/postcodes/{}.json"
+# bulk postcode endpoint - if set postcodes are looked up in batches
+PC_BATCH_URL = None
+PC_BATCH_SIZE = 250
 PC_NAMES_URL = "https://findthatpostcode.uk/areas/names.csv"
+NEGATIVE_CACHE_TTL = 60 * 60 * 24 * 7  # failed lookups aren't retried for a week
+NEGATIVE_CACHE_PREFIX = "negative:"
+LOOKUP_STATS_KEY = "lookup_stats"
+# seconds before a cached lookup is refreshed
+LOOKUP_MAX_AGE = {
+    "charity": 60 * 60 * 24 * 30,
+    "company": 60 * 60 * 24 * 30,
+    "postcode": 60 * 60 * 24 * 365,
+}
+LOOKUP_MAX_ENTRIES = 1000000  # maximum number of cached lookups for each source
 
 # config
 # schemes with data on findthatcharity
@@ -45,18 +83,29 @@ FTC_SCHEMES = [
     "GB-WALEDU",
     "GB-PLA",
 ]
-POSTCODE_FIELDS = [
-    "ctry",
-    "cty",
-    "laua",
-    "pcon",
-    "rgn",
-    "imd",
-    "ru11ind",
-    "oac11",
-    "lat",
-    "long",
-]  # fields to care about from the postcodes)
+
+# columns in bulk register CSV files, and the register fields they map to
+REGISTER_CSV_FIELDS = {
+    # findthatcharity organisation data, using the same names as the JSON API
+    "charity": {
+        "id": "orgid",
+        "charityNumber": "charity_number",
+        "companyNumber": "company_number",
+        "dateRegistered": "date_registered",
+        "dateRemoved": "date_removed",
+        "postalCode": "postcode",
+        "latestIncome": "latest_income",
+        "organisationTypePrimary": "org_type",
+    },
+    # Companies House basic company data
+    "company": {
+        "CompanyNumber": "company_number",
+        "IncorporationDate": "date_registered",
+        "DissolutionDate": "date_removed",
+        "RegAddress.PostCode": "postcode",
+        "CompanyCategory": "org_type",
+    },
+}
 
 # column to add to indicate datastore data has been used
 DATASTORE_IS_USED_COL = "__used_additional_data"
@@ -65,7 +114,7 @@ DATASTORE_IS_USED_COL = "__used_additional_data"
 def get_dataframe_from_file(
     filename, contents, date=None, expire_days=(2 * (365 / 12))
 ):
-    fileid = get_fileid(contents, filename, date)
+    fileid = get_content_fileid(contents, filename, date)
 
     # 2. Check cache for file
     df = get_from_cache(fileid)
@@ -89,10 +138,17 @@ def get_dataframe_from_file(
             datetime.datetime.now() + datetime.timedelta(expire_days)
         ).isoformat()
     }
+    defer_companies = check_deferred_company_lookups(df, cache)
+    if defer_companies:
+        metadata["company_lookup"] = "queued"
 
     # 5. save to cache
     save_to_cache(fileid, df, metadata=metadata)  # dataframe
 
+    # 6. look up companies in the background if there were too many
+    if defer_companies:
+        queue_deferred_company_lookups(fileid, job)
+
     return (fileid, filename)
 
 
@@ -144,20 +200,82 @@ def get_dataframe_from_url(url, use_cache=True):
     }
     if registry:
         metadata["registry_entry"] = registry
+    defer_companies = check_deferred_company_lookups(df, cache)
+    if defer_companies:
+        metadata["company_lookup"] = "queued"
 
     # 5. save to cache
     save_to_cache(fileid, df, metadata=metadata)  # dataframe
 
+    # 6. look up companies in the background if there were too many
+    if defer_companies:
+        queue_deferred_company_lookups(fileid, job)
+
     return (fileid, url, headers)
 
 
+def check_deferred_company_lookups(df, cache):
+    # whether company lookups were skipped because there were too many companies
+    if not current_app.config.get("DEFER_COMPANY_LOOKUPS", True):
+        return False
+    stage = LookupCompanyDetails(df, cache, None)
+    if stage.skip_job():
+        return False
+    return len(stage._get_company_orgids()) > stage._get_company_limit()
+
+
+def queue_deferred_company_lookups(fileid, job=None):
+    # run after the current job, so the file is available straight away
+    q = Queue("low", connection=get_cache())
+    return q.enqueue_call(
+        func=get_deferred_company_lookups,
+        args=(fileid,),
+        timeout="2h",
+        depends_on=job,
+    )
+
+
+def get_deferred_company_lookups(fileid):
+    """
+    Look up all the companies in a file without a limit, and then update the
+    organisation and geo data in the cached file.
+    """
+    df = get_from_cache(fileid)
+    metadata = get_metadata_from_cache(fileid)
+    if df is None or metadata is None:
+        return None
+
+    # org and geo data is recreated with the new company data
+    df = df.drop(columns=[c for c in df.columns if c.startswith(("__org_", "__geo_"))])
+    df = df.astype({c: object for c in df.select_dtypes(["category"]).columns})
+    cache = prepare_lookup_cache()
+    job = get_current_job()
+    data_preparation = DataPreparation(df, cache, job, company_limit=None)
+    data_preparation.stages = [
+        LookupCompanyDetails,
+        MergeCompanyAndCharityDetails,
+        FetchPostcodes,
+        MergeGeoData,
+        AddExtraFieldsExternal,
+        AddDerivedColumns,
+        CompactDataTypes,
+    ]
+    df = data_preparation.run()
+
+    metadata["company_lookup"] = "complete"
+    save_to_cache(fileid, df, metadata=metadata)
+    return fileid
+
+
 def prepare_lookup_cache(cache=None):
     if cache is None:
         cache = get_cache()
 
     if not cache.exists("geocodes"):
+        pipeline = cache.pipeline(transaction=False)
         for g, name in fetch_geocodes().items():
-            cache.hset("geocodes", g, name)
+            pipeline.hset("geocodes", g, name)
+        pipeline.execute()
     return cache
 
 
@@ -169,6 +287,50 @@ def fetch_geocodes():
     return geocodes
 
 
+def import_register(csv_file, path, source):
+    """
+    Build a local snapshot of a charity or company register from a bulk CSV
+    file, keyed by org-id, holding the fields used by
+    `MergeCompanyAndCharityDetails`.
+    """
+    fields = REGISTER_CSV_FIELDS[source]
+    df = pd.read_csv(
+        csv_file,
+        usecols=lambda c: c.strip() in fields,
+        dtype=str,
+        keep_default_na=False,
+        na_values=[""],
+    )
+    df = df.rename(columns=lambda c: fields[c.strip()]).reindex(
+        columns=["orgid"] + ORG_FIELDS
+    )
+
+    if source == "company":
+        df.loc[:, "company_number"] = df["company_number"].str.strip()
+        df.loc[:, "orgid"] = "GB-COH-" + df["company_number"]
+        df.loc[:, "org_type"] = df["org_type"].replace(COMPANY_REPLACE)
+        for c in ["date_registered", "date_removed"]:
+            df.loc[:, c] = pd.to_datetime(
+                df[c], dayfirst=True, utc=True, errors="coerce"
+            )
+    else:
+        df.loc[:, "org_type"] = [
+            get_org_type(orgid, org_type)
+            for orgid, org_type in zip(df["orgid"].fillna(""), df["org_type"])
+        ]
+        for c in ["date_registered", "date_removed"]:
+            df.loc[:, c] = pd.to_datetime(df[c], utc=True, errors="coerce")
+
+        # charities registered as companies can also be found by their company
+        # number, as they are through the findthatcharity API
+        companies = df[df["company_number"].notnull()].copy()
+        companies.loc[:, "orgid"] = "GB-COH-" + companies["company_number"]
+        df = pd.concat([df, companies])
+
+    df.loc[:, "latest_income"] = pd.to_numeric(df["latest_income"], errors="coerce")
+    return SortedIndex.build(df.set_index("orgid")[ORG_FIELDS], path)
+
+
 class DataPreparation(object):
     def __init__(self, df, cache=None, job=None, **kwargs):
         self.stages = [
@@ -184,6 +346,8 @@ class DataPreparation(object):
             FetchPostcodes,
             MergeGeoData,
             AddExtraFieldsExternal,
+            AddDerivedColumns,
+            CompactDataTypes,
         ]
         self.df = df
         self.cache = cache
@@ -205,7 +369,7 @@ class DataPreparation(object):
         self.job.save_meta()
 
     def run(self):
-        df = None
+        df = self.df
         self._setup_job_meta()
         for k, Stage in enumerate(self.stages):
             stage = Stage(df, self.cache, self.job, **self.attributes)
@@ -219,6 +383,9 @@ class DataPreparation(object):
 
 
 class DataPreparationStage(object):
+
+    redis_chunk_size = 1000  # number of keys fetched or written at once
+
     def __init__(self, df, cache, job, **kwargs):
         self.df = df
         self.cache = cache
@@ -231,6 +398,28 @@ class DataPreparationStage(object):
         self.job.meta["progress"]["progress"] = (item_key, total_items)
         self.job.save_meta()
 
+    def _get_postcode_index(self):
+        if "postcode_index" in self.attributes:
+            return self.attributes["postcode_index"]
+        return get_postcode_index()
+
+    def _get_register_index(self, source):
+        if "register_index" in self.attributes:
+            return self.attributes["register_index"].get(source)
+        return get_register_index(source)
+
+    def _get_cached(self, key, fields):
+        # fetch fields from a redis hash in chunks, returning
+        # a dictionary of the fields that were found
+        fields = list(fields)
+        found = {}
+        for i in range(0, len(fields), self.redis_chunk_size):
+            chunk = fields[i : i + self.redis_chunk_size]
+            for field, value in zip(chunk, self.cache.hmget(key, chunk)):
+                if value is not None:
+                    found[field] = value
+        return found
+
     def skip_job(self):
         # should return true if this step shouldn't be run
         return False
@@ -266,10 +455,8 @@ class LoadDatasetFromFile(DataPreparationStage):
         contents = self.attributes.get("contents")
         filename = self.attributes.get("filename")
 
-        if isinstance(contents, str):
-            # if it's a string we assume it's dataurl/base64 encoded
-            content_type, content_string = contents.split(",")
-            contents = base64.b64decode(content_string)
+        # if it's a string we assume it's dataurl/base64 encoded
+        contents = decode_contents(contents)
 
         if filename.endswith("csv"):
             # Assume that the user uploaded a CSV file
@@ -347,11 +534,9 @@ class AddExtraColumns(DataPreparationStage):
 
     def run(self):
         self.df.loc[:, "Award Date:Year"] = self.df["Award Date"].dt.year
-        self.df.loc[:, "Recipient Org:0:Identifier:Scheme"] = self.df[
-            "Recipient Org:0:Identifier"
-        ].apply(
-            lambda x: "360G" if x.startswith("360G-") else "-".join(x.split("-")[:2])
-        )
+        self.df["Recipient Org:0:Identifier:Scheme"] = parse_identifiers(
+            self.df["Recipient Org:0:Identifier"]
+        )["scheme"]
         return self.df
 
 
@@ -390,16 +575,11 @@ class CleanRecipientIdentifiers(DataPreparationStage):
 
         # overwrite the identifier scheme using the new identifiers
         # @TODO: this doesn't work well at the moment - seems to lose lots of identifiers
-        self.df.loc[:, "Recipient Org:0:Identifier:Scheme"] = (
-            self.df["Recipient Org:0:Identifier:Clean"]
-            .apply(
-                lambda x: (
-                    "360G" if x.startswith("360G-") else "-".join(x.split("-")[:2])
-                )
-                if isinstance(x, str)
-                else None
-            )
-            .fillna(self.df["Recipient Org:0:Identifier:Scheme"])
+        self.df["Recipient Org:0:Identifier:Scheme"] = (
+            parse_identifiers(self.df["Recipient Org:0:Identifier:Clean"])["scheme"]
+            .astype(object)
+            .fillna(self.df["Recipient Org:0:Identifier:Scheme"].astype(object))
+            .astype("category")
         )
 
         return self.df
@@ -453,20 +633,137 @@ class MapAdditionalDataFields(DataPreparationStage):
         return self.df
 
 
-class LookupCharityDetails(DataPreparationStage):
+class ExternalLookupStage(DataPreparationStage):
+    # base class for stages that look up identifiers from an external API
+    # and store the results in a redis hash
 
-    name = "Look up charity data"
-    ftc_url = FTC_URL
+    cache_key = None
+    negative_ttl = NEGATIVE_CACHE_TTL
+
+    # URL used to look up an identifier, with `{}` for the identifier -
+    # each lookup stage must set this
+    url_template = None
 
-    # utils
-    def _get_charity(self, orgid):
-        if self.cache.hexists("charity", orgid):
-            return json.loads(self.cache.hget("charity", orgid))
-        return requests.get(self.ftc_url.format(orgid)).json()
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.url_template is None:
+            raise TypeError("{} must set url_template".format(cls.__name__))
+
+    def __init__(self, df, cache, job, **kwargs):
+        super().__init__(df, cache, job, **kwargs)
+        self._pipeline = None
+
+    def _get_url(self, lookup_id):
+        return self.url_template.format(lookup_id)
+
+    def _get_missing(self, lookup_ids, refresh=False):
+        # identifiers that aren't in the cache and haven't recently failed
+        # if `refresh` is true then identifiers in the cache are included
+        if not refresh:
+            cached = self._get_cached(self.cache_key, lookup_ids)
+            lookup_ids = [
+                lookup_id
+                for lookup_id in lookup_ids
+                if lookup_id not in cached or not is_current_record(cached[lookup_id])
+            ]
+        else:
+            lookup_ids = list(lookup_ids)
+        failed = []
+        for i in range(0, len(lookup_ids), self.redis_chunk_size):
+            failed.extend(
+                self.cache.mget(
+                    [
+                        self._negative_key(lookup_id)
+                        for lookup_id in lookup_ids[i : i + self.redis_chunk_size]
+                    ]
+                )
+            )
+        missing = [
+            lookup_id for lookup_id, reason in zip(lookup_ids, failed) if reason is None
+        ]
+        self._record_stat("negative_hit", len(lookup_ids) - len(missing))
+        self._record_stat("negative_miss", len(missing))
+        return missing
+
+    def _lookup(self, lookup_ids, refresh=False):
+        # fetch any identifiers not already in the cache, concurrently
+        urls = {
+            lookup_id: self._get_url(lookup_id)
+            for lookup_id in self._get_missing(lookup_ids, refresh)
+        }
+        results = get_lookup_engine().fetch_json(urls)
+        progress_step = max(1, len(urls) // 100)
+        for k, (lookup_id, result, error) in tqdm.tqdm(
+            enumerate(results), total=len(urls)
+        ):
+            if (k + 1) % progress_step == 0 or (k + 1) == len(urls):
+                self._progress_job(k + 1, len(urls))
+            if error is not None:
+                logging.info(
+                    "Could not find {} [{}]: {}".format(
+                        self.cache_key, lookup_id, error
+                    )
+                )
+                self._save_negative(lookup_id, get_error_reason(error))
+            else:
+                self._save_result(lookup_id, result)
+            self._flush_writes()
+        self._flush_writes(force=True)
+
+    def _get_pipeline(self):
+        # new results are written to redis in pipelined batches
+        if self._pipeline is None:
+            self._pipeline = self.cache.pipeline(transaction=False)
+        return self._pipeline
+
+    def _flush_writes(self, force=False):
+        if self._pipeline is None:
+            return
+        if force or len(self._pipeline) >= self.redis_chunk_size:
+            self._pipeline.execute()
+
+    def _save_result(self, lookup_id, result):
+        self._get_pipeline().hset(
+            self.cache_key, lookup_id, encode_record(self.cache_key, result)
+        )
+
+    def _negative_key(self, lookup_id):
+        return "{}{}:{}".format(NEGATIVE_CACHE_PREFIX, self.cache_key, lookup_id)
+
+    def _save_negative(self, lookup_id, reason):
+        # remember lookups that failed for a reason that won't go away soon
+        if reason is None:
+            return
+        ttl = self.negative_ttl
+        if has_app_context():
+            ttl = current_app.config.get("NEGATIVE_CACHE_TTL", ttl)
+        self._get_pipeline().setex(self._negative_key(lookup_id), ttl, reason)
+        self._record_stat("negative_saved")
+
+    def _record_stat(self, stat, count=1):
+        if count:
+            self._get_pipeline().hincrby(
+                LOOKUP_STATS_KEY, "{}:{}".format(self.cache_key, stat), count
+            )
+
+    def _remove_indexed(self, lookup_ids, index):
+        # identifiers found in a local index don't need to be fetched
+        if index is None:
+            return lookup_ids
+        in_index = index.contains(lookup_ids)
+        print("Found {} {} records locally".format(in_index.sum(), self.cache_key))
+        return lookup_ids[~in_index]
 
     def skip_job(self):
         return DATASTORE_IS_USED_COL in self.df.columns
 
+
+class LookupCharityDetails(ExternalLookupStage):
+
+    name = "Look up charity data"
+    url_template = FTC_URL
+    cache_key = "charity"
+
     def run(self):
         orgids = (
             self.df.loc[
@@ -476,43 +773,56 @@ class LookupCharityDetails(DataPreparationStage):
             .dropna()
             .unique()
         )
+        orgids = self._remove_indexed(orgids, self._get_register_index("charity"))
         print("Finding details for {} charities".format(len(orgids)))
-        for k, orgid in tqdm.tqdm(enumerate(orgids)):
-            self._progress_job(k + 1, len(orgids))
-            try:
-                self.cache.hset("charity", orgid, json.dumps(self._get_charity(orgid)))
-            except ValueError:
-                pass
+        self._lookup(orgids)
 
         return self.df
 
 
-class LookupCompanyDetails(DataPreparationStage):
+class LookupCompanyDetails(ExternalLookupStage):
 
     name = "Look up company data"
-    ch_url = CH_URL
+    url_template = CH_URL
+    cache_key = "company"
     company_limit = 100
 
-    def _get_company(self, orgid):
-        if self.cache.hexists("company", orgid):
-            return json.loads(self.cache.hget("company", orgid))
-        return requests.get(self.ch_url.format(orgid.replace("GB-COH-", ""))).json()
+    def _get_url(self, orgid):
+        return super()._get_url(orgid.replace("GB-COH-", ""))
 
-    def _get_orgid_index(self):
-        # find records where the ID has already been found in charity lookup
-        return list(self.cache.hkeys("charity"))
+    def _get_company_orgids(self):
+        company_orgids = (
+            self.df.loc[
+                self.df["Recipient Org:0:Identifier:Scheme"] == "GB-COH",
+                "Recipient Org:0:Identifier:Clean",
+            ]
+            .dropna()
+            .unique()
+        )
+        # skip records where the ID has already been found in charity lookup
+        found_charities = self._get_cached("charity", company_orgids)
+        company_orgids = company_orgids[
+            ~pd.Series(company_orgids, dtype=object).isin(found_charities).values
+        ]
+        company_orgids = self._remove_indexed(
+            company_orgids, self._get_register_index("charity")
+        )
+        company_orgids = self._remove_indexed(
+            company_orgids, self._get_register_index("company")
+        )
+        return company_orgids
 
-    def skip_job(self):
-        return DATASTORE_IS_USED_COL in self.df.columns
+    def _get_company_limit(self):
+        # the limit can be removed by passing `company_limit=None`
+        return self.attributes.get("company_limit", self.company_limit)
 
     def run(self):
 
-        company_orgids = self.df.loc[
-            ~self.df["Recipient Org:0:Identifier:Clean"].isin(self._get_orgid_index())
-            & (self.df["Recipient Org:0:Identifier:Scheme"] == "GB-COH"),
-            "Recipient Org:0:Identifier:Clean",
-        ].unique()
-        if len(company_orgids) > self.company_limit:
+        company_orgids = self._get_company_orgids()
+
+        # the limit only applies to companies that need fetching individually
+        company_limit = self._get_company_limit()
+        if company_limit is not None and len(company_orgids) > company_limit:
             print(
                 "Skipping company data lookup as there are too many companies ({:,.0f})".format(
                     len(company_orgids)
@@ -521,12 +831,7 @@ class LookupCompanyDetails(DataPreparationStage):
             return self.df
 
         print("Finding details for {} companies".format(len(company_orgids)))
-        for k, orgid in tqdm.tqdm(enumerate(company_orgids)):
-            self._progress_job(k + 1, len(company_orgids))
-            try:
-                self.cache.hset("company", orgid, json.dumps(self._get_company(orgid)))
-            except ValueError:
-                pass
+        self._lookup(company_orgids)
 
         return self.df
 
@@ -535,101 +840,48 @@ class MergeCompanyAndCharityDetails(DataPreparationStage):
 
     name = "Add charity and company details to data"
 
-    COMPANY_REPLACE = {
-        "PRI/LBG/NSC (Private, Limited by guarantee, no share capital, use of 'Limited' exemption)": "Company Limited by Guarantee",
-        "PRI/LTD BY GUAR/NSC (Private, limited by guarantee, no share capital)": "Company Limited by Guarantee",
-        "PRIV LTD SECT. 30 (Private limited company, section 30 of the Companies Act)": "Private Limited Company",
-    }  # replacement values for companycategory
+    COMPANY_REPLACE = COMPANY_REPLACE  # replacement values for companycategory
 
     org_prefix = "__org_"
 
-    def _get_org_type(self, id, org_type_primary):
-        if id.startswith("S") or id.startswith("GB-SC-"):
-            return "Registered Charity (Scotland)"
-        elif id.startswith("N") or id.startswith("GB-NIC-"):
-            return "Registered Charity (NI)"
-        elif id.startswith("GB-CHC-"):
-            return "Registered Charity (E&W)"
-        return org_type_primary
+    _get_org_type = staticmethod(get_org_type)
 
-    def _create_orgid_df(self):
+    def _create_records_df(self, source, date_dayfirst=False):
+        # create a dataframe of the cached records for organisations in the data
+        orgids = self.df["Recipient Org:0:Identifier:Clean"].dropna().unique()
+        rows = []
+        for orgid, value in self._get_cached(source, orgids).items():
+            record = decode_record(source, value)
+            if record is not None:
+                rows.append({"orgid": orgid, **record})
 
-        orgids = self.df["Recipient Org:0:Identifier:Clean"].unique()
-        charity_rows = []
-        for k, c in self.cache.hscan_iter("charity"):
-            if k.decode("utf8") in orgids:
-                c = json.loads(c)
-                charity_rows.append(
-                    {
-                        "orgid": k.decode("utf8"),
-                        "charity_number": c.get("charityNumber"),
-                        "company_number": c.get("companyNumber")
-                        if c.get("companyNumber")
-                        else None,
-                        "date_registered": c.get("dateRegistered"),
-                        "date_removed": c.get("dateRemoved"),
-                        "postcode": c.get("address", {}).get("postalCode"),
-                        "latest_income": c.get("latestIncome"),
-                        "org_type": self._get_org_type(
-                            c.get("id"), c.get("organisationTypePrimary")
-                        ),
-                    }
-                )
-
-        if not charity_rows:
+        if not rows:
             return None
 
-        orgid_df = pd.DataFrame(charity_rows).set_index("orgid")
-
-        orgid_df.loc[:, "date_registered"] = pd.to_datetime(
-            orgid_df.loc[:, "date_registered"], utc=True
-        )
-        orgid_df.loc[:, "date_removed"] = pd.to_datetime(
-            orgid_df.loc[:, "date_removed"], utc=True
-        )
+        records_df = pd.DataFrame(rows).set_index("orgid")[ORG_FIELDS]
+        for c in ["date_registered", "date_removed"]:
+            records_df.loc[:, c] = pd.to_datetime(
+                records_df.loc[:, c], dayfirst=date_dayfirst, utc=True
+            )
+        return records_df
 
-        return orgid_df
+    def _create_orgid_df(self):
+        return self._create_records_df("charity")
 
     def _create_company_df(self):
+        return self._create_records_df("company", date_dayfirst=True)
 
-        orgids = self.df["Recipient Org:0:Identifier:Clean"].unique()
-
-        company_rows = []
-        for k, c in self.cache.hscan_iter("company"):
-            if k.decode("utf8") in orgids:
-                c = json.loads(c)
-                company = c.get("primaryTopic", {})
-                company = {} if company is None else company
-                address = c.get("primaryTopic", {}).get("RegAddress", {})
-                address = {} if address is None else address
-                company_rows.append(
-                    {
-                        "orgid": k.decode("utf8"),
-                        "charity_number": None,
-                        "company_number": company.get("CompanyNumber"),
-                        "date_registered": company.get("IncorporationDate"),
-                        "date_removed": company.get("DissolutionDate"),
-                        "postcode": address.get("Postcode"),
-                        "latest_income": None,
-                        "org_type": self.COMPANY_REPLACE.get(
-                            company.get("CompanyCategory"),
-                            company.get("CompanyCategory"),
-                        ),
-                    }
-                )
-
-        if not company_rows:
+    def _create_register_df(self, source):
+        # find organisations in the local register snapshot
+        register_index = self._get_register_index(source)
+        if register_index is None:
             return None
 
-        companies_df = pd.DataFrame(company_rows).set_index("orgid")
-        companies_df.loc[:, "date_registered"] = pd.to_datetime(
-            companies_df.loc[:, "date_registered"], dayfirst=True, utc=True
-        )
-        companies_df.loc[:, "date_removed"] = pd.to_datetime(
-            companies_df.loc[:, "date_removed"], dayfirst=True, utc=True
-        )
-
-        return companies_df
+        orgids = self.df["Recipient Org:0:Identifier:Clean"].dropna().unique()
+        register_df = register_index.lookup(orgids)
+        if register_df.empty:
+            return None
+        return register_df.reindex(columns=ORG_FIELDS)
 
     def skip_job(self):
         return DATASTORE_IS_USED_COL in self.df.columns
@@ -637,31 +889,24 @@ class MergeCompanyAndCharityDetails(DataPreparationStage):
     def run(self):
 
         # create orgid dataframes
-        orgid_df = self._create_orgid_df()
-        companies_df = self._create_company_df()
-
-        if isinstance(orgid_df, pd.DataFrame) and isinstance(
-            companies_df, pd.DataFrame
-        ):
-            orgid_df = pd.concat([orgid_df, companies_df], sort=False)
-        elif isinstance(companies_df, pd.DataFrame):
-            orgid_df = companies_df
-
-        if not isinstance(orgid_df, pd.DataFrame):
-            org_columns = [
-                "orgid",
-                "charity_number",
-                "company_number",
-                "date_registered",
-                "date_removed",
-                "postcode",
-                "latest_income",
-                "org_type",
+        org_dfs = [
+            org_df
+            for org_df in [
+                self._create_orgid_df(),
+                self._create_register_df("charity"),
+                self._create_company_df(),
+                self._create_register_df("company"),
             ]
-            for c in org_columns:
+            if isinstance(org_df, pd.DataFrame)
+        ]
+
+        if not org_dfs:
+            for c in ["orgid"] + ORG_FIELDS:
                 self.df.loc[:, self.org_prefix + c] = None
             return self.df
 
+        orgid_df = pd.concat(org_dfs, sort=False)
+
         # drop any duplicates
         orgid_df = orgid_df[~orgid_df.index.duplicated(keep="first")]
 
@@ -686,19 +931,56 @@ class MergeCompanyAndCharityDetails(DataPreparationStage):
         return self.df
 
 
-class FetchPostcodes(DataPreparationStage):
+class FetchPostcodes(ExternalLookupStage):
 
     name = "Look up postcode data"
-    pc_url = PC_URL
+    # @TODO: postcode cleaning and formatting
+    url_template = PC_URL
+    pc_batch_url = PC_BATCH_URL
+    pc_batch_size = PC_BATCH_SIZE
+    cache_key = "postcode"
+
+    def _get_batch_settings(self):
+        if has_app_context():
+            return (
+                current_app.config.get("PC_BATCH_URL") or self.pc_batch_url,
+                current_app.config.get("PC_BATCH_SIZE", self.pc_batch_size),
+            )
+        return (self.pc_batch_url, self.pc_batch_size)
+
+    def _lookup(self, postcodes, refresh=False):
+        batch_url, batch_size = self._get_batch_settings()
+        if not batch_url:
+            return super()._lookup(postcodes, refresh)
+
+        # send the postcodes to the bulk endpoint in batches
+        postcodes = self._get_missing(postcodes, refresh)
+        batches = {
+            k: {"postcodes": postcodes[i : i + batch_size]}
+            for k, i in enumerate(range(0, len(postcodes), batch_size))
+        }
+        results = get_lookup_engine().post_json(batch_url, batches)
+        for k, (batch_id, result, error) in tqdm.tqdm(
+            enumerate(results), total=len(batches)
+        ):
+            self._progress_job(k + 1, len(batches))
+            if error is not None:
+                logging.info("Could not fetch postcode batch: {}".format(error))
+                continue
 
-    def _get_postcode(self, pc):
-        if self.cache.hexists("postcode", pc):
-            return json.loads(self.cache.hget("postcode", pc))
-        # @TODO: postcode cleaning and formatting
-        return requests.get(self.pc_url.format(pc)).json()
-
-    def skip_job(self):
-        return DATASTORE_IS_USED_COL in self.df.columns
+            # split the results back into individual postcodes
+            found = {
+                normalise_postcode(pc_data.get("id")): pc_data
+                for pc_data in result.get("data", [])
+                if pc_data and pc_data.get("id")
+            }
+            for pc in batches[batch_id]["postcodes"]:
+                if normalise_postcode(pc) in found:
+                    self._save_result(pc, {"data": found[normalise_postcode(pc)]})
+                else:
+                    self._save_negative(pc, "not-found")
+            self._flush_writes()
+        self._flush_writes(force=True)
 
     def run(self):
         # check for recipient org postcode field first
@@ -716,13 +998,10 @@ class FetchPostcodes(DataPreparationStage):
 
         # fetch postcode data
         postcodes = self.df.loc[:, "Recipient Org:0:Postal Code"].dropna().unique()
+
+        postcodes = self._remove_indexed(postcodes, self._get_postcode_index())
         print("Finding details for {} postcodes".format(len(postcodes)))
-        for k, pc in tqdm.tqdm(enumerate(postcodes)):
-            self._progress_job(k + 1, len(postcodes))
-            try:
-                self.cache.hset("postcode", pc, json.dumps(self._get_postcode(pc)))
-            except json.JSONDecodeError:
-                continue
+        self._lookup(postcodes)
 
         return self.df
 
@@ -732,42 +1011,51 @@ class MergeGeoData(DataPreparationStage):
     name = "Add geo data"
     POSTCODE_FIELDS = POSTCODE_FIELDS
 
-    def _convert_geocode(self, areatype, geocode_code):
-        geocode_name = self.cache.hget(
-            "geocodes", "-".join([areatype, str(geocode_code)])
+    def _get_geocode_names(self, areatype, geocode_codes):
+        # map each code to its name, keeping the code if there's no name
+        geocode_names = self._get_cached(
+            "geocodes", ["-".join([areatype, str(code)]) for code in geocode_codes]
         )
-        if not geocode_name:
-            return geocode_code
-        if isinstance(geocode_name, bytes):
-            return geocode_name.decode("utf8")
-        return geocode_name
+        result = {}
+        for code in geocode_codes:
+            geocode_name = geocode_names.get("-".join([areatype, str(code)]))
+            if not geocode_name:
+                result[code] = code
+            elif isinstance(geocode_name, bytes):
+                result[code] = geocode_name.decode("utf8")
+            else:
+                result[code] = geocode_name
+        return result
 
     def _create_postcode_df(self):
-        postcodes = self.df["Recipient Org:0:Postal Code"].unique()
+        postcodes = self.df["Recipient Org:0:Postal Code"].dropna().unique()
+        postcode_frames = []
+
+        # look up postcodes in the local postcode index first
+        postcode_index = self._get_postcode_index()
+        if postcode_index is not None:
+            index_df = postcode_index.lookup(postcodes)
+            postcode_frames.append(index_df.reindex(columns=self.POSTCODE_FIELDS))
+            postcodes = postcodes[~pd.Series(postcodes).isin(index_df.index).values]
+
         postcode_rows = []
-        for k, c in self.cache.hscan_iter("postcode"):
-            c = json.loads(c)
-            if k.decode("utf8") in postcodes:
-                postcode_rows.append(
-                    {
-                        **{"postcode": k.decode("utf8")},
-                        **{
-                            j: c.get("data", {}).get("attributes", {}).get(j)
-                            for j in self.POSTCODE_FIELDS
-                        },
-                    }
-                )
-        postcode_df = pd.DataFrame(postcode_rows).set_index("postcode")[
-            self.POSTCODE_FIELDS
-        ]
+        for pc, value in self._get_cached("postcode", postcodes).items():
+            record = decode_record("postcode", value)
+            if record is not None:
+                postcode_rows.append({"postcode": pc, **record})
+        if postcode_rows:
+            postcode_frames.append(
+                pd.DataFrame(postcode_rows).set_index("postcode")[self.POSTCODE_FIELDS]
+            )
+
+        if not postcode_frames:
+            return pd.DataFrame(columns=self.POSTCODE_FIELDS)
+        postcode_df = pd.concat(postcode_frames)
 
         # swap out names for codes
         for c in postcode_df.columns:
-            postcode_df.loc[:, c] = (
-                postcode_df[c]
-                .apply(lambda x: self._convert_geocode(c, str(x)))
-                .fillna(postcode_df[c])
-            )
+            geocode_names = self._get_geocode_names(c, postcode_df[c].dropna().unique())
+            postcode_df.loc[:, c] = postcode_df[c].map(geocode_names)
             if postcode_df[c].dtype == "object":
                 postcode_df.loc[:, c] = postcode_df[c].str.replace(
                     r"\(pseudo\)", "", regex=True
@@ -853,3 +1141,164 @@ class AddExtraFieldsExternal(DataPreparationStage):
             self.df.loc[:, "Grant Programme:0:Title"] = "All grants"
 
         return self.df
+
+
+class AddDerivedColumns(DataPreparationStage):
+    """
+    Add the columns the dashboard filters and groups grants by, so they
+    don't need to be worked out again each time the file is shown (see
+    `add_derived_columns`).
+
+    `__org_type` is worked out again, as the charity and company data it
+    uses may have changed since the file was last processed.
+    """
+
+    name = "Add derived columns"
+
+    def run(self):
+        self.df = add_derived_columns(
+            self.df.drop(columns=["__org_type"], errors="ignore")
+        )
+        for c in GEO_COLUMNS:
+            if c in self.df.columns:
+                self.df[c] = self.df[c].astype("category")
+        return self.df
+
+
+class CompactDataTypes(DataPreparationStage):
+
+    name = "Compact data types"
+
+    # text columns with few distinct values, which are stored as categories
+    # if they have fewer distinct values than this proportion of rows. Free
+    # text like titles and descriptions is left as objects even if it repeats
+    category_columns = [
+        "Funding Org:0:Name",
+        "Funding Org:0:Identifier",
+        "Grant Programme:0:Title",
+        "Currency",
+        "Recipient Org:0:Identifier:Scheme",
+        "Amount Awarded:Bands",
+        "__org_type",
+        "__org_org_type",
+        "__org_age_bands",
+        "__org_latest_income_bands",
+    ]
+    category_prefixes = ("__geo_",)
+    category_max_ratio = 0.5
+
+    # columns used by the dashboard, which are kept even if they're empty
+    columns_to_keep = CheckColumnNames.columns_to_check + [
+        "Title",
+        "Currency",
+        "Grant Programme:0:Title",
+    ]
+
+    def run(self):
+        memory_before = self.df.memory_usage(deep=True).sum()
+        to_drop = []
+        for c in self.df.columns:
+            values = self.df[c]
+            if values.isnull().all():
+                if not c.startswith("__") and c not in self.columns_to_keep:
+                    to_drop.append(c)
+            elif values.dtype == object and self.is_category_column(c):
+                if pd.api.types.infer_dtype(
+                    values, skipna=True
+                ) == "string" and values.nunique() <= (
+                    len(values) * self.category_max_ratio
+                ):
+                    self.df[c] = values.astype("category")
+            elif pd.api.types.is_integer_dtype(values):
+                self.df[c] = pd.to_numeric(values, downcast="integer")
+        self.df = self.df.drop(columns=to_drop)
+
+        logging.info(
+            "Memory usage reduced from {:,.0f} to {:,.0f} bytes".format(
+                memory_before, self.df.memory_usage(deep=True).sum()
+            )
+        )
+        return self.df
+
+    def is_category_column(self, column):
+        return column in self.category_columns or column.startswith(
+            self.category_prefixes
+        )
+
+
+LOOKUP_STAGES = {
+    "charity": LookupCharityDetails,
+    "company": LookupCompanyDetails,
+    "postcode": FetchPostcodes,
+}
+
+
+def get_stale_lookups(cache, source, max_age):
+    # identifiers in the cache that were fetched more than `max_age` seconds ago
+    fetched_before = time.time() - max_age
+    for k, v in cache.hscan_iter(source, count=1000):
+        fetched_at = get_fetched_at(v)
+        if fetched_at is None or fetched_at < fetched_before:
+            yield k.decode("utf8") if isinstance(k, bytes) else k
+
+
+def refresh_lookups(sources=None, limit=None):
+    """
+    Fetch charity, company and postcode records again once they are older
+    than the maximum age set for their source, then evict the oldest records
+    if there are too many. Can be run as a background job.
+    """
+    cache = get_cache()
+    job = get_current_job()
+    sources = sources or list(LOOKUP_STAGES.keys())
+    max_age = {**LOOKUP_MAX_AGE, **current_app.config.get("LOOKUP_MAX_AGE", {})}
+
+    if job:
+        job.meta["stages"] = ["Refresh {} data".format(s) for s in sources]
+        job.meta["progress"] = {"stage": 0, "progress": None}
+        job.save_meta()
+
+    refreshed = {}
+    for k, source in enumerate(sources):
+        if job:
+            job.meta["progress"]["stage"] = k
+            job.save_meta()
+        stale = list(
+            itertools.islice(get_stale_lookups(cache, source, max_age[source]), limit)
+        )
+        logging.info("Refreshing {:,.0f} {} records".format(len(stale), source))
+        stage = LOOKUP_STAGES[source](None, cache, job)
+        stage._lookup(stale, refresh=True)
+        refreshed[source] = len(stale)
+
+    return {"refreshed": refreshed, "evicted": evict_lookups(cache)}
+
+
+def evict_lookups(cache=None, max_entries=None):
+    """
+    Remove the records fetched longest ago from each of the lookup hashes,
+    so each holds no more than `max_entries` records.
+    """
+    if cache is None:
+        cache = get_cache()
+    if max_entries is None:
+        max_entries = current_app.config.get("LOOKUP_MAX_ENTRIES", LOOKUP_MAX_ENTRIES)
+
+    evicted = {}
+    for source in RECORD_FIELDS:
+        to_evict = cache.hlen(source) - max_entries
+        evicted[source] = max(to_evict, 0)
+        if to_evict <= 0:
+            continue
+        oldest = heapq.nsmallest(
+            to_evict,
+            (
+                (get_fetched_at(v) or 0, k)
+                for k, v in cache.hscan_iter(source, count=1000)
+            ),
+        )
+        keys = [k for fetched_at, k in oldest]
+        for i in range(0, len(keys), 1000):
+            cache.hdel(source, *keys[i : i + 1000])
+        logging.info("Evicted {:,.0f} {} records".format(len(keys), source))
+    return evicted
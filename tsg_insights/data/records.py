@@ -0,0 +1,192 @@
+import json
+import time
+
+import msgpack
+
+# version of the record format - increase this if the fields change
+RECORD_VERSION = 2
+
+# fields held for each organisation from the charity and company data
+ORG_FIELDS = [
+    "charity_number",
+    "company_number",
+    "date_registered",
+    "date_removed",
+    "postcode",
+    "latest_income",
+    "org_type",
+]
+POSTCODE_FIELDS = [
+    "ctry",
+    "cty",
+    "laua",
+    "pcon",
+    "rgn",
+    "imd",
+    "ru11ind",
+    "oac11",
+    "lat",
+    "long",
+]  # fields to care about from the postcodes)
+RECORD_FIELDS = {
+    "charity": ORG_FIELDS,
+    "company": ORG_FIELDS,
+    "postcode": POSTCODE_FIELDS,
+}
+
+COMPANY_REPLACE = {
+    "PRI/LBG/NSC (Private, Limited by guarantee, no share capital, use of 'Limited' exemption)": "Company Limited by Guarantee",
+    "PRI/LTD BY GUAR/NSC (Private, limited by guarantee, no share capital)": "Company Limited by Guarantee",
+    "PRIV LTD SECT. 30 (Private limited company, section 30 of the Companies Act)": "Private Limited Company",
+}  # replacement values for companycategory
+
+
+def get_org_type(id, org_type_primary):
+    if id.startswith("S") or id.startswith("GB-SC-"):
+        return "Registered Charity (Scotland)"
+    elif id.startswith("N") or id.startswith("GB-NIC-"):
+        return "Registered Charity (NI)"
+    elif id.startswith("GB-CHC-"):
+        return "Registered Charity (E&W)"
+    return org_type_primary
+
+
+def extract_charity(c):
+    # fields from a findthatcharity API response
+    return {
+        "charity_number": c.get("charityNumber"),
+        "company_number": c.get("companyNumber") if c.get("companyNumber") else None,
+        "date_registered": c.get("dateRegistered"),
+        "date_removed": c.get("dateRemoved"),
+        "postcode": (c.get("address") or {}).get("postalCode"),
+        "latest_income": c.get("latestIncome"),
+        "org_type": get_org_type(c.get("id") or "", c.get("organisationTypePrimary")),
+    }
+
+
+def extract_company(c):
+    # fields from a Companies House API response
+    company = c.get("primaryTopic", {})
+    company = {} if company is None else company
+    address = company.get("RegAddress", {})
+    address = {} if address is None else address
+    return {
+        "charity_number": None,
+        "company_number": company.get("CompanyNumber"),
+        "date_registered": company.get("IncorporationDate"),
+        "date_removed": company.get("DissolutionDate"),
+        "postcode": address.get("Postcode"),
+        "latest_income": None,
+        "org_type": COMPANY_REPLACE.get(
+            company.get("CompanyCategory"), company.get("CompanyCategory")
+        ),
+    }
+
+
+def extract_postcode(c):
+    # fields from a findthatpostcode API response
+    attributes = (c.get("data") or {}).get("attributes") or {}
+    return {j: attributes.get(j) for j in POSTCODE_FIELDS}
+
+
+EXTRACTORS = {
+    "charity": extract_charity,
+    "company": extract_company,
+    "postcode": extract_postcode,
+}
+
+
+def encode_record(source, result, fetched_at=None):
+    """
+    Create a compact record from an API response, holding only the fields
+    that are used from that source.
+
+    Records are a msgpack array of the record version, the time the record
+    was fetched (as a unix timestamp) and then the value of each field in
+    `RECORD_FIELDS[source]`.
+    """
+    if fetched_at is None:
+        fetched_at = int(time.time())
+    record = EXTRACTORS[source](result)
+    return _pack_record(fetched_at, [record.get(f) for f in RECORD_FIELDS[source]])
+
+
+def _pack_record(fetched_at, values):
+    return msgpack.packb([RECORD_VERSION, fetched_at] + values, use_bin_type=True)
+
+
+def _unpack_record(value):
+    # returns the record version, the time it was fetched and the field values
+    try:
+        record = msgpack.unpackb(value, raw=False)
+    except (ValueError, TypeError, msgpack.UnpackException):
+        return None
+    if not isinstance(record, list) or not record:
+        # another value stored in the same hash, or a corrupt entry
+        return None
+    if record[0] == RECORD_VERSION and len(record) > 1:
+        return record[0], record[1], record[2:]
+    if record[0] == 1:
+        # version 1 records didn't include when they were fetched
+        return record[0], 0, record[1:]
+    return None
+
+
+def is_legacy_record(value):
+    # records saved before compact records were introduced hold the raw JSON
+    return value[:1] in (b"{", "{")
+
+
+def is_current_record(value):
+    # whether a record in the cache can be used without fetching it again
+    return is_legacy_record(value) or _unpack_record(value) is not None
+
+
+def get_fetched_at(value):
+    """
+    Get the unix timestamp of when a record was fetched. Records where this
+    isn't known return 0, and records that can't be read return `None`.
+    """
+    if is_legacy_record(value):
+        return 0
+    record = _unpack_record(value)
+    if record is None:
+        return None
+    return record[1]
+
+
+def decode_record(source, value):
+    """
+    Get a dictionary of fields from a record in the cache.
+
+    Returns `None` if the record is from an older version or can't be
+    read, so the record should be fetched again.
+    """
+    if is_legacy_record(value):
+        value = migrate_record(source, value)
+        if value is None:
+            return None
+    record = _unpack_record(value)
+    if record is None:
+        return None
+    return dict(zip(RECORD_FIELDS[source], record[2]))
+
+
+def migrate_record(source, value):
+    """
+    Convert a record to the current format.
+
+    Returns the new value, or `None` if the record can't be converted.
+    """
+    if is_legacy_record(value):
+        try:
+            return encode_record(source, json.loads(value), fetched_at=0)
+        except (ValueError, TypeError, AttributeError):
+            return None
+    record = _unpack_record(value)
+    if record is None:
+        return None
+    version, fetched_at, values = record
+    if version == RECORD_VERSION:
+        return value
+    return _pack_record(fetched_at, values)
@@ -1,13 +1,47 @@
+import base64
 import hashlib
+import os
 
 import babel.numbers
 import humanize
 import inflect
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 from flask.json import JSONEncoder
 from requests.structures import CaseInsensitiveDict
 
+IDENTIFIER_MAP = {
+    "360G": "Identifier not recognised",  # 360G          41190
+    "GB-CHC": "Registered Charity (E&W)",  # GB-CHC        42190
+    "GB-SC": "Registered Charity (Scotland)",  # GB-SC          7134
+    "GB-NIC": "Registered Charity (NI)",  # GB-NIC          718
+    "GB-COH": "Registered Company",  # GB-COH        11698
+    "GB-GOR": "Government",  # GB-GOR           13
+    "GB-MPR": "Mutual",  # GB-MPR           32
+    "GB-NHS": "NHS",  # GB-NHS           14
+    "GB-UKPRN": "School/University/Education",  # GB-UKPRN         48
+    "GB-EDU": "School/University/Education",  # GB-EDU          255
+    "GB-SHPE": "Social Housing Provider",
+    "GB-LAE": "Local Authority",  # GB-LAE           39
+    "GB-LAS": "Local Authority",  # GB-LAS            2
+    "GB-REV": "Registered Charity (HMRC)",  # GB-REV           92
+    "US-EIN": "US - registered with IRS",  # US-EIN           38
+    "ZA-NPO": "South Africa - registered with Nonprofit Organisation Directorate",  # ZA-NPO           12
+    "IM-GR": "Registered Charity (Isle of Man)",  # IM-GR             8
+    # NL-KVK            3
+    # GG-RCE            3
+    # XM-DAC            2
+    # IL-ROC            2
+    # BE-BCE_KBO        2
+    # CA-CRA_ACR        2
+    # ZA-PBO            2
+    # SE-BLV            1
+    # CH-FDJP           1
+    # JE-FSC            1
+}
+
 
 def list_to_string(l, oxford_comma="auto", separator=", ", as_list=False):
     if len(l) == 1:
@@ -95,6 +129,43 @@ def get_fileid(contents, filename, date=None):
     return hash_obj.hexdigest()
 
 
+def decode_contents(contents):
+    # file contents given as a string are a base64 encoded data URL
+    if isinstance(contents, str):
+        content_type, content_string = contents.split(",")
+        return base64.b64decode(content_string)
+    return contents
+
+
+def get_content_fileid(contents, filename=None, date=None, chunk_size=1024 * 1024):
+    """
+    ID for an uploaded file, from a hash of its contents and the file
+    extension (which decides how the file is read), so the same file
+    uploaded under a different name gets the same ID.
+
+    `contents` can be bytes, a base64 encoded data URL or a file object,
+    which is read in chunks.
+    """
+    contents = decode_contents(contents)
+    hash_obj = hashlib.blake2b(digest_size=16)
+    if isinstance(contents, (bytes, bytearray)):
+        hash_obj.update(contents)
+    else:
+        for chunk in iter(lambda: contents.read(chunk_size), b""):
+            hash_obj.update(chunk)
+    hash_obj.update(os.path.splitext(filename or "")[1].lower().encode())
+    if date is not None:
+        hash_obj.update(str(date).encode())
+    return hash_obj.hexdigest()
+
+
+def normalise_postcode(pc):
+    # remove whitespace and uppercase a postcode so it can be compared
+    if not isinstance(pc, str):
+        return None
+    return "".join(pc.split()).upper()
+
+
 def charity_number_to_org_id(regno):
     if not isinstance(regno, str):
         return None
@@ -106,6 +177,142 @@ def charity_number_to_org_id(regno):
         return "GB-CHC-{}".format(regno)
 
 
+def _dictionary_encode(values):
+    # the distinct values of a series (as an arrow array), and the position
+    # of each value in them (or -1 if it's missing)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = np.asarray(values.cat.categories, dtype=object)
+        return (
+            pa.array(categories, type=pa.string(), from_pandas=True),
+            values.cat.codes.to_numpy(),
+        )
+    encoded = pc.dictionary_encode(
+        pa.array(np.asarray(values, dtype=object), type=pa.string(), from_pandas=True)
+    )
+    return encoded.dictionary, pc.fill_null(encoded.indices, -1).to_numpy()
+
+
+def _to_categorical(values, codes, sort=False):
+    # a categorical of `values[codes]`, where `values` is an arrow array
+    # which can contain the same value more than once
+    encoded = pc.dictionary_encode(values)
+    value_codes = np.append(pc.fill_null(encoded.indices, -1).to_numpy(), -1)
+    result = pd.Categorical.from_codes(
+        value_codes[codes], encoded.dictionary.to_pandas()
+    )
+    if sort:
+        result = result.reorder_categories(sorted(result.categories))
+    return result
+
+
+def parse_identifiers(identifiers):
+    """
+    Split a series of organisation identifiers into their scheme (the first
+    two parts, eg `GB-CHC`) and the identifier within that scheme, which
+    is missing if there are fewer than three parts. Identifiers starting
+    with `360G-` have the scheme `360G`. Whitespace around the identifier
+    is removed.
+
+    Returns a dataframe with `scheme` and `id` columns as categories. Each
+    distinct identifier is only parsed once, using arrow's string functions.
+    """
+    uniques, codes = _dictionary_encode(identifiers)
+    uniques = pc.utf8_trim_whitespace(uniques)
+
+    # split into (up to) three parts, and pick out each part
+    parts = pc.split_pattern(uniques, pattern="-", max_splits=2)
+    lengths = pc.list_value_length(parts).to_numpy()
+    values = parts.flatten()
+    starts = parts.offsets.to_numpy()[:-1]
+
+    def get_part(i):
+        return pc.take(values, pa.array(np.minimum(starts + i, len(values) - 1)))
+
+    scheme = pc.if_else(
+        pa.array(lengths >= 2),
+        pc.binary_join_element_wise(get_part(0), get_part(1), "-"),
+        get_part(0),
+    )
+    ids = pc.if_else(pa.array(lengths == 3), get_part(2), pa.scalar(None, pa.string()))
+
+    is_360g = pc.starts_with(pc.ascii_upper(uniques), pattern="360G-")
+    scheme = pc.if_else(is_360g, pa.scalar("360G"), scheme)
+    ids = pc.if_else(is_360g, pc.utf8_slice_codeunits(uniques, 5), ids)
+
+    return pd.DataFrame(
+        {
+            "scheme": _to_categorical(scheme, codes, sort=True),
+            "id": _to_categorical(ids, codes),
+        },
+        index=identifiers.index,
+    )
+
+
+def get_identifier_schemes(df):
+    """
+    Get the type of each recipient organisation, from the charity and
+    company data if it's available, or otherwise from the scheme of its
+    identifier. Identifiers with fewer than three parts aren't recognised.
+    """
+    identifiers = parse_identifiers(df["Recipient Org:0:Identifier"])
+    schemes = identifiers["scheme"].cat.categories.tolist() + ["360G"]
+    codes = identifiers["scheme"].cat.codes.to_numpy().copy()
+    codes[identifiers["id"].isnull().to_numpy()] = len(schemes) - 1
+    names = np.array([IDENTIFIER_MAP.get(x, x) for x in schemes], dtype=object)
+    identifier_schemes = names[codes]
+
+    if "__org_org_type" in df:
+        org_codes, org_types = pd.factorize(df["__org_org_type"])
+        org_names = np.array(
+            [IDENTIFIER_MAP.get(x, x) for x in org_types], dtype=object
+        )
+        has_org_type = org_codes >= 0
+        identifier_schemes[has_org_type] = org_names[org_codes[has_org_type]]
+
+    return pd.Series(identifier_schemes, index=df.index)
+
+
+# columns added by `add_derived_columns`, and the columns they're worked out from
+DERIVED_COLUMNS = {
+    "__org_type": ["Recipient Org:0:Identifier", "__org_org_type"],
+}
+
+# country and region values that are treated as missing
+GEO_COLUMNS = ["__geo_ctry", "__geo_rgn"]
+GEO_MISSING = ["None", "Unknown"]
+
+
+def add_derived_columns(df):
+    """
+    Add the columns the dashboard filters and groups grants by, if they
+    aren't already in the dataframe.
+
+    `__org_type` is the type of the recipient organisation (from
+    `get_identifier_schemes`). Country and region values of "None" or
+    "Unknown" are treated as missing.
+
+    These are added when a file is processed, but files saved by older
+    versions don't include them, so they're also added when those files
+    are loaded.
+    """
+    if "__org_type" not in df.columns and "Recipient Org:0:Identifier" in df.columns:
+        df["__org_type"] = get_identifier_schemes(df).astype("category")
+
+    for c in GEO_COLUMNS:
+        if c not in df.columns:
+            continue
+        values = df[c]
+        if values.dtype.name == "category":
+            has_missing = values.cat.categories.isin(GEO_MISSING).any()
+        else:
+            has_missing = values.isin(GEO_MISSING).any()
+        if has_missing:
+            values = values.astype(object)
+            df[c] = values.where(~values.isin(GEO_MISSING)).astype("category")
+
+    return df
+
+
 class CustomJSONEncoder(JSONEncoder):
     def default(self, obj):
         # handling numpy numbers:
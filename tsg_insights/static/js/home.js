@@ -227,6 +227,11 @@ const sendFile = function (file) {
             return response.json();
         })
         .then(function (jobJson) {
+            // the file has already been processed
+            if (jobJson['fileid']) {
+                window.location.href = `/file/${jobJson['fileid']}`;
+                return;
+            }
             const jobid = jobJson['job'];
             track_job(jobid);
         });
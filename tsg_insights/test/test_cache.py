@@ -0,0 +1,538 @@
+import datetime
+import os
+import pickle
+from unittest import mock
+
+import pandas as pd
+import pytest
+from redis import Redis
+from rq import Queue
+from rq.registry import ScheduledJobRegistry
+
+from tsg_insights import create_app
+from tsg_insights.data.cache import (
+    CACHE_SWEEP_JOB_ID,
+    CACHE_SWEEP_LOCK_KEY,
+    CUBE_CELL_COLUMN,
+    FILES_ACCESSED_KEY,
+    RESULTS_ACCESSED_KEY,
+    RESULTS_STATS_KEY,
+    _dataframes,
+    delete_from_cache,
+    delete_from_redis,
+    get_cache,
+    get_chunk_key,
+    get_cube_from_cache,
+    get_cube_key,
+    get_dataframe_checksum,
+    get_file_size,
+    get_filename,
+    get_from_cache,
+    get_from_redis,
+    get_metadata_from_cache,
+    get_redis_manifest,
+    get_results_from_cache,
+    get_results_key,
+    load_dataframe,
+    repack_file,
+    repack_files,
+    save_results_to_cache,
+    save_to_cache,
+    save_to_redis,
+    schedule_cache_sweep,
+    sweep_cache,
+    sweep_cache_job,
+    write_dataframe,
+)
+
+
+@pytest.fixture
+def test_app(tmp_path):
+    return create_app({"REQUESTS_CACHE_ON": False, "UPLOADS_FOLDER": str(tmp_path)})
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame(
+        {
+            "Amount Awarded": [100.0, 250.5, 1000.0],
+            "Award Date": pd.to_datetime(
+                ["2019-01-01", "2019-06-30", "2020-02-14"], utc=True
+            ),
+            "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B"],
+            "Recipient Org:0:Charity Number": [225922, "SC003558", None],
+            "Amount Awarded:Bands": pd.Categorical(
+                ["Under £500", "Under £500", "£500 - £1k"]
+            ),
+        }
+    )
+
+
+@pytest.mark.parametrize("cache_type", ["filesystem", "redis", "parquet", "arrow"])
+def test_save_to_cache(test_app, df, cache_type):
+    with test_app.app_context():
+        save_to_cache("test-cache", df, cache_type=cache_type)
+
+        result = get_from_cache("test-cache", cache_type=cache_type)
+        assert result.columns.tolist() == df.columns.tolist()
+        assert result["Award Date"].dt.tz is not None
+        assert result["Amount Awarded"].sum() == df["Amount Awarded"].sum()
+        assert result["Recipient Org:0:Charity Number"].iloc[1] == "SC003558"
+
+        # columns that aren't in the file are ignored
+        result = get_from_cache(
+            "test-cache",
+            cache_type=cache_type,
+            columns=["Award Date", "Amount Awarded", "Not a column"],
+        )
+        assert result.columns.tolist() == ["Amount Awarded", "Award Date"]
+        assert len(result) == 3
+
+        delete_from_cache("test-cache", cache_type=cache_type)
+        assert get_from_cache("test-cache", cache_type=cache_type) is None
+
+
+def test_filename(test_app):
+    with test_app.app_context():
+        assert get_filename("abc").endswith("abc.pkl")
+        assert get_filename("abc", "parquet").endswith("abc.parquet")
+        assert get_filename("abc", "arrow").endswith("abc.arrow")
+
+
+def test_arrow_memory_mapped(test_app, df):
+    with test_app.app_context():
+        df.index = pd.Index(["360G-a", "360G-b", "360G-c"], name="Identifier")
+        save_to_cache("test-cache", df, cache_type="arrow")
+
+        # numeric columns are read straight from the mapped file
+        result = get_from_cache("test-cache", cache_type="arrow")
+        assert not result["Amount Awarded"].to_numpy().flags.writeable
+        assert result.index.tolist() == ["360G-a", "360G-b", "360G-c"]
+
+        # the index is kept when only some columns are loaded
+        result = get_from_cache(
+            "test-cache", cache_type="arrow", columns=["Amount Awarded"]
+        )
+        assert result.columns.tolist() == ["Amount Awarded"]
+        assert result.index.name == "Identifier"
+
+        # saving again replaces the file without changing the mapped copy
+        save_to_cache("test-cache", df.iloc[:1], cache_type="arrow")
+        assert result["Amount Awarded"].sum() == df["Amount Awarded"].sum()
+        assert len(get_from_cache("test-cache", cache_type="arrow")) == 1
+
+        delete_from_cache("test-cache", cache_type="arrow")
+
+
+@pytest.mark.parametrize("cache_type", ["filesystem", "redis", "parquet"])
+def test_memory_cache(test_app, df, cache_type):
+    with test_app.app_context():
+        save_to_cache("test-cache", df, cache_type=cache_type)
+        get_from_cache("test-cache", cache_type=cache_type)
+
+        # the second load comes from memory, even if the file has gone
+        load_dataframe = "tsg_insights.data.cache.load_dataframe"
+        with mock.patch(load_dataframe) as load:
+            result = get_from_cache("test-cache", cache_type=cache_type)
+            result_columns = get_from_cache(
+                "test-cache", cache_type=cache_type, columns=["Amount Awarded"]
+            )
+            assert not load.called
+        assert result_columns.columns.tolist() == ["Amount Awarded"]
+
+        # replacing or removing columns in the result doesn't change the cache
+        result["Amount Awarded"] = 0
+        del result["Funding Org:0:Name"]
+        result_columns["Amount Awarded"] = 0
+        result = get_from_cache("test-cache", cache_type=cache_type)
+        assert result["Amount Awarded"].sum() == df["Amount Awarded"].sum()
+        assert "Funding Org:0:Name" in result.columns
+
+        # saving the file again replaces the cached copy
+        save_to_cache("test-cache", df.iloc[:1], cache_type=cache_type)
+        assert len(get_from_cache("test-cache", cache_type=cache_type)) == 1
+
+        # removing the file (eg from another process) isn't served from memory
+        get_cache().hdel("files", "test-cache")
+        assert get_from_cache("test-cache", cache_type=cache_type) is None
+        delete_from_cache("test-cache", cache_type=cache_type)
+
+
+def test_memory_cache_columns(test_app, df):
+    with test_app.app_context():
+        save_to_cache("test-cache", df, cache_type="parquet")
+
+        # a subset of columns is read from the file, and not kept in memory
+        with mock.patch(
+            "tsg_insights.data.cache.load_dataframe", wraps=load_dataframe
+        ) as load:
+            result = get_from_cache(
+                "test-cache", cache_type="parquet", columns=["Amount Awarded"]
+            )
+            load.assert_called_once_with("test-cache", "parquet", ["Amount Awarded"])
+        assert result.columns.tolist() == ["Amount Awarded"]
+        assert ("test-cache", "parquet") not in _dataframes
+
+        # once the whole file is in memory it's used for subsets of columns
+        get_from_cache("test-cache", cache_type="parquet")
+        with mock.patch("tsg_insights.data.cache.load_dataframe") as load:
+            result = get_from_cache(
+                "test-cache", cache_type="parquet", columns=["Amount Awarded"]
+            )
+            assert not load.called
+        assert result.columns.tolist() == ["Amount Awarded"]
+        delete_from_cache("test-cache", cache_type="parquet")
+
+
+def test_memory_cache_size(test_app, df):
+    size = df.memory_usage(index=True, deep=True).sum()
+    test_app.config["DATAFRAME_CACHE_SIZE"] = size * 2
+    with test_app.app_context():
+        for fileid in ["test-cache-1", "test-cache-2", "test-cache-3"]:
+            save_to_cache(fileid, df)
+            get_from_cache(fileid)
+        assert list(_dataframes.keys()) == [
+            ("test-cache-2", "filesystem"),
+            ("test-cache-3", "filesystem"),
+        ]
+
+        # using a file moves it to the end of the queue
+        get_from_cache("test-cache-2")
+        save_to_cache("test-cache-1", df)
+        get_from_cache("test-cache-1")
+        assert list(_dataframes.keys()) == [
+            ("test-cache-2", "filesystem"),
+            ("test-cache-1", "filesystem"),
+        ]
+
+        for fileid in ["test-cache-1", "test-cache-2", "test-cache-3"]:
+            delete_from_cache(fileid)
+        assert not _dataframes
+
+
+@pytest.mark.parametrize("compression", ["lz4", "zstd", "none"])
+def test_save_to_redis(test_app, compression):
+    data = b"grant data " * 1000
+    with test_app.app_context():
+        r = get_cache()
+        manifest = save_to_redis(
+            r, "test-chunks", data, compression=compression, chunk_size=1000
+        )
+        assert manifest["raw_size"] == len(data)
+        if compression != "none":
+            assert manifest["size"] < len(data)
+        assert r.exists(get_chunk_key("test-chunks", manifest["chunks"] - 1))
+        assert get_from_redis(r, "test-chunks") == data
+
+        # chunks that are no longer needed are removed
+        save_to_redis(r, "test-chunks", b"grant", compression=compression)
+        assert get_from_redis(r, "test-chunks") == b"grant"
+        assert not r.exists(get_chunk_key("test-chunks", 1))
+
+        delete_from_redis(r, "test-chunks")
+        assert not r.exists("test-chunks")
+        assert not r.exists(get_chunk_key("test-chunks", 0))
+
+
+def test_redis_legacy_pickle(test_app, df):
+    # files saved to redis before they were compressed are still loaded
+    with test_app.app_context():
+        save_to_cache("test-cache", df, cache_type="redis")
+        legacy = pickle.dumps(df.iloc[:2])
+        get_cache().set("file_test-cache", legacy)
+
+        # the size is found without fetching the whole pickle
+        with mock.patch.object(Redis, "get") as get:
+            assert get_redis_manifest(get_cache(), "file_test-cache") is None
+            assert get_file_size("test-cache", cache_type="redis") == len(legacy)
+            assert not get.called
+
+        assert len(get_from_cache("test-cache", cache_type="redis")) == 2
+        delete_from_cache("test-cache", cache_type="redis")
+
+
+@pytest.mark.parametrize("cache_type", ["filesystem", "redis"])
+def test_cube(test_app, df, cache_type):
+    test_app.config["FILE_CACHE"] = cache_type
+    with test_app.app_context():
+        r = get_cache()
+        save_to_cache("test-cache", df)
+        assert r.exists(get_cube_key("test-cache"))
+
+        cube = get_cube_from_cache("test-cache")
+        assert len(cube) == 3
+        assert cube.etag == get_metadata_from_cache("test-cache")["etag"]
+        assert cube.value_counts("Funding Org:0:Name").to_dict() == {
+            "Funder A": 2,
+            "Funder B": 1,
+        }
+
+        # the cell of each row is saved with the data rather than in the cube
+        assert cube.indexed
+        assert CUBE_CELL_COLUMN not in get_from_cache("test-cache").columns
+        cells = get_from_cache("test-cache", columns=[], cube_cells=True)
+        assert cells.columns.tolist() == [CUBE_CELL_COLUMN]
+        assert len(cells) == 3
+
+        # a missing cube (eg for a file saved by an older version) is built again
+        delete_from_redis(r, get_cube_key("test-cache"))
+        _dataframes.clear()
+        assert len(get_cube_from_cache("test-cache")) == 3
+        assert get_cube_from_cache("test-cache").indexed
+        assert r.exists(get_cube_key("test-cache"))
+
+        # the saved cells aren't used if they don't match the new cube
+        stale_cells = cells[CUBE_CELL_COLUMN].to_numpy() + 1
+        write_dataframe("test-cache", df.assign(**{CUBE_CELL_COLUMN: stale_cells}))
+        delete_from_redis(r, get_cube_key("test-cache"))
+        _dataframes.clear()
+        assert not get_cube_from_cache("test-cache").indexed
+
+        # saving the file again replaces the cube
+        save_to_cache("test-cache", df.iloc[:1])
+        assert len(get_cube_from_cache("test-cache")) == 1
+
+        delete_from_cache("test-cache")
+        assert not r.exists(get_cube_key("test-cache"))
+        assert get_cube_from_cache("test-cache") is None
+
+
+@pytest.mark.parametrize(
+    "from_type,to_type",
+    [
+        ("filesystem", "redis"),
+        ("redis", "filesystem"),
+        ("filesystem", "parquet"),
+        ("parquet", "arrow"),
+        ("arrow", "filesystem"),
+    ],
+)
+def test_repack_file(test_app, df, from_type, to_type):
+    with test_app.app_context():
+        save_to_cache("test-repack", df, cache_type=from_type)
+        metadata = get_metadata_from_cache("test-repack")
+
+        result = repack_file("test-repack", from_type, to_type)
+        assert result["rows"] == 3
+        assert result["checksum"] == get_dataframe_checksum(
+            load_dataframe("test-repack", from_type)
+        )
+        assert get_metadata_from_cache("test-repack") == metadata
+        assert len(get_from_cache("test-repack", cache_type=to_type)) == 3
+
+        # the checksum changes if the values change
+        changed = df.copy()
+        changed.loc[0, "Amount Awarded"] = 101
+        assert get_dataframe_checksum(changed) != result["checksum"]
+
+        delete_from_cache("test-repack", cache_type=from_type)
+        delete_from_cache("test-repack", cache_type=to_type)
+        with pytest.raises(ValueError):
+            repack_file("test-repack", from_type, to_type)
+
+
+def test_repack_files(test_app, df):
+    runner = test_app.test_cli_runner()
+    with test_app.app_context():
+        r = get_cache()
+        r.delete("files", "repack:filesystem:parquet")
+        for fileid in ["test-repack-1", "test-repack-2"]:
+            save_to_cache(fileid, df, cache_type="filesystem")
+
+        result = runner.invoke(
+            args=["data", "repack", "--from", "filesystem", "--to", "parquet"]
+            + ["--workers", "1"]
+        )
+        assert result.exit_code == 0, result.output
+        assert "Repacked 2 files (6 rows" in result.output
+        assert os.path.exists(get_filename("test-repack-1", "parquet"))
+
+        # files that have already been repacked are skipped, unless they change
+        save_to_cache("test-repack-2", df.iloc[:1], cache_type="filesystem")
+        results = list(repack_files("filesystem", "parquet", workers=1))
+        assert [(x["fileid"], x["rows"]) for x in results] == [("test-repack-2", 1)]
+        assert len(list(repack_files("filesystem", "parquet", workers=1))) == 0
+        assert len(list(repack_files("filesystem", "parquet", 1, restart=True))) == 2
+
+        # files that can't be repacked are reported
+        os.remove(get_filename("test-repack-1"))
+        result = runner.invoke(
+            args=["data", "repack", "--from", "filesystem", "--to", "parquet"]
+            + ["--workers", "1", "--restart"]
+        )
+        assert result.exit_code == 1
+        assert "1 files could not be repacked" in result.output
+
+        for fileid in ["test-repack-1", "test-repack-2"]:
+            delete_from_cache(fileid, cache_type="parquet")
+            delete_from_cache(fileid, cache_type="filesystem")
+        r.delete("repack:filesystem:parquet")
+
+
+def test_sweep_cache(test_app, df):
+    with test_app.app_context():
+        r = get_cache()
+        r.delete("files", FILES_ACCESSED_KEY)
+        for fileid in ["test-sweep-1", "test-sweep-2", "test-sweep-3"]:
+            save_to_cache(fileid, df)
+        save_to_cache(
+            "test-sweep-expired",
+            df,
+            metadata={"expires": datetime.datetime(2020, 1, 1).isoformat()},
+        )
+        # files are evicted in the order they were last loaded
+        r.hset(FILES_ACCESSED_KEY, "test-sweep-1", 300)
+        r.hset(FILES_ACCESSED_KEY, "test-sweep-2", 100)
+        r.hset(FILES_ACCESSED_KEY, "test-sweep-3", 200)
+
+        # a file left behind when its metadata was removed
+        orphan = get_filename("test-sweep-orphan")
+        with open(orphan, "wb") as orphan_file:
+            pickle.dump(df, orphan_file)
+        os.utime(orphan, (0, 0))
+
+        size = get_file_size("test-sweep-1")
+        result = sweep_cache(max_size=size * 2)
+        assert result == {
+            "expired": 1,
+            "evicted": 1,
+            "orphaned": 1,
+            "size": size * 2,
+        }
+        assert sorted(k.decode("utf8") for k in r.hkeys("files")) == [
+            "test-sweep-1",
+            "test-sweep-3",
+        ]
+        assert not os.path.exists(get_filename("test-sweep-2"))
+        assert not os.path.exists(orphan)
+        assert not r.hexists(FILES_ACCESSED_KEY, "test-sweep-2")
+
+        # loading a file records when it was used
+        get_from_cache("test-sweep-3")
+        assert int(r.hget(FILES_ACCESSED_KEY, "test-sweep-3")) > 200
+
+        for fileid in ["test-sweep-1", "test-sweep-3"]:
+            delete_from_cache(fileid)
+
+
+def test_schedule_cache_sweep(test_app):
+    with test_app.app_context():
+        get_cache().delete(CACHE_SWEEP_LOCK_KEY)
+        job = schedule_cache_sweep(interval=60)
+        assert job.origin == "low"
+        assert job.id.startswith(CACHE_SWEEP_JOB_ID)
+
+        # only one sweep is scheduled at a time
+        assert schedule_cache_sweep(interval=60) is None
+        assert schedule_cache_sweep(interval=0) is None
+
+        # even if the check of the scheduled jobs doesn't find it yet
+        with mock.patch.object(ScheduledJobRegistry, "get_job_ids", return_value=[]):
+            assert schedule_cache_sweep(interval=60) is None
+
+        # the sweep schedules the next one when it runs
+        queue = Queue("low", connection=get_cache())
+        ScheduledJobRegistry(queue=queue).remove(job, delete_job=True)
+        with mock.patch("tsg_insights.data.cache.sweep_cache"):
+            sweep_cache_job(interval=60)
+        job_ids = ScheduledJobRegistry(queue=queue).get_job_ids()
+        assert len(job_ids) == 1
+        ScheduledJobRegistry(queue=queue).remove(job_ids[0], delete_job=True)
+        get_cache().delete(CACHE_SWEEP_LOCK_KEY)
+
+
+def test_sweep_missing_uploads_folder(tmp_path):
+    app = create_app({"REQUESTS_CACHE_ON": False, "UPLOADS_FOLDER": str(tmp_path)})
+    app.config["UPLOADS_FOLDER"] = str(tmp_path / "missing")
+    with app.app_context():
+        assert sweep_cache()["orphaned"] == 0
+
+
+def test_results_cache(tmp_path):
+    app = create_app(
+        {
+            "REQUESTS_CACHE_ON": False,
+            "UPLOADS_FOLDER": str(tmp_path),
+            "RESULTS_CACHE_MAX_ENTRIES": 2,
+        }
+    )
+    client = app.test_client()
+    with app.app_context():
+        r = get_cache()
+        r.delete(RESULTS_STATS_KEY, RESULTS_ACCESSED_KEY)
+
+        assert get_results_from_cache("test-results", "etag1", "a") is None
+        save_results_to_cache("test-results", "etag1", "a", {"funders": [1, 2]})
+        assert get_results_from_cache("test-results", "etag1", "a") == {
+            "funders": [1, 2]
+        }
+        assert r.ttl(get_results_key("test-results", "etag1", "a")) > 0
+
+        # results for another version of the file aren't used
+        assert get_results_from_cache("test-results", "etag2", "a") is None
+
+        # the results used longest ago are removed
+        save_results_to_cache("test-results", "etag1", "b", {})
+        get_results_from_cache("test-results", "etag1", "a")
+        save_results_to_cache("test-results", "etag1", "c", {})
+        assert get_results_from_cache("test-results", "etag1", "a") is not None
+        assert get_results_from_cache("test-results", "etag1", "b") is None
+        assert r.zcard(RESULTS_ACCESSED_KEY) == 2
+
+    result = client.get("/cache/results_stats").get_json()
+    assert result == {"hit": 3, "miss": 3, "hit_rate": 0.5, "entries": 2}
+
+    app.config["RESULTS_CACHE_TTL"] = 0
+    with app.app_context():
+        assert get_results_from_cache("test-results", "etag1", "a") is None
+        r.delete(
+            RESULTS_STATS_KEY,
+            RESULTS_ACCESSED_KEY,
+            get_results_key("test-results", "etag1", "a"),
+            get_results_key("test-results", "etag1", "c"),
+        )
+
+
+def test_redis_cache_pages(test_app, df):
+    test_app.config["FILE_CACHE"] = "redis"
+    client = test_app.test_client()
+    with test_app.app_context():
+        r = get_cache()
+        for i in range(5):
+            r.set("negative:charity:GB-CHC-{}".format(i), "not-found")
+        r.hset("charity", "GB-CHC-1", "record")
+        save_to_cache("test-cache", df)
+        save_to_cache("test-legacy", df)
+        legacy = pickle.dumps(df.iloc[:2])
+        r.set("file_test-legacy", legacy)
+
+    # go through all the keys a page at a time
+    cursor = None
+    prefixes = {}
+    while cursor != 0:
+        result = client.get(
+            "/cache/redis_cache", query_string={"cursor": cursor or 0, "count": 2}
+        ).get_json()
+        cursor = result["cursor"]
+        for prefix, stats in result["prefixes"].items():
+            prefixes[prefix] = prefixes.get(prefix, 0) + stats["keys"]
+    assert prefixes["negative:charity"] == 5
+    assert result["hashes"]["charity"] >= 1
+    assert result["hashes"]["files"] >= 1
+
+    # sizes of the files on a page are found without fetching their values
+    with mock.patch.object(Redis, "get") as get:
+        result = client.get("/cache/files", query_string={"count": 1000}).get_json()
+        assert not get.called
+    assert result["cursor"] == 0
+    assert result["files"]["test-cache"]["size"] > 0
+    assert result["files"]["test-cache"]["fileid"] == "test-cache"
+    assert result["files"]["test-legacy"]["size"] == len(legacy)
+
+    with test_app.app_context():
+        r = get_cache()
+        for i in range(5):
+            r.delete("negative:charity:GB-CHC-{}".format(i))
+        r.hdel("charity", "GB-CHC-1")
+        delete_from_cache("test-cache")
+        delete_from_cache("test-legacy")
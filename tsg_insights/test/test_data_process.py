@@ -1,12 +1,20 @@
 import json
 import os
+import re
+import threading
+import time
 from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pandas as pd
 import pytest
 import requests_mock
 
+from tsg_insights import create_app
+from tsg_insights.data.cache import delete_from_cache
+from tsg_insights.data.index import PostcodeIndex
 from tsg_insights.data.process import *
+from tsg_insights.data.records import decode_record, encode_record, get_fetched_at
 
 
 @pytest.fixture
@@ -60,7 +68,66 @@ def m():
         m.get(i, text="Not found", status_code=404)
 
     m.start()
-    return m
+    yield m
+    m.stop()
+
+
+@pytest.fixture
+def postcode_server():
+    # local stub of a bulk postcode endpoint, serving the sample postcode data
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    postcodes = {}
+    for f in os.scandir(os.path.join(thisdir, "sample_external_apis", "pc")):
+        with open(f, "rb") as data:
+            postcodes[f.name.replace(".json", "")] = json.load(data)["data"]
+
+    class PostcodeHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            server.requests.append(self.path)
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            body = json.dumps(
+                {
+                    "data": [
+                        postcodes[pc.upper()]
+                        for pc in request["postcodes"]
+                        if pc.upper() in postcodes
+                    ]
+                }
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PostcodeHandler)
+    server.requests = []
+    server.url = "http://127.0.0.1:{}/postcodes/".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class DummyPipeline(list):
+    # queues commands and runs them against the cache when executed
+    def __init__(self, cache):
+        self.cache = cache
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.append((name, args, kwargs))
+
+        return command
+
+    def execute(self):
+        results = [getattr(self.cache, c)(*args, **kwargs) for c, args, kwargs in self]
+        self.clear()
+        return results
 
 
 class DummyCache(dict):
@@ -88,6 +155,31 @@ class DummyCache(dict):
     def hkeys(self, key):
         return list(self.get(key, {}).keys())
 
+    def hincrby(self, key, field, amount=1):
+        if not key in self:
+            self[key] = {}
+        self[key][field] = self[key].get(field, 0) + amount
+        return self[key][field]
+
+    def setex(self, key, time, value):
+        self[key] = value.encode() if isinstance(value, str) else value
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def hmget(self, key, fields):
+        # redis treats string and bytes fields the same
+        values = self.get(key, {})
+        return [
+            values.get(field, values.get(field.encode()))
+            if isinstance(field, str)
+            else values.get(field)
+            for field in fields
+        ]
+
+    def pipeline(self, transaction=True):
+        return DummyPipeline(self)
+
 
 def test_check_column_names():
     df = pd.DataFrame(
@@ -305,10 +397,147 @@ def test_charity_lookup(m):
     stage = LookupCharityDetails(df, cache, None)
     result_df = stage.run()
     assert len(cache["charity"]) == 4
-    assert json.loads(cache["charity"]["GB-CHC-225922"])["charityNumber"] == "225922"
-    assert json.loads(cache["charity"]["GB-COH-04325234"])["charityNumber"] == "1089464"
-    assert json.loads(cache["charity"]["GB-NIC-100012"])["charityNumber"] == "100012"
-    assert json.loads(cache["charity"]["GB-SC-SC003558"])["charityNumber"] == "SC003558"
+    for orgid, charity_number in [
+        ("GB-CHC-225922", "225922"),
+        ("GB-COH-04325234", "1089464"),
+        ("GB-NIC-100012", "100012"),
+        ("GB-SC-SC003558", "SC003558"),
+    ]:
+        record = decode_record("charity", cache["charity"][orgid])
+        assert record["charity_number"] == charity_number
+    assert (
+        decode_record("charity", cache["charity"]["GB-NIC-100012"])["org_type"]
+        == "Registered Charity (NI)"
+    )
+
+
+def test_lookup_batched_redis(m):
+    class CountingCache(DummyCache):
+        calls = []
+
+        def hmget(self, key, fields):
+            self.calls.append("hmget")
+            return super().hmget(key, fields)
+
+        def hset(self, key, field, value):
+            self.calls.append("hset")
+            return super().hset(key, field, value)
+
+    orgids = ["GB-CHC-{}".format(i) for i in range(2500)]
+    cache = CountingCache()
+    cache["charity"] = {orgid: b"{}" for orgid in orgids}
+    df = pd.DataFrame(
+        {
+            "Recipient Org:0:Identifier:Clean": orgids + ["GB-CHC-225922"],
+            "Recipient Org:0:Identifier:Scheme": "GB-CHC",
+        }
+    )
+    LookupCharityDetails(df, cache, None).run()
+
+    # cached IDs are fetched in chunks and only the new result is written
+    assert m.call_count == 1
+    assert len(cache["charity"]) == 2501
+    assert cache.calls == ["hmget", "hmget", "hmget", "hset"]
+
+
+def test_refresh_lookups(m, tmp_path):
+    app = create_app(
+        {
+            "REQUESTS_CACHE_ON": False,
+            "UPLOADS_FOLDER": str(tmp_path),
+            "LOOKUP_MAX_AGE": {"charity": 60},
+        }
+    )
+    with app.app_context():
+        cache = get_cache()
+        cache.delete("charity", "company", "postcode")
+        now = int(time.time())
+        record = {"charityNumber": "1", "id": "GB-CHC-1"}
+        cache.hset("charity", "GB-CHC-225922", encode_record("charity", record, 0))
+        cache.hset("charity", "GB-NIC-100012", encode_record("charity", record, now))
+        cache.hset(
+            "charity", "GB-SC-SC003558", encode_record("charity", record, now - 10)
+        )
+
+        # only the stale record is fetched again
+        result = refresh_lookups(["charity"])
+        assert result["refreshed"] == {"charity": 1}
+        assert m.call_count == 1
+        record = cache.hget("charity", "GB-CHC-225922")
+        assert get_fetched_at(record) >= now
+        assert decode_record("charity", record)["charity_number"] == "225922"
+
+        # the record fetched longest ago is evicted first
+        assert evict_lookups(max_entries=2)["charity"] == 1
+        assert sorted(cache.hkeys("charity")) == [b"GB-CHC-225922", b"GB-NIC-100012"]
+        cache.delete("charity")
+
+
+def test_deferred_company_lookups(m, tmp_path):
+    app = create_app({"REQUESTS_CACHE_ON": False, "UPLOADS_FOLDER": str(tmp_path)})
+    orgids = ["GB-COH-04325234", "GB-COH-09668396"] + [
+        "GB-COH-{:08.0f}".format(i) for i in range(100)
+    ]
+    df = pd.DataFrame(
+        {
+            "Amount Awarded": 100,
+            "Award Date": pd.to_datetime("2019-01-01", utc=True),
+            "Funding Org:0:Name": "Funder",
+            "Recipient Org:0:Identifier:Clean": orgids,
+            "Recipient Org:0:Identifier:Scheme": "GB-COH",
+            "__org_org_type": None,
+        }
+    )
+    for i in range(100):
+        m.get(
+            "http://data.companieshouse.gov.uk/doc/company/{:08.0f}.json".format(i),
+            status_code=404,
+        )
+    m.get(re.compile("https://findthatpostcode.uk/postcodes/"), status_code=404)
+
+    with app.app_context():
+        cache = get_cache()
+        cache.delete("company")
+        for orgid in orgids:
+            cache.hdel("charity", orgid)
+            cache.delete("negative:company:{}".format(orgid))
+        assert check_deferred_company_lookups(df, cache)
+        save_to_cache("test-deferred", df, metadata={"company_lookup": "queued"})
+        job = queue_deferred_company_lookups("test-deferred")
+        assert job.origin == "low"
+
+        # the worker adds the company data to the saved file
+        assert get_deferred_company_lookups("test-deferred") == "test-deferred"
+        metadata = get_metadata_from_cache("test-deferred")
+        assert metadata["company_lookup"] == "complete"
+        assert metadata["version"] == 2
+        result_df = get_from_cache("test-deferred").set_index(
+            "Recipient Org:0:Identifier:Clean"
+        )
+        assert result_df.loc["GB-COH-04325234", "__org_company_number"] == "04325234"
+        assert len(result_df["__org_org_type"].dropna()) == 2
+
+        job.delete()
+        delete_from_cache("test-deferred")
+        cache.delete("company")
+
+
+def test_lookup_urls():
+    df = pd.DataFrame()
+    assert (
+        LookupCharityDetails(df, None, None)._get_url("GB-CHC-225922")
+        == "https://findthatcharity.uk/orgid/GB-CHC-225922/canonical.json"
+    )
+    assert (
+        LookupCompanyDetails(df, None, None)._get_url("GB-COH-04325234")
+        == "http://data.companieshouse.gov.uk/doc/company/04325234.json"
+    )
+
+    # each lookup stage needs a URL
+    with pytest.raises(TypeError):
+
+        class LookupOther(ExternalLookupStage):
+            cache_key = "other"
 
 
 def test_company_lookup(m):
@@ -342,8 +571,8 @@ def test_company_lookup(m):
     result_df = stage.run()
     assert len(cache["company"]) == 1
     assert (
-        json.loads(cache["company"]["GB-COH-04325234"])["primaryTopic"]["CompanyName"]
-        == "CANCER RESEARCH UK"
+        decode_record("company", cache["company"]["GB-COH-04325234"])["company_number"]
+        == "04325234"
     )
     assert "GB-COH-00198344" not in cache["company"]
 
@@ -365,6 +594,10 @@ def test_org_merge():
             orgid = "GB-COH-{}".format(f.name.replace(".json", ""))
             cache["company"][orgid.encode()] = data.read()
 
+    # organisations not in the file are never read
+    cache["charity"][b"GB-CHC-OTHER"] = b"not json"
+    cache["company"][b"GB-COH-OTHER"] = b"not json"
+
     df = pd.DataFrame(
         {
             "Recipient Org:0:Identifier:Clean": [
@@ -422,6 +655,96 @@ def test_org_merge():
     assert len(result_df["__org_org_type"].dropna()) == 0
 
 
+def test_register_snapshot(m, tmp_path):
+    pd.DataFrame(
+        {
+            "id": ["GB-CHC-225922", "GB-SC-SC003558"],
+            "charityNumber": ["225922", "SC003558"],
+            "companyNumber": [None, "00198344"],
+            "dateRegistered": ["1963-01-10", "1961-05-17"],
+            "dateRemoved": [None, None],
+            "postalCode": ["SE1 1AA", "L4 0TH"],
+            "latestIncome": [123456, None],
+            "organisationTypePrimary": ["Registered Charity", "Registered Charity"],
+        }
+    ).to_csv(tmp_path / "charities.csv", index=False)
+    pd.DataFrame(
+        {
+            "CompanyName": ["A COMPANY LIMITED"],
+            " CompanyNumber": ["09668396"],
+            "RegAddress.PostCode": ["M1A 1AM"],
+            "CompanyCategory": ["Private Limited Company"],
+            "DissolutionDate": [None],
+            "IncorporationDate": ["01/07/2015"],
+        }
+    ).to_csv(tmp_path / "companies.csv", index=False)
+    register_index = {
+        source: import_register(
+            str(tmp_path / "{}.csv".format(csv_name)),
+            str(tmp_path / "registers" / source),
+            source,
+        )
+        for source, csv_name in [("charity", "charities"), ("company", "companies")]
+    }
+    assert len(register_index["charity"]) == 3
+
+    df = pd.DataFrame(
+        {
+            "Award Date": pd.to_datetime("2019-01-01"),
+            "Recipient Org:0:Identifier:Clean": [
+                "GB-CHC-225922",
+                "GB-NIC-100012",
+                "GB-SC-SC003558",
+                "GB-COH-00198344",
+                "GB-COH-09668396",
+                "GB-COH-04325234",
+            ],
+            "Recipient Org:0:Identifier:Scheme": [
+                "GB-CHC",
+                "GB-NIC",
+                "GB-SC",
+                "GB-COH",
+                "GB-COH",
+                "GB-COH",
+            ],
+        }
+    )
+    cache = DummyCache()
+    cache["charity"] = {}
+    cache["company"] = {}
+
+    # only organisations missing from the snapshot are fetched
+    m.get(
+        "https://findthatcharity.uk/orgid/GB-COH-09668396/canonical.json",
+        status_code=404,
+    )
+    stage = LookupCharityDetails(df, cache, None, register_index=register_index)
+    stage.run()
+    assert sorted(cache["charity"].keys()) == ["GB-COH-04325234", "GB-NIC-100012"]
+    stage = LookupCompanyDetails(df, cache, None, register_index=register_index)
+    stage.company_limit = 0
+    stage.run()
+    assert len(cache["company"]) == 0
+
+    stage = MergeCompanyAndCharityDetails(
+        df, cache, None, register_index=register_index
+    )
+    result_df = stage.run().set_index("Recipient Org:0:Identifier:Clean")
+    assert len(result_df) == len(df)
+    assert len(result_df["__org_org_type"].dropna()) == 6
+    assert result_df.loc["GB-CHC-225922", "__org_latest_income"] == 123456
+    assert result_df.loc["GB-CHC-225922", "__org_postcode"] == "SE1 1AA"
+    assert (
+        result_df.loc["GB-SC-SC003558", "__org_org_type"]
+        == "Registered Charity (Scotland)"
+    )
+    assert result_df.loc["GB-COH-00198344", "__org_charity_number"] == "SC003558"
+    assert result_df.loc["GB-COH-09668396", "__org_date_registered"] == pd.Timestamp(
+        "2015-07-01", tz="UTC"
+    )
+    assert pd.isnull(result_df.loc["GB-COH-09668396", "__org_charity_number"])
+
+
 def test_postcode_lookup(m):
     df = pd.DataFrame(
         {
@@ -434,13 +757,49 @@ def test_postcode_lookup(m):
     stage = FetchPostcodes(df, cache, None)
     result_df = stage.run()
     assert len(cache["postcode"]) == 2
+    assert decode_record("postcode", cache["postcode"]["L4 0TH"])["laua"] == "E08000012"
+
+
+def test_negative_cache(m):
+    df = pd.DataFrame({"Recipient Org:0:Postal Code": ["SE1 1AA", "L4 0TH", "M1A 1AM"]})
+    cache = DummyCache()
+    cache["postcode"] = {}
+    FetchPostcodes(df, cache, None).run()
+    assert len(cache["postcode"]) == 2
+    assert cache["negative:postcode:M1A 1AM"] == b"not-found"
+    assert cache["lookup_stats"]["postcode:negative_saved"] == 1
+    assert m.call_count == 3
+
+    # the missing postcode isn't requested again
+    FetchPostcodes(df, cache, None).run()
+    assert m.call_count == 3
+    assert cache["lookup_stats"]["postcode:negative_hit"] == 1
+    assert cache["lookup_stats"]["postcode:negative_miss"] == 3
+
+
+def test_postcode_lookup_batch(postcode_server):
+    df = pd.DataFrame(
+        {
+            "Recipient Org:0:Postal Code": ["SE1 1AA", "l4 0th", "M1A 1AM", None, None],
+            "__org_postcode": [None, None, None, "L4 0TH", None],
+        }
+    )
+    cache = DummyCache()
+    cache["postcode"] = {}
+    stage = FetchPostcodes(df, cache, None)
+    stage.pc_batch_url = postcode_server.url
+    stage.pc_batch_size = 2
+    result_df = stage.run()
+    assert len(postcode_server.requests) == 2
+    assert len(cache["postcode"]) == 3
+    assert "M1A 1AM" not in cache["postcode"]
+    assert decode_record("postcode", cache["postcode"]["l4 0th"])["laua"] == "E08000012"
     assert (
-        json.loads(cache["postcode"]["L4 0TH"])["data"]["attributes"]["laua_name"]
-        == "Liverpool"
+        decode_record("postcode", cache["postcode"]["SE1 1AA"])["ctry"] == "E92000001"
     )
 
 
-def test_geo_merge():
+def test_geo_merge(m):
     cache = DummyCache()
     cache["postcode"] = {}
 
@@ -450,6 +809,8 @@ def test_geo_merge():
         with open(f, "rb") as data:
             pc = f.name.replace(".json", "")
             cache["postcode"][pc.encode()] = data.read()
+    # postcodes not in the file are never read
+    cache["postcode"][b"XX1 1XX"] = b"not json"
 
     # get sample geodata
     cache = prepare_lookup_cache(cache)
@@ -478,6 +839,42 @@ def test_geo_merge():
     assert result_df.iloc[1]["__geo_laua"] == "Liverpool"
 
 
+def test_postcode_index(m, tmp_path):
+    # load sample data into a local postcode index
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    rows = {}
+    for f in os.scandir(os.path.join(thisdir, "sample_external_apis", "pc")):
+        with open(f, "rb") as data:
+            rows[f.name.replace(".json", "")] = json.load(data)["data"]["attributes"]
+    rows = pd.DataFrame(rows).T[POSTCODE_FIELDS]
+    for f in ["lat", "long"]:
+        rows[f] = pd.to_numeric(rows[f])
+    postcode_index = PostcodeIndex.build(rows, str(tmp_path / "postcodes"))
+
+    cache = DummyCache()
+    cache["postcode"] = {}
+    cache = prepare_lookup_cache(cache)
+
+    df = pd.DataFrame(
+        {
+            "Recipient Org:0:Postal Code": ["SE1 1AA", "L4 0TH", "M1A 1AM", None],
+        }
+    )
+
+    # postcodes in the index aren't fetched
+    stage = FetchPostcodes(df, cache, None, postcode_index=postcode_index)
+    stage.run()
+    assert len(cache["postcode"]) == 0
+    assert m.call_count == 2  # geocode names & the missing postcode
+
+    stage = MergeGeoData(df, cache, None, postcode_index=postcode_index)
+    result_df = stage.run()
+    assert len(result_df) == 4
+    assert len(result_df["__geo_ctry"].dropna()) == 2
+    assert result_df.iloc[1]["__geo_laua"] == "Liverpool"
+    assert result_df.iloc[0]["__geo_lat"] == pytest.approx(51.502166)
+
+
 def test_add_extra_fields():
     df = pd.DataFrame(
         {
@@ -512,3 +909,69 @@ def test_add_extra_fields():
     assert result_df.loc[3, "__org_age_bands"] == "Over 25 years"
 
     assert len(result_df["Grant Programme:0:Title"].unique()) == 1
+
+
+def test_add_derived_columns():
+    df = pd.DataFrame(
+        {
+            "Recipient Org:0:Identifier": [
+                "GB-CHC-123456",
+                "GB-COH-123456",
+                "360G-abc",
+                "XI-ABC-123",
+            ],
+            "__org_org_type": [None, "Registered Charity", None, None],
+            "__geo_ctry": ["England", "None", "Scotland", None],
+            "__geo_rgn": ["London", "Unknown", None, None],
+        }
+    )
+    stage = AddDerivedColumns(df, DummyCache(), None)
+    result_df = stage.run()
+
+    assert result_df["__org_type"].dtype == "category"
+    assert result_df["__org_type"].tolist() == [
+        "Registered Charity (E&W)",
+        "Registered Charity",
+        "Identifier not recognised",
+        "XI-ABC",
+    ]
+
+    assert result_df["__geo_ctry"].dtype == "category"
+    assert result_df["__geo_ctry"].tolist()[0] == "England"
+    assert result_df["__geo_ctry"].isnull().tolist() == [False, True, False, True]
+    assert result_df["__geo_rgn"].isnull().tolist() == [False, True, True, True]
+
+
+def test_compact_data_types():
+    df = pd.DataFrame(
+        {
+            "Amount Awarded": [100.5, 200, 300, 400],
+            "Award Date:Year": [2018, 2019, 2019, 2020],
+            "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder A"],
+            "Title": ["Grant 1", "Grant 2", "Grant 3", "Grant 4"],
+            "Description": ["Core costs", "Core costs", "Core costs", "Salary"],
+            "Recipient Org:0:Charity Number": [225922, "SC003558", 225922, None],
+            "Beneficiary Location:0:Name": None,
+            "Grant Programme:0:Title": None,
+            "__geo_ctry": ["England", "England", None, "Scotland"],
+            "__org_latest_income": None,
+        }
+    )
+    stage = CompactDataTypes(df, DummyCache(), None)
+    result_df = stage.run()
+
+    assert result_df["Funding Org:0:Name"].dtype == "category"
+    assert result_df["__geo_ctry"].dtype == "category"
+    assert result_df["__geo_ctry"].isnull().sum() == 1
+    assert result_df["Award Date:Year"].dtype == "int16"
+
+    # floats, free text and mixed columns are left alone
+    assert result_df["Amount Awarded"].dtype == "float64"
+    assert result_df["Title"].dtype == object
+    assert result_df["Description"].dtype == object
+    assert result_df["Recipient Org:0:Charity Number"].dtype == object
+
+    # empty columns are dropped, unless they're used by the dashboard
+    assert "Beneficiary Location:0:Name" not in result_df.columns
+    assert "Grant Programme:0:Title" in result_df.columns
+    assert "__org_latest_income" in result_df.columns
@@ -1,3 +1,4 @@
+import io
 import os
 import random
 import re
@@ -12,6 +13,7 @@ from tsg_insights.data.cache import (
     delete_from_cache,
     get_from_cache,
     get_metadata_from_cache,
+    save_to_cache,
 )
 from tsg_insights.data.process import *
 
@@ -75,7 +77,8 @@ def m():
             m.head(i[1])
 
     m.start()
-    return m
+    yield m
+    m.stop()
 
 
 @pytest.fixture
@@ -110,7 +113,7 @@ def test_file_upload(get_file, m, test_app):
             assert len(df) > 0
 
             metadata = get_metadata_from_cache(fileid)
-            assert len(metadata.keys()) == 5
+            assert len(metadata.keys()) == 7
             assert isinstance(metadata["expires"], str)
 
             delete_from_cache(fileid)
@@ -134,7 +137,33 @@ def test_file_fetch_from_url(get_file, m, test_app):
             assert len(df) > 0
 
             metadata = get_metadata_from_cache(fileid)
-            assert len(metadata.keys()) == 6
+            assert len(metadata.keys()) == 8
             assert metadata["url"] == url
 
             delete_from_cache(fileid)
+
+
+def test_upload_already_processed(test_app, tmp_path):
+    test_app.config["UPLOADS_FOLDER"] = str(tmp_path)
+    contents = b"Identifier,Title\n360G-abc,Grant\n"
+    fileid = get_content_fileid(contents, "grants.csv")
+    df = pd.DataFrame(
+        {
+            "Funding Org:0:Name": ["Funder"],
+            "Award Date": pd.to_datetime(["2019-01-01"], utc=True),
+        }
+    )
+    with test_app.app_context():
+        save_to_cache(fileid, df)
+
+    # the same file uploaded with a different name isn't processed again
+    client = test_app.test_client()
+    response = client.post(
+        "/fetch/upload",
+        data={"file": (io.BytesIO(contents), "my grants.csv")},
+        content_type="multipart/form-data",
+    )
+    assert response.get_json() == {"job": None, "fileid": fileid}
+
+    with test_app.app_context():
+        delete_from_cache(fileid)
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tsg_insights.data.index import *
+
+
+def test_sorted_index(tmp_path):
+    df = pd.DataFrame(
+        {
+            "name": ["Charity B", "Charity A", None, "Charity B"],
+            "income": [100.0, 200.0, None, 400.0],
+            "registered": pd.to_datetime(
+                ["2001-01-01", "2002-02-02", None, "2004-04-04"]
+            ),
+        },
+        index=["gb-chc-2", "GB-CHC-1", "GB-CHC-3", " GB-CHC-4 "],
+    )
+    index = SortedIndex.build(df, str(tmp_path / "orgs"))
+    assert len(index) == 4
+    assert index.contains(["GB-CHC-1", "gb-chc-4", "GB-CHC-5", None]).tolist() == [
+        True,
+        True,
+        False,
+        False,
+    ]
+
+    result = index.lookup(["GB-CHC-2", "GB-CHC-5", "GB-CHC-3", "GB-CHC-1234567890"])
+    assert result.index.tolist() == ["GB-CHC-2", "GB-CHC-3"]
+    assert result.loc["GB-CHC-2", "name"] == "Charity B"
+    assert result.loc["GB-CHC-2", "income"] == 100
+    assert result.loc["GB-CHC-3", "name"] is None
+    assert np.isnan(result.loc["GB-CHC-3", "income"])
+    assert result.loc["GB-CHC-2", "registered"] == pd.Timestamp("2001-01-01", tz="UTC")
+    assert pd.isnull(result.loc["GB-CHC-3", "registered"])
+
+    # opening the same index again reuses the mapped arrays
+    assert open_index(str(tmp_path / "orgs")) is open_index(str(tmp_path / "orgs"))
+    assert open_index(str(tmp_path / "missing")) is None
+
+
+def test_sorted_index_text(tmp_path, monkeypatch):
+    # text columns with many distinct values are stored as memory-mapped bytes
+    monkeypatch.setattr(SortedIndex, "max_categories", 2)
+    df = pd.DataFrame(
+        {
+            "postcode": ["SE1 1AA", "L4 0TH", None, "M1 1AÉ"],
+            "org_type": ["Charity", "Charity", None, "Company"],
+        },
+        index=["GB-CHC-1", "GB-CHC-2", "GB-CHC-3", "GB-CHC-4"],
+    )
+    index = SortedIndex.build(df, str(tmp_path / "orgs"))
+    postcodes, categories, _, encoding = index.columns["postcode"]
+    assert categories is None and encoding == "utf-8"
+    assert isinstance(postcodes, np.memmap)
+    assert index.columns["org_type"][1].tolist() == ["Charity", "Company"]
+
+    result = index.lookup(["GB-CHC-4", "GB-CHC-3", "GB-CHC-1"])
+    assert result["postcode"].tolist() == ["M1 1AÉ", None, "SE1 1AA"]
+    assert result["org_type"].tolist() == ["Company", None, "Charity"]
+
+
+def test_import_postcodes(tmp_path):
+    csv_file = tmp_path / "nspl.csv"
+    pd.DataFrame(
+        {
+            "pcd": ["SE1  1AA", "L4   0TH"],
+            "pcds": ["SE1 1AA", "L4 0TH"],
+            "ctry": ["E92000001", "E92000001"],
+            "laua": ["E09000028", "E08000012"],
+            "imd": [5620, 37],
+            "lat": [51.503541, 53.436033],
+            "long": [-0.09155, -2.963245],
+        }
+    ).to_csv(csv_file, index=False)
+
+    index = import_postcodes(
+        str(csv_file), str(tmp_path / "postcodes"), ["ctry", "laua", "imd", "lat"]
+    )
+    result = index.lookup(["se11aa", "L4 0TH", "M1A 1AM"])
+    assert result.index.tolist() == ["se11aa", "L4 0TH"]
+    assert result.columns.tolist() == ["ctry", "laua", "imd", "lat"]
+    assert result.loc["L4 0TH", "laua"] == "E08000012"
+    assert result.loc["se11aa", "imd"] == 5620
@@ -0,0 +1,131 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests_mock
+
+from tsg_insights.data.lookup import *
+
+
+@pytest.fixture
+def stub_server():
+    # a local HTTP server that records how many requests it handles at once
+    lock = threading.Lock()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with lock:
+                server.active += 1
+                server.max_active = max(server.max_active, server.active)
+            time.sleep(0.05)
+            with lock:
+                server.active -= 1
+            body = json.dumps({"path": self.path}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.active = 0
+    server.max_active = 0
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_json():
+    engine = LookupEngine(backoff=0)
+    with requests_mock.Mocker() as m:
+        m.get("https://example.com/a.json", json={"id": "a"})
+        m.get("https://example.com/b.json", json={"id": "b"})
+        m.get("https://example.com/missing.json", text="Not found", status_code=404)
+        m.get("https://example.com/invalid.json", text="Not JSON")
+
+        results = {
+            k: (data, error)
+            for k, data, error in engine.fetch_json(
+                {
+                    "a": "https://example.com/a.json",
+                    "b": "https://example.com/b.json",
+                    "missing": "https://example.com/missing.json",
+                    "invalid": "https://example.com/invalid.json",
+                }
+            )
+        }
+
+    assert results["a"] == ({"id": "a"}, None)
+    assert results["b"] == ({"id": "b"}, None)
+    assert results["missing"][0] is None
+    assert isinstance(results["missing"][1], requests.HTTPError)
+    assert results["invalid"][0] is None
+    assert isinstance(results["invalid"][1], ValueError)
+
+
+def test_fetch_json_retries():
+    engine = LookupEngine(backoff=0, retries=2)
+    with requests_mock.Mocker() as m:
+        m.get(
+            "https://example.com/a.json",
+            [
+                {"status_code": 503},
+                {"exc": requests.exceptions.ConnectTimeout},
+                {"json": {"id": "a"}},
+            ],
+        )
+        m.get("https://example.com/b.json", status_code=503)
+        results = {
+            k: (data, error)
+            for k, data, error in engine.fetch_json(
+                {
+                    "a": "https://example.com/a.json",
+                    "b": "https://example.com/b.json",
+                }
+            )
+        }
+        assert m.call_count == 6
+
+    assert results["a"] == ({"id": "a"}, None)
+    assert results["b"][0] is None
+
+
+def test_fetch_json_host_limit(stub_server):
+    engine = LookupEngine(max_workers=8, host_limit=2)
+    results = list(
+        engine.fetch_json(
+            {i: "{}/{}.json".format(stub_server.url, i) for i in range(10)}
+        )
+    )
+
+    assert len(results) == 10
+    assert all(error is None for k, data, error in results)
+    assert stub_server.max_active == 2
+
+
+def test_get_error_reason():
+    with requests_mock.Mocker() as m:
+        for status_code in [403, 404, 503]:
+            m.get("https://example.com/{}".format(status_code), status_code=status_code)
+        errors = {}
+        for status_code in [403, 404, 503]:
+            try:
+                requests.get(
+                    "https://example.com/{}".format(status_code)
+                ).raise_for_status()
+            except requests.HTTPError as error:
+                errors[status_code] = error
+
+    assert get_error_reason(errors[403]) == "http-403"
+    assert get_error_reason(errors[404]) == "not-found"
+    assert get_error_reason(errors[503]) is None
+    assert get_error_reason(ValueError("Invalid JSON")) == "invalid-json"
+    assert get_error_reason(requests.ConnectionError()) is None
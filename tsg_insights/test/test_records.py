@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+import msgpack
+
+from tsg_insights.data.records import *
+
+
+def load_sample(source, name):
+    thisdir = os.path.dirname(os.path.realpath(__file__))
+    with open(
+        os.path.join(thisdir, "sample_external_apis", source, name + ".json"), "rb"
+    ) as f:
+        return f.read()
+
+
+def test_encode_record():
+    raw = load_sample("ftc", "GB-SC-SC003558")
+    value = encode_record("charity", json.loads(raw))
+    assert len(value) < len(raw) / 5
+    assert msgpack.unpackb(value)[0] == RECORD_VERSION
+    assert abs(get_fetched_at(value) - time.time()) < 60
+
+    record = decode_record("charity", value)
+    assert list(record.keys()) == ORG_FIELDS
+    assert record["charity_number"] == "SC003558"
+    assert record["org_type"] == "Registered Charity (Scotland)"
+
+    record = decode_record(
+        "postcode", encode_record("postcode", json.loads(load_sample("pc", "L4 0TH")))
+    )
+    assert list(record.keys()) == POSTCODE_FIELDS
+    assert record["laua"] == "E08000012"
+
+
+def test_migrate_record():
+    raw = load_sample("ch", "04325234")
+    assert is_legacy_record(raw)
+    value = migrate_record("company", raw)
+    assert not is_legacy_record(value)
+    assert decode_record("company", raw) == decode_record("company", value)
+    assert decode_record("company", value)["company_number"] == "04325234"
+
+    # current records are left alone
+    assert migrate_record("company", value) is value
+
+    # version 1 records are converted, with an unknown fetch time
+    record = decode_record("company", value)
+    version_1 = msgpack.packb([1] + [record[f] for f in ORG_FIELDS])
+    assert decode_record("company", version_1) == record
+    assert get_fetched_at(version_1) == 0
+    assert decode_record("company", migrate_record("company", version_1)) == record
+
+    # unknown and unreadable records can't be converted
+    outdated = msgpack.packb([0, "04325234"])
+    assert not is_current_record(outdated)
+    assert migrate_record("company", outdated) is None
+    assert decode_record("company", outdated) is None
+    assert migrate_record("company", b"{not json") is None
+
+
+def test_unexpected_record():
+    # values that aren't lists of fields can't be read
+    for value in (5, "04325234", [], [RECORD_VERSION], {"a": 1}):
+        packed = msgpack.packb(value)
+        assert not is_current_record(packed)
+        assert get_fetched_at(packed) is None
+        assert decode_record("company", packed) is None
+        assert migrate_record("company", packed) is None
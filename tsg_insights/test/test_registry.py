@@ -43,7 +43,8 @@ def m():
             m.head(i[1])
 
     m.start()
-    return m
+    yield m
+    m.stop()
 
 
 @pytest.fixture
@@ -1,3 +1,12 @@
+import base64
+import io
+import logging
+import os
+import timeit
+
+import pandas as pd
+import pytest
+
 from tsg_insights.data.utils import *
 
 
@@ -81,6 +90,26 @@ def test_fileid():
     assert isinstance(r, str)
 
 
+def test_content_fileid():
+    contents = b"Identifier,Title\n360G-abc,Grant\n"
+    r = get_content_fileid(contents, "grants.csv")
+    assert isinstance(r, str)
+    assert len(r) == 32
+
+    # the file name doesn't change the ID, but the file type does
+    assert get_content_fileid(contents, "other.CSV") == r
+    assert get_content_fileid(contents, "grants.xlsx") != r
+    assert get_content_fileid(contents + b" ", "grants.csv") != r
+    assert get_content_fileid(contents, "grants.csv", date="2020") != r
+
+    # file objects are read in chunks
+    assert get_content_fileid(io.BytesIO(contents), "grants.csv", chunk_size=5) == r
+
+    # data URLs are decoded before they're hashed
+    data_url = "data:text/csv;base64," + base64.b64encode(contents).decode()
+    assert get_content_fileid(data_url, "grants.csv") == r
+
+
 def test_charity_number_to_org_id():
     charity_numbers = [
         (123545, None),
@@ -90,3 +119,98 @@ def test_charity_number_to_org_id():
     ]
     for c in charity_numbers:
         assert charity_number_to_org_id(c[0]) == c[1]
+
+
+def test_parse_identifiers():
+    identifiers = pd.Series(
+        [
+            "GB-CHC-1234567",
+            "360G-abc",
+            "360g-abc-def",
+            "",
+            "GB-RC000123",
+            None,
+            " GB-COH-123 ",
+            "GB-CHC-12-34",
+            "GB-CHC-1234567",
+        ],
+        index=range(10, 19),
+    )
+    result = parse_identifiers(identifiers)
+    assert result.index.tolist() == identifiers.index.tolist()
+    assert result["scheme"].dtype == "category"
+    assert result["id"].dtype == "category"
+    assert result["scheme"].tolist()[:3] == ["GB-CHC", "360G", "360G"]
+    assert result["scheme"].tolist()[3:5] == ["", "GB-RC000123"]
+    assert pd.isna(result["scheme"].tolist()[5])
+    assert result["scheme"].tolist()[6:] == ["GB-COH", "GB-CHC", "GB-CHC"]
+    assert result["id"].tolist()[:3] == ["1234567", "abc", "abc-def"]
+    assert result["id"].isnull().tolist()[3:6] == [True, True, True]
+    assert result["id"].tolist()[6:] == ["123", "12-34", "1234567"]
+
+    # categories give the same result
+    assert parse_identifiers(identifiers.astype("category")).equals(result)
+    assert len(parse_identifiers(identifiers.iloc[:0])) == 0
+
+
+def test_get_identifier_schemes():
+    df = pd.DataFrame(
+        {
+            "Recipient Org:0:Identifier": [
+                "GB-CHC-123456",
+                "GB-COH-123456",
+                "360G-abc",
+                "XI-ABC-123",
+                "GB-RC000123",
+            ],
+            "__org_org_type": [None, "Registered Charity", None, None, None],
+        }
+    )
+    assert get_identifier_schemes(df).tolist() == [
+        "Registered Charity (E&W)",
+        "Registered Charity",
+        "Identifier not recognised",
+        "XI-ABC",
+        "Identifier not recognised",
+    ]
+
+
+def parse_each(identifiers):
+    # work out the scheme of each identifier in turn, as identifiers were
+    # parsed before
+    return identifiers.apply(
+        lambda x: "360G" if x.startswith("360G-") else "-".join(x.split("-")[:2])
+    )
+
+
+def get_benchmark_identifiers(size):
+    return pd.Series(
+        ["GB-CHC-{}".format(i % 20000) for i in range(size * 7 // 10)]
+        + ["360G-funder-{}".format(i % 10000) for i in range(size * 3 // 10)]
+    )
+
+
+def test_parse_identifiers_each():
+    identifiers = get_benchmark_identifiers(1000)
+    assert (
+        parse_identifiers(identifiers)["scheme"]
+        .astype(object)
+        .equals(parse_each(identifiers))
+    )
+
+
+@pytest.mark.skipif(
+    not os.environ.get("RUN_BENCHMARKS"), reason="set RUN_BENCHMARKS to run"
+)
+def test_parse_identifiers_benchmark():
+    # run with `RUN_BENCHMARKS=1 python -m pytest -k benchmark --log-cli-level=INFO`
+    identifiers = get_benchmark_identifiers(100000)
+    each = min(timeit.repeat(lambda: parse_each(identifiers), number=1, repeat=3))
+    parsed = min(
+        timeit.repeat(lambda: parse_identifiers(identifiers), number=1, repeat=3)
+    )
+    logging.info(
+        "{:.1f}ms parsing each identifier, {:.1f}ms with parse_identifiers".format(
+            each * 1000, parsed * 1000
+        )
+    )
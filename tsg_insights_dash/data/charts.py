@@ -15,7 +15,7 @@ from tsg_insights.data.utils import (
     pluralize,
 )
 
-from .results import CHARTS, get_statistics
+from .results import CHARTS, get_chart_results, get_statistics
 
 DEFAULT_TABLE_FIELDS = [
     "Title",
@@ -167,9 +167,9 @@ def series_to_list(data):
     )
 
 
-def funder_chart(df):
+def funder_chart(grants):
     chart = CHARTS["funders"]
-    data = chart["get_results"](df)
+    data = get_chart_results("funders", grants)
     layout = copy.deepcopy(DEFAULT_LAYOUT)
     chart_type = "bar"
 
@@ -212,16 +212,13 @@ def funder_chart(df):
     )
 
 
-def grant_programme_chart(df):
+def grant_programme_chart(grants):
 
-    if (
-        "Grant Programme:0:Title" not in df.columns
-        or len(df["Grant Programme:0:Title"].unique()) <= 1
-    ):
+    if "Grant Programme:0:Title" not in grants.columns:
         return
 
     chart = CHARTS["grant_programmes"]
-    data = chart["get_results"](df)
+    data = get_chart_results("grant_programmes", grants)
     layout = copy.deepcopy(DEFAULT_LAYOUT)
     chart_type = "bar"
 
@@ -265,9 +262,9 @@ def grant_programme_chart(df):
     )
 
 
-def amount_awarded_chart(df):
+def amount_awarded_chart(grants):
     chart = CHARTS["amount_awarded"]
-    data = chart["get_results"](df)
+    data = get_chart_results("amount_awarded", grants)
 
     # if("USD" in data.columns):
     #     data.loc[:, "GBP"] = data["USD"]
@@ -338,9 +335,9 @@ def amount_awarded_chart(df):
     )
 
 
-def org_identifier_chart(df):
+def org_identifier_chart(grants):
     chart = CHARTS["identifier_scheme"]
-    data = chart["get_results"](df)
+    data = get_chart_results("identifier_scheme", grants)
     return chart_wrapper(
         dcc.Graph(
             id="identifier_scheme_chart",
@@ -354,47 +351,55 @@ def org_identifier_chart(df):
     )
 
 
-def awards_over_time_chart(df):
+def awards_over_time_chart(grants):
+
+    chart = CHARTS["award_date"]
+    data = get_chart_results("award_date", grants)
 
     # check whether all grants were awarded in the same month
-    if df["Award Date"].max().strftime("%Y-%m") == df["Award Date"].min().strftime(
-        "%Y-%m"
-    ):
+    if len(data["months"]) == 1:
         return message_box(
             "Award Date",
             "All grants were awarded in {}.".format(
-                df["Award Date"].min().strftime("%B %Y")
+                pd.Timestamp(data["months"].index[0]).strftime("%B %Y")
             ),
             error=False,
         )
 
-    chart = CHARTS["award_date"]
-    data = chart["get_results"](df)
-
-    xbins_sizes = (("M1", "by month"), ("M3", "by quarter"), ("M12", "by year"))
+    # grants are binned on the server, with a bar chart for each size of bin
+    bin_sizes = (
+        ("months", "by month", "%b %Y"),
+        ("quarters", "by quarter", "Q{quarter} %Y"),
+        ("years", "by year", "%Y"),
+    )
 
-    xbins_size = "M1"
+    bin_size = "months"
     if (data["max"] - data["min"]) >= 5:
-        xbins_size = "M12"
+        bin_size = "years"
     elif (data["max"] - data["min"]) >= 1:
-        xbins_size = "M3"
+        bin_size = "quarters"
+
+    def bin_labels(index, label_format):
+        dates = pd.to_datetime(index)
+        return [
+            d.strftime(label_format.replace("{quarter}", str(d.quarter))) for d in dates
+        ]
 
     chart_data = [
         dict(
-            x=data["all"],
-            autobinx=False,
-            autobiny=True,
+            x=data[b[0]].index.tolist(),
+            y=data[b[0]].tolist(),
+            text=bin_labels(data[b[0]].index, b[2]),
+            textposition="none",
+            hoverinfo="text+y",
             marker=dict(
                 color=THREESIXTY_COLOURS[1],
             ),
-            name="date",
-            type="histogram",
-            xbins=dict(
-                start="{}-01-01".format(data["min"]),
-                end="{}-12-31".format(data["max"]),
-                size=xbins_size,
-            ),
+            name=b[1],
+            type="bar",
+            visible=(b[0] == bin_size),
         )
+        for b in bin_sizes
     ]
 
     updatemenus = [
@@ -404,15 +409,15 @@ def awards_over_time_chart(df):
             xref="paper",
             yref="paper",
             yanchor="top",
-            active=[b[0] for b in xbins_sizes].index(xbins_size),
+            active=[b[0] for b in bin_sizes].index(bin_size),
             showactive=True,
             buttons=[
                 dict(
-                    args=["xbins.size", b[0]],
+                    args=["visible", [c[0] == b[0] for c in bin_sizes]],
                     label=b[1],
                     method="restyle",
                 )
-                for b in xbins_sizes
+                for b in bin_sizes
             ],
         )
     ]
@@ -431,18 +436,22 @@ def awards_over_time_chart(df):
         chart["title"],
         subtitle=chart.get("units"),
         description=chart.get("desc"),
-        children=[chart_n(len(data["all"]), "grant")],
+        children=[chart_n(data["months"].sum(), "grant")],
     )
 
 
-def region_and_country_chart(df):
+def is_geo_missing(ctry_rgn):
+    # whether the results of the ctry_rgn chart don't include any regions or countries
+    if not isinstance(ctry_rgn, (pd.DataFrame, pd.Series)):
+        return True
+    return all(i == ("Unknown", "Unknown") for i in ctry_rgn.index)
+
+
+def region_and_country_chart(grants):
     chart = CHARTS["ctry_rgn"]
-    data = chart["get_results"](df)
+    data = get_chart_results("ctry_rgn", grants)
 
-    if (
-        not isinstance(data, (pd.DataFrame, pd.Series))
-        or (df["__geo_ctry"].count() + df["__geo_rgn"].count()) == 0
-    ):
+    if is_geo_missing(data):
         return message_box(chart["title"], chart.get("missing"), error=True)
 
     layout = copy.deepcopy(DEFAULT_LAYOUT)
@@ -474,9 +483,9 @@ def region_and_country_chart(df):
     )
 
 
-def organisation_type_chart(df):
+def organisation_type_chart(grants):
     chart = CHARTS["org_type"]
-    data = chart["get_results"](df).sort_values(ascending=False)
+    data = get_chart_results("org_type", grants).sort_values(ascending=False)
     title = chart["title"]
     subtitle = chart.get("units")
     description = html.P(
@@ -550,16 +559,16 @@ def organisation_type_chart(df):
     )
 
 
-def organisation_income_chart(df):
+def organisation_income_chart(grants):
     chart = CHARTS["org_income"]
 
-    if (
-        "__org_latest_income_bands" not in df.columns
-        or df["__org_latest_income_bands"].count() == 0
-    ):
+    if "__org_latest_income_bands" not in grants.columns:
+        return message_box(chart["title"], chart.get("missing"), error=True)
+
+    data = get_chart_results("org_income", grants)
+    if data.sum() == 0:
         return message_box(chart["title"], chart.get("missing"), error=True)
 
-    data = chart["get_results"](df)
     return chart_wrapper(
         dcc.Graph(
             id="organisation_income_chart",
@@ -573,12 +582,15 @@ def organisation_income_chart(df):
     )
 
 
-def organisation_age_chart(df):
+def organisation_age_chart(grants):
     chart = CHARTS["org_age"]
-    if "__org_age_bands" not in df.columns or df["__org_age_bands"].count() == 0:
+    if "__org_age_bands" not in grants.columns:
+        return message_box(chart["title"], chart.get("missing"), error=True)
+
+    data = get_chart_results("org_age", grants)
+    if data.sum() == 0:
         return message_box(chart["title"], chart.get("missing"), error=True)
 
-    data = chart["get_results"](df)
     return chart_wrapper(
         dcc.Graph(
             id="organisation_age_chart",
@@ -592,10 +604,10 @@ def organisation_age_chart(df):
     )
 
 
-def imd_chart(df):
+def imd_chart(grants):
     # @TODO: expand to include non-English IMD too
     chart = CHARTS["imd"]
-    data = chart["get_results"](df)
+    data = get_chart_results("imd", grants)
     if data is None:
         return message_box(chart["title"], chart.get("missing"), error=True)
 
@@ -660,7 +672,7 @@ def location_map(df, mapbox_access_token=None, mapbox_style=None):
         geo = df[["__geo_lat", "__geo_long", popup_col]].dropna()
         grant_count = len(geo)
         geo = (
-            geo.groupby(["__geo_lat", "__geo_long", popup_col])
+            geo.groupby(["__geo_lat", "__geo_long", popup_col], observed=True)
             .size()
             .rename("grants")
             .reset_index()
@@ -753,8 +765,8 @@ charity or company registers. Mapping is UK only.""".format(
     )
 
 
-def get_statistics_output(df):
-    stats = get_statistics(df)
+def get_statistics_output(grants):
+    stats = get_statistics(grants)
 
     c = list(stats["currencies"].items())
     main_currency = c[0][1]
@@ -866,10 +878,10 @@ def get_statistics_output(df):
     ]
 
 
-def get_funder_output(df, grant_programme=[]):
+def get_funder_output(grants, grant_programme=[]):
 
     funder_class = ""
-    funder_names = sorted(df["Funding Org:0:Name"].unique().tolist())
+    funder_names = sorted(get_chart_results("funders", grants).index.tolist())
     subtitle = []
     if len(funder_names) > 5:
         funders = html.Span(
@@ -883,9 +895,10 @@ def get_funder_output(df, grant_programme=[]):
             [html.Span(f, className=funder_class) for f in funder_names], as_list=True
         )
 
+    award_dates = get_chart_results("award_date", grants)
     years = {
-        "max": df["Award Date"].dt.year.max(),
-        "min": df["Award Date"].dt.year.min(),
+        "max": award_dates["max"],
+        "min": award_dates["min"],
     }
     if years["max"] == years["min"]:
         years = [
@@ -913,7 +926,7 @@ def get_funder_output(df, grant_programme=[]):
     return_str = [
         html.H5(
             className="results-page__body__content__grants-made-by",
-            children="{} made by ".format(pluralize("Grant", len(df))),
+            children="{} made by ".format(pluralize("Grant", len(grants))),
         ),
         html.H1(
             className="results-page__body__content__header",
@@ -987,6 +1000,13 @@ def get_file_output(metadata):
                 else []
             )
         )
+    if metadata.get("company_lookup") == "queued":
+        output.append(
+            html.P(
+                "Company data is still being added to this file. "
+                "The dashboard will update when it is ready."
+            )
+        )
 
     if not output:
         return []
@@ -1,24 +1,63 @@
-from pandas import NA
+import hashlib
+import json
 
-from tsg_insights.data.cache import get_from_cache
+import numpy as np
+
+from tsg_insights.data.cache import (
+    get_cube_from_cache,
+    get_from_cache,
+    get_metadata_from_cache,
+    get_results_from_cache,
+    is_expired,
+    save_results_to_cache,
+)
+from tsg_insights.data.cube import CUBE_CELL_COLUMN
 
 from .results import (
     AGE_BAND_CHANGES,
     AWARD_BAND_CHANGES,
     INCOME_BAND_CHANGES,
+    ChartResults,
     get_ctry_rgn,
-    get_identifier_schemes,
     get_org_income,
-    get_org_income_bands,
+    get_org_type,
 )
 
 
-def get_filtered_df(fileid, **filters):
-    df = get_from_cache(fileid)
+def get_filter_columns(filter_ids=None):
+    # columns needed to apply (or get the values of) a set of filters
+    columns = []
+    for filter_id, filter_def in FILTERS.items():
+        if filter_ids is None or filter_id in filter_ids:
+            columns.extend(filter_def.get("columns", [filter_def.get("field")]))
+    return columns
+
+
+def get_filtered_df(fileid, columns=None, **filters):
+    """
+    Get a dataframe from the cache with the filters applied.
 
-    # fix for region and country being wrongly encoded
-    df.loc[df["__geo_ctry"].isin(["None", "Unknown"]), "__geo_ctry"] = NA
-    df.loc[df["__geo_rgn"].isin(["None", "Unknown"]), "__geo_rgn"] = NA
+    If a list of `columns` is given then only those columns are loaded.
+
+    The filters are applied to the cells of the file's aggregation cube,
+    and the rows in those cells are then found using the cell of each
+    row saved with the data, so the filters don't need to be applied to
+    every row.
+    """
+    cube = get_cube_from_cache(fileid)
+    indexed = cube is not None and cube.indexed
+    if columns is not None and not indexed:
+        columns = list(columns) + get_filter_columns(
+            [f for f, v in filters.items() if v]
+        )
+    df = get_from_cache(fileid, columns=columns, cube_cells=indexed)
+    if df is None:
+        return None
+
+    if indexed and CUBE_CELL_COLUMN in df.columns:
+        cells = get_filtered_cells(cube, **filters)
+        rows = cube.get_row_mask(cells.index, df.pop(CUBE_CELL_COLUMN).to_numpy())
+        return df.take(np.flatnonzero(rows))
 
     for filter_id, filter_def in FILTERS.items():
         new_df = filter_def["apply_filter"](df, filters.get(filter_id), filter_def)
@@ -28,6 +67,85 @@ def get_filtered_df(fileid, **filters):
     return df
 
 
+def get_filtered_cells(cube, **filters):
+    """
+    Get the cells of a cube that match the filters.
+
+    Filters are applied using `apply_cube_filter` and `cube_field` from the
+    filter definition if they're different from the ones used for the
+    dataframe.
+    """
+    cells = cube.cells
+    for filter_id, filter_def in FILTERS.items():
+        apply_filter = filter_def.get("apply_cube_filter", filter_def["apply_filter"])
+        new_cells = apply_filter(
+            cells,
+            filters.get(filter_id),
+            {
+                **filter_def,
+                "field": filter_def.get("cube_field", filter_def.get("field")),
+            },
+        )
+        if new_cells is not None:
+            cells = new_cells
+    return cells
+
+
+def get_filtered_cube(fileid, **filters):
+    """
+    Get the aggregation cube for a file with the filters applied.
+    """
+    cube = get_cube_from_cache(fileid)
+    if cube is None:
+        return None
+
+    cells = get_filtered_cells(cube, **filters)
+    return cube.select(cube.cells.index.isin(cells.index))
+
+
+def get_filters_key(filters):
+    """
+    Get a key for a set of filters, which is the same for any filters that
+    select the same grants (eg with the values in a different order).
+    """
+    normalised = [ChartResults.version]
+    for filter_id, filter_def in FILTERS.items():
+        value = filters.get(filter_id)
+        if not value or value == ["__all"]:
+            continue
+        value = [str(v) for v in value]
+        if filter_def["type"] == "multidropdown":
+            value = sorted(set(value))
+        normalised.append([filter_id, value])
+    return hashlib.sha1(json.dumps(normalised).encode("utf8")).hexdigest()
+
+
+def get_filtered_results(fileid, **filters):
+    """
+    Get the results of each chart, and the statistics, for a file with the
+    filters applied.
+
+    Results are cached in redis for each version of the file and set of
+    filters, so they're only worked out from the cube the first time a set
+    of filters is used.
+    """
+    metadata = get_metadata_from_cache(fileid)
+    if not metadata or is_expired(metadata):
+        return None
+
+    filters_key = get_filters_key(filters)
+    results = get_results_from_cache(fileid, metadata.get("etag"), filters_key)
+    if results is not None:
+        return results
+
+    cube = get_filtered_cube(fileid, **filters)
+    if cube is None:
+        return None
+    results = ChartResults.from_data(cube)
+    save_results_to_cache(fileid, cube.etag, filters_key, results)
+    return results
+
+
 def apply_area_filter(df, filter_args, filter_def):
 
     if not filter_args or filter_args == ["__all"]:
@@ -43,28 +161,15 @@ def apply_area_filter(df, filter_args, filter_def):
     if countries and regions:
         return df[
             (df["__geo_ctry"].isin(countries))
-            & (df["__geo_rgn"].fillna(df["__geo_ctry"]).isin(regions))
+            & (
+                df["__geo_rgn"]
+                .astype(object)
+                .fillna(df["__geo_ctry"].astype(object))
+                .isin(regions)
+            )
         ]
 
 
-def apply_org_size_filter(df, filter_args, filter_def):
-
-    if not filter_args or filter_args == ["__all"]:
-        return
-
-    bands = get_org_income_bands(df)
-    return df[bands.isin(filter_args)]
-
-
-def apply_org_type_filter(df, filter_args, filter_def):
-
-    if not filter_args or filter_args == ["__all"]:
-        return
-
-    org_type = get_identifier_schemes(df)
-    return df[org_type.isin(filter_args)]
-
-
 def apply_field_filter(df, filter_args, filter_def):
 
     if not filter_args or filter_args == ["__all"]:
@@ -131,6 +236,7 @@ FILTERS = {
             }
         ),
         "field": "Award Date",
+        "cube_field": "award_month",
         "apply_filter": apply_date_range_filter,
     },
     "area": {
@@ -152,6 +258,7 @@ FILTERS = {
                 for value, count in get_ctry_rgn(df)["Grants"].iteritems()
             ]
         ),
+        "columns": ["__geo_ctry", "__geo_rgn", "Amount Awarded"],
         "apply_filter": apply_area_filter,
     },
     "orgtype": {
@@ -161,11 +268,13 @@ FILTERS = {
         "get_values": (
             lambda df: [
                 {"label": "{} ({})".format(i[0], i[1]), "value": i[0]}
-                for i in get_identifier_schemes(df).value_counts().iteritems()
+                for i in get_org_type(df)
+                .sort_values(ascending=False, kind="stable")
+                .iteritems()
             ]
         ),
-        "field": "__org_org_type",
-        "apply_filter": apply_org_type_filter,
+        "field": "__org_type",
+        "apply_filter": apply_field_filter,
     },
     "award_amount": {
         "label": "Amount awarded",
@@ -204,7 +313,7 @@ FILTERS = {
             else []
         ),
         "field": "__org_latest_income_bands",
-        "apply_filter": apply_org_size_filter,
+        "apply_filter": apply_field_filter,
     },
     "org_age": {
         "label": "Organisation age",
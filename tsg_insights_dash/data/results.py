@@ -1,38 +1,8 @@
 import numpy as np
 import pandas as pd
 
-from tsg_insights.data.process import AddExtraFieldsExternal
-from tsg_insights.data.utils import format_currency
-
-IDENTIFIER_MAP = {
-    "360G": "Identifier not recognised",  # 360G          41190
-    "GB-CHC": "Registered Charity (E&W)",  # GB-CHC        42190
-    "GB-SC": "Registered Charity (Scotland)",  # GB-SC          7134
-    "GB-NIC": "Registered Charity (NI)",  # GB-NIC          718
-    "GB-COH": "Registered Company",  # GB-COH        11698
-    "GB-GOR": "Government",  # GB-GOR           13
-    "GB-MPR": "Mutual",  # GB-MPR           32
-    "GB-NHS": "NHS",  # GB-NHS           14
-    "GB-UKPRN": "School/University/Education",  # GB-UKPRN         48
-    "GB-EDU": "School/University/Education",  # GB-EDU          255
-    "GB-SHPE": "Social Housing Provider",
-    "GB-LAE": "Local Authority",  # GB-LAE           39
-    "GB-LAS": "Local Authority",  # GB-LAS            2
-    "GB-REV": "Registered Charity (HMRC)",  # GB-REV           92
-    "US-EIN": "US - registered with IRS",  # US-EIN           38
-    "ZA-NPO": "South Africa - registered with Nonprofit Organisation Directorate",  # ZA-NPO           12
-    "IM-GR": "Registered Charity (Isle of Man)",  # IM-GR             8
-    # NL-KVK            3
-    # GG-RCE            3
-    # XM-DAC            2
-    # IL-ROC            2
-    # BE-BCE_KBO        2
-    # CA-CRA_ACR        2
-    # ZA-PBO            2
-    # SE-BLV            1
-    # CH-FDJP           1
-    # JE-FSC            1
-}
+from tsg_insights.data.cube import GrantsCube, get_imd_deciles
+from tsg_insights.data.utils import format_currency, parse_identifiers
 
 INCOME_BAND_CHANGES = {
     # "Under £10k": "Up to £10k",
@@ -63,164 +33,303 @@ AGE_BAND_CHANGES = {
 }
 
 
-def get_imd_data(df):
+IMD_ORDER = [
+    "1: most deprived",
+    "2 ",
+    "3 ",
+    "4 ",
+    "5 ",
+    "6 ",
+    "7 ",
+    "8 ",
+    "9 ",
+    "10: least deprived",
+]
+
+REGION_ORDER = [
+    ("Scotland", "Scotland"),
+    ("Northern Ireland", "Northern Ireland"),
+    ("Wales", "Wales"),
+    ("England", "North East"),
+    ("England", "North West"),
+    ("England", "Yorkshire and The Humber"),
+    ("England", "West Midlands"),
+    ("England", "East Midlands"),
+    ("England", "East of England"),
+    ("England", "London"),
+    ("England", "South West"),
+    ("England", "South East"),
+    ("Isle of Man", "Isle of Man"),
+    ("Unknown", "Unknown"),
+]
+
+
+def get_imd_series(counts):
+    # number of grants in each IMD decile, labelled in order
+    imd = counts.sort_index().reindex(np.arange(1, 11)).fillna(0)
+    imd.index = pd.Series(IMD_ORDER)
+    return imd
 
-    imd_order = [
-        "1: most deprived",
-        "2 ",
-        "3 ",
-        "4 ",
-        "5 ",
-        "6 ",
-        "7 ",
-        "8 ",
-        "9 ",
-        "10: least deprived",
-    ]
 
-    imd = df.loc[df["__geo_ctry"] == "England", "__geo_imd"]
+def get_imd_data(df):
+    imd = get_imd_deciles(df)
     if imd.count() == 0:
         return None
+    return get_imd_series(imd.value_counts())
 
-    # maximum rank of LSOAs by IMD
-    # from: https://www.arcgis.com/sharing/rest/content/items/0a404beab6f544be8fb72d0c2b12d62b/data
-    # NSPL user guid
-    # 1 = most deprived, this number = most deprived
-    imd_total_eng = 32844
-    imd_total_scot = 6976
-    imd_total_wal = 1909
-    imd_total_ni = 890
-
-    # work out the IMD decile
-    imd = (
-        ((imd / imd_total_eng) * 10)
-        .apply(np.ceil)
-        .value_counts()
-        .sort_index()
-        .reindex(np.arange(1, 11))
-        .fillna(0)
-    )
 
-    imd.index = pd.Series(imd_order)
-    return imd
+def get_cube_imd_data(cube):
+    if "imd_decile" not in cube.columns:
+        return None
+    imd = cube.value_counts("imd_decile")
+    if imd.sum() == 0:
+        return None
+    return get_imd_series(imd)
 
 
-def get_statistics(df):
-    curr_gb = df.groupby("Currency")
-    currencies = pd.DataFrame(
-        {
-            "total": curr_gb["Amount Awarded"].sum(),
-            "median": curr_gb["Amount Awarded"].median(),
-            "grants": curr_gb.size(),
-            "recipients": curr_gb["Recipient Org:0:Identifier"].nunique(),
-        }
-    )
+def format_statistics(currencies, grants, recipients, award_years):
     currencies = currencies.sort_values("grants", ascending=False).to_dict("index")
     for c in currencies:
         currencies[c]["total_f"] = format_currency(currencies[c]["total"], c)
         currencies[c]["median_f"] = format_currency(currencies[c]["median"], c)
 
     return {
-        "grants": len(df),
-        "recipients": df["Recipient Org:0:Identifier"].unique().size,
+        "grants": grants,
+        "recipients": recipients,
         "currencies": currencies,
         "award_years": {
-            "min": df["Award Date"].dt.year.min(),
-            "max": df["Award Date"].dt.year.max(),
+            "min": award_years.min(),
+            "max": award_years.max(),
         },
     }
 
 
-def get_ctry_rgn(df):
+def get_statistics(df):
+    if isinstance(df, ChartResults):
+        return df.statistics
+    if isinstance(df, GrantsCube):
+        return get_cube_statistics(df)
 
-    if "__geo_ctry" not in df.columns or "__geo_rgn" not in df.columns:
-        return None
+    curr_gb = df.groupby("Currency", observed=True)
+    currencies = pd.DataFrame(
+        {
+            "total": curr_gb["Amount Awarded"].sum(),
+            "median": curr_gb["Amount Awarded"].median(),
+            "grants": curr_gb.size(),
+            "recipients": curr_gb["Recipient Org:0:Identifier"].nunique(),
+        }
+    )
+    return format_statistics(
+        currencies,
+        len(df),
+        df["Recipient Org:0:Identifier"].unique().size,
+        df["Award Date"].dt.year,
+    )
 
-    REGION_ORDER = [
-        ("Scotland", "Scotland"),
-        ("Northern Ireland", "Northern Ireland"),
-        ("Wales", "Wales"),
-        ("England", "North East"),
-        ("England", "North West"),
-        ("England", "Yorkshire and The Humber"),
-        ("England", "West Midlands"),
-        ("England", "East Midlands"),
-        ("England", "East of England"),
-        ("England", "London"),
-        ("England", "South West"),
-        ("England", "South East"),
-        ("Isle of Man", "Isle of Man"),
-        ("Unknown", "Unknown"),
-    ]
 
-    # generate region groupby
-    ctry_rgn = (
-        df.groupby(
-            [
-                df["__geo_ctry"].fillna("Unknown").str.strip(),
-                # ensure countries where region is null are correctly labelled
-                df.loc[:, "__geo_rgn"]
-                .fillna(df["__geo_ctry"])
-                .fillna("Unknown")
-                .str.strip(),
-            ]
-        )
-        .agg({"Amount Awarded": "sum", "Title": "size"})
-        .rename(columns={"Title": "Grants"})
+def get_cube_statistics(cube):
+    currency = cube.cells["Currency"].astype(object)
+    currencies = pd.DataFrame(
+        {
+            "total": cube.cells.groupby(currency)["Amount Awarded"].sum(),
+            "median": cube.median_amounts("Currency"),
+            "grants": cube.cells.groupby(currency)["Grants"].sum(),
+            "recipients": pd.Series(cube.recipients)
+            .groupby(cube.recipient_values("Currency"))
+            .nunique(),
+        }
+    )
+    return format_statistics(
+        currencies,
+        len(cube),
+        cube.unique_recipients(),
+        cube.cells.loc[cube.cells["Grants"] > 0, "award_month"].dt.year,
     )
 
+
+def get_ctry_rgn_groups(df):
+    return [
+        df["__geo_ctry"].astype(object).fillna("Unknown").str.strip(),
+        # ensure countries where region is null are correctly labelled
+        df["__geo_rgn"]
+        .astype(object)
+        .fillna(df["__geo_ctry"].astype(object))
+        .fillna("Unknown")
+        .str.strip(),
+    ]
+
+
+def sort_regions(ctry_rgn):
     # Sort from North -> South
     idx = ctry_rgn.index.tolist()
     new_idx = [i for i in REGION_ORDER if i in idx] + [
         i for i in idx if i not in REGION_ORDER
     ]
-    ctry_rgn = ctry_rgn.reindex(new_idx)
-    return ctry_rgn
+    return ctry_rgn.reindex(new_idx)
+
 
+def get_ctry_rgn(df):
 
-def get_org_income_bands(df):
-    if df["__org_latest_income"].isnull().values.all():
-        return df["__org_latest_income"]
-    return pd.cut(
-        df["__org_latest_income"],
-        bins=AddExtraFieldsExternal.INCOME_BINS,
-        labels=AddExtraFieldsExternal.INCOME_BIN_LABELS,
+    if "__geo_ctry" not in df.columns or "__geo_rgn" not in df.columns:
+        return None
+
+    # generate region groupby
+    ctry_rgn = df.groupby(get_ctry_rgn_groups(df))
+    ctry_rgn = pd.DataFrame(
+        {
+            "Amount Awarded": ctry_rgn["Amount Awarded"].sum(),
+            "Grants": ctry_rgn.size(),
+        }
     )
+    return sort_regions(ctry_rgn)
+
+
+def get_cube_ctry_rgn(cube):
+
+    if "__geo_ctry" not in cube.columns or "__geo_rgn" not in cube.columns:
+        return None
+
+    ctry_rgn = cube.cells.groupby(get_ctry_rgn_groups(cube.cells)).agg(
+        {"Amount Awarded": "sum", "Grants": "sum"}
+    )
+    return sort_regions(ctry_rgn)
 
 
 def get_org_income(df):
-    return get_org_income_bands(df).value_counts().sort_index()
+    return df["__org_latest_income_bands"].value_counts().sort_index()
 
 
 def get_org_type(df):
-    return get_identifier_schemes(df).value_counts().sort_index()
+    org_type = df["__org_type"].value_counts()
+    return org_type[org_type > 0].sort_index()
 
 
-def get_identifier_schemes(df):
-    identifier_schemes = df["Recipient Org:0:Identifier"].apply(
-        lambda x: "360G"
-        if len(x.split("-")) < 3 or x.upper().startswith("360G-")
-        else "-".join(x.split("-")[:2])
+def get_cube_org_type(cube):
+    org_type = cube.value_counts("__org_type")
+    return org_type[org_type > 0].sort_index()
+
+
+def get_cube_amount_awarded(cube):
+    return (
+        pd.crosstab(
+            cube.cells["Amount Awarded:Bands"].cat.rename_categories(
+                AWARD_BAND_CHANGES
+            ),
+            cube.cells["Currency"].astype(object),
+            values=cube.cells["Grants"],
+            aggfunc="sum",
+            dropna=False,
+        )
+        .fillna(0)
+        .astype(int)
+        .sort_index()
     )
 
-    if "__org_org_type" in df:
-        identifier_schemes = df["__org_org_type"].fillna(identifier_schemes)
 
-    return identifier_schemes.fillna("Identifier not recognised").apply(
-        lambda x: IDENTIFIER_MAP.get(x, x)
+def get_award_date_bins(months):
+    """
+    Get the number of grants awarded by month, quarter and year from the
+    number of grants in each month (indexed by the first day of the month).
+
+    Each series is indexed by the first day of the month, quarter or year,
+    and only includes the periods where grants were awarded, so the chart
+    doesn't need to bin each grant itself.
+    """
+    months = months[months > 0].sort_index()
+    dates = pd.to_datetime(months.index)
+    quarters = dates.to_period("Q").start_time.strftime("%Y-%m-%d")
+    years = dates.strftime("%Y-01-01")
+    return {
+        "months": months,
+        "quarters": months.groupby(quarters).sum(),
+        "years": months.groupby(years).sum(),
+        "min": dates.year.min(),
+        "max": dates.year.max(),
+    }
+
+
+def get_award_dates(df):
+    return get_award_date_bins(
+        df["Award Date"].dt.strftime("%Y-%m-01").value_counts().sort_index()
     )
 
 
+def get_cube_award_dates(cube):
+    months = cube.value_counts("award_month").sort_index()
+    months = months[months > 0]
+    months.index = months.index.strftime("%Y-%m-%d")
+    return get_award_date_bins(months)
+
+
+class ChartResults(object):
+    """
+    The results of every chart, and the statistics, for a set of grants.
+
+    These can be used in place of the grants by `get_chart_results` and
+    `get_statistics`, and are what's kept in the results cache. `columns`
+    holds the columns of the grants, and `len()` is the number of grants.
+    """
+
+    # version of the results - increase this if the results of any chart
+    # change, so that results cached by older versions aren't used
+    version = 3
+
+    def __init__(self, results, statistics, columns, grants):
+        self.results = results
+        self.statistics = statistics
+        self.columns = columns
+        self.grants = grants
+
+    @classmethod
+    def from_data(cls, data):
+        # work out the results from a dataframe of grants or a `GrantsCube`
+        results = {}
+        for chart_id in CHARTS:
+            try:
+                results[chart_id] = get_chart_results(chart_id, data)
+            except KeyError:
+                # the columns needed for the chart aren't in the data
+                results[chart_id] = None
+        return cls(results, get_statistics(data), list(data.columns), len(data))
+
+    def __len__(self):
+        return self.grants
+
+
+def get_chart_results(chart_id, data):
+    """
+    Get the results for a chart from either a dataframe of grants, a
+    `GrantsCube` or `ChartResults`.
+    """
+    if isinstance(data, ChartResults):
+        return data.results[chart_id]
+    if isinstance(data, GrantsCube):
+        return CHARTS[chart_id]["get_cube_results"](data)
+    return CHARTS[chart_id]["get_results"](data)
+
+
 CHARTS = dict(
     funders={
         "title": "Funders",
         "units": "(number of grants)",
-        "get_results": (lambda df: df["Funding Org:0:Name"].value_counts()),
+        "get_results": (
+            lambda df: df["Funding Org:0:Name"].value_counts().loc[lambda x: x > 0]
+        ),
+        "get_cube_results": (
+            lambda cube: cube.value_counts("Funding Org:0:Name").loc[lambda x: x > 0]
+        ),
     },
     grant_programmes={
         "title": "Grant programmes",
         "units": "(number of grants)",
-        "get_results": (lambda df: df["Grant Programme:0:Title"].value_counts()),
+        "get_results": (
+            lambda df: df["Grant Programme:0:Title"].value_counts().loc[lambda x: x > 0]
+        ),
+        "get_cube_results": (
+            lambda cube: cube.value_counts("Grant Programme:0:Title").loc[
+                lambda x: x > 0
+            ]
+        ),
     },
     amount_awarded={
         "title": "Amount awarded",
@@ -228,35 +337,32 @@ CHARTS = dict(
         "get_results": (
             lambda df: pd.crosstab(
                 df["Amount Awarded:Bands"].cat.rename_categories(AWARD_BAND_CHANGES),
-                df["Currency"],
+                df["Currency"].astype(object),
                 dropna=False,
             ).sort_index()
         ),
+        "get_cube_results": get_cube_amount_awarded,
     },
     identifier_scheme={
         "title": "Identifier scheme",
         "units": "(number of grants)",
         "get_results": (
-            lambda df: df["Recipient Org:0:Identifier"]
-            .apply(
-                lambda x: "360G"
-                if x.startswith("360G-")
-                else "-".join(x.split("-")[:2])
-            )
+            lambda df: parse_identifiers(df["Recipient Org:0:Identifier"])["scheme"]
             .value_counts()
+            .loc[lambda x: x > 0]
+            .sort_index()
+        ),
+        "get_cube_results": (
+            lambda cube: cube.value_counts("identifier_scheme")
+            .loc[lambda x: x > 0]
             .sort_index()
         ),
     },
     award_date={
         "title": "Award date",
         "units": "(number of grants)",
-        "get_results": (
-            lambda df: {
-                "all": df["Award Date"].dt.strftime("%Y-%m-%d").tolist(),
-                "min": df["Award Date"].dt.year.min(),
-                "max": df["Award Date"].dt.year.max(),
-            }
-        ),
+        "get_results": get_award_dates,
+        "get_cube_results": get_cube_award_dates,
     },
     ctry_rgn={
         "title": "UK region and country",
@@ -266,6 +372,7 @@ If postcodes aren’t present, they are sourced from UK charity or company regis
         "missing": """This chart can\'t be shown as there is no information on the country and region of recipients or grants. 
 This can be added by using charity or company numbers, or by including a postcode.""",
         "get_results": get_ctry_rgn,
+        "get_cube_results": get_cube_ctry_rgn,
     },
     org_type={
         "title": "Recipient type",
@@ -273,6 +380,7 @@ This can be added by using charity or company numbers, or by including a postcod
         "desc": """Organisation type is only available for recipients with a valid
 organisation identifier.""",
         "get_results": get_org_type,
+        "get_cube_results": get_cube_org_type,
     },
     org_income={
         "title": "Latest income of charity recipients",
@@ -281,6 +389,9 @@ organisation identifier.""",
 organisation income data. Add company or charity numbers to your data to show a chart of
 the income of organisations.""",
         "get_results": get_org_income,
+        "get_cube_results": (
+            lambda cube: cube.value_counts("__org_latest_income_bands").sort_index()
+        ),
     },
     org_age={
         "title": "Age of recipient organisations",
@@ -295,6 +406,11 @@ the age of organisations.""",
             .value_counts()
             .sort_index()
         ),
+        "get_cube_results": (
+            lambda cube: cube.value_counts("__org_age_bands")
+            .sort_index()
+            .rename(AGE_BAND_CHANGES)
+        ),
     },
     imd={
         "title": "Index of multiple deprivation",
@@ -305,5 +421,6 @@ the age of organisations.""",
         "missing": """We can't show this chart as we couldn't find any details of the index of multiple deprivation 
             ranking for postcodes in your data. At the moment we can only use data for England.""",
         "get_results": get_imd_data,
+        "get_cube_results": get_cube_imd_data,
     },
 )
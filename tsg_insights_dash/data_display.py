@@ -4,6 +4,7 @@ import re
 
 import dash_core_components as dcc
 import dash_html_components as html
+from dash import no_update
 from dash.dependencies import Input, Output, State
 from dash_dangerously_set_inner_html import DangerouslySetInnerHTML as InnerHTML
 from flask import render_template, url_for
@@ -13,7 +14,12 @@ from tsg_insights.data.cache import get_metadata_from_cache
 from tsg_insights_components import InsightChecklist, InsightDropdown, InsightFoldable
 
 from .data.charts import *
-from .data.filters import FILTERS, get_filtered_df
+from .data.filters import (
+    FILTERS,
+    get_filter_columns,
+    get_filtered_df,
+    get_filtered_results,
+)
 
 
 def footer(server):
@@ -181,6 +187,14 @@ layout = html.Div(
                                     id="award-dates",
                                     data={f: FILTERS[f]["defaults"] for f in FILTERS},
                                 ),
+                                # checks for updates to the file while extra
+                                # data is being added in the background
+                                dcc.Store(id="file-version"),
+                                dcc.Interval(
+                                    id="file-version-interval",
+                                    interval=15 * 1000,
+                                    disabled=True,
+                                ),
                             ],
                         ),
                     ],
@@ -210,6 +224,28 @@ layout = html.Div(
 )
 
 
+@app.callback(
+    [
+        Output("file-version", "data"),
+        Output("file-version-interval", "disabled"),
+    ],
+    [
+        Input("output-data-id", "data"),
+        Input("file-version-interval", "n_intervals"),
+    ],
+    [State("file-version", "data")],
+)
+def file_version_change(fileid, n_intervals, existing_version):
+    metadata = get_metadata_from_cache(fileid) if fileid else None
+    version = "{}:{}".format(fileid, (metadata or {}).get("version"))
+
+    # keep checking while company data is being looked up
+    disabled = (metadata or {}).get("company_lookup") != "queued"
+    if version == existing_version:
+        return (no_update, disabled)
+    return (version, disabled)
+
+
 @app.callback(
     [
         Output("dashboard-output", "children"),
@@ -217,19 +253,21 @@ layout = html.Div(
         Output("dashboard-output", "className"),
     ],
     [
-        Input("output-data-id", "data"),
+        Input("file-version", "data"),
         #    Input('tabs', 'value'),
     ]
     + [Input("df-change-{}".format(f), "value") for f in FILTERS],
+    [State("output-data-id", "data")],
 )
-def dashboard_output(fileid, *args):
-    filter_args = dict(zip(FILTERS.keys(), args))
-    df = get_filtered_df(fileid, **filter_args)
+def dashboard_output(file_version, *args):
+    fileid = args[-1]
+    filter_args = dict(zip(FILTERS.keys(), args[:-1]))
+    results = get_filtered_results(fileid, **filter_args)
 
     metadata = get_metadata_from_cache(fileid)
     className = "results-page__body__content"
 
-    if df is None:
+    if results is None:
         return (
             [
                 html.H1(
@@ -261,9 +299,9 @@ def dashboard_output(fileid, *args):
             className,
         )
 
-    whatsnext = what_next_missing_fields(df, fileid)
+    whatsnext = what_next_missing_fields(results, fileid)
 
-    if len(df) == 0:
+    if len(results) == 0:
         return (html.Div("No grants meet criteria"), whatsnext, className)
 
     # if tabid == 'giving-map':
@@ -278,44 +316,44 @@ def dashboard_output(fileid, *args):
 
     outputs = []
 
-    outputs.extend(get_funder_output(df, filter_args.get("grant_programmes")))
-    outputs.extend(get_statistics_output(df))
+    outputs.extend(get_funder_output(results, filter_args.get("grant_programmes")))
+    outputs.extend(get_statistics_output(results))
     outputs.extend(get_file_output(metadata))
 
     charts = []
 
-    charts.append(funder_chart(df))
-    charts.append(amount_awarded_chart(df))
-    charts.append(grant_programme_chart(df))
-    charts.append(awards_over_time_chart(df))
-    charts.append(organisation_type_chart(df))
-    # charts.append(org_identifier_chart(df))
-    charts.append(region_and_country_chart(df))
+    charts.append(funder_chart(results))
+    charts.append(amount_awarded_chart(results))
+    charts.append(grant_programme_chart(results))
+    charts.append(awards_over_time_chart(results))
+    charts.append(organisation_type_chart(results))
+    # charts.append(org_identifier_chart(cube))
+    charts.append(region_and_country_chart(results))
     charts.append(location_map_iframe(fileid, filter_args))
     # charts.append(location_map(
     #     df,
     #     app.server.config.get("MAPBOX_ACCESS_TOKEN"),
     #     app.server.config.get("MAPBOX_STYLE")
     # ))
-    charts.append(organisation_age_chart(df))
-    charts.append(organisation_income_chart(df))
-    # charts.append(imd_chart(df))
+    charts.append(organisation_age_chart(results))
+    charts.append(organisation_income_chart(results))
+    # charts.append(imd_chart(cube))
 
     outputs.extend(charts)
 
     return (outputs, whatsnext, className)
 
 
-def what_next_missing_fields(df, fileid):
+def what_next_missing_fields(grants, fileid):
 
-    if df is None:
+    if grants is None:
         return []
 
     missing = []
-    if (df["__geo_ctry"].count() + df["__geo_rgn"].count()) == 0:
+    if is_geo_missing(get_chart_results("ctry_rgn", grants)):
         missing.append(["postcodes or other geo data", "https://findthatpostcode.uk/"])
 
-    org_type = CHARTS["org_type"]["get_results"](df)
+    org_type = get_chart_results("org_type", grants)
     if "Identifier not recognised" in org_type.index and len(org_type.index) == 1:
         missing.append(
             [
@@ -462,9 +500,13 @@ def what_next_missing_fields(df, fileid):
     ]
 
 
-@app.callback(Output("award-dates", "data"), [Input("output-data-id", "data")])
-def award_dates_change(fileid):
-    df = get_filtered_df(fileid)
+@app.callback(
+    Output("award-dates", "data"),
+    [Input("file-version", "data")],
+    [State("output-data-id", "data")],
+)
+def award_dates_change(file_version, fileid):
+    df = get_filtered_df(fileid, columns=get_filter_columns())
     if df is None:
         return {f: FILTERS[f]["defaults"] for f in FILTERS}
 
@@ -473,7 +515,7 @@ def award_dates_change(fileid):
         try:
             result[f] = FILTERS[f]["get_values"](df)
         except Exception as e:
-            result[f] = FILTERS[f]["defaults"](df)
+            result[f] = FILTERS[f]["defaults"]
     return result
 
 
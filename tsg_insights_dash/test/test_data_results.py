@@ -1,5 +1,21 @@
+from unittest import mock
+
 import pandas as pd
+import pytest
 
+from tsg_insights import create_app
+from tsg_insights.data.cache import delete_from_cache, get_from_cache, save_to_cache
+from tsg_insights.data.cube import build_cube
+from tsg_insights.data.process import AddDerivedColumns, AddExtraFieldsExternal
+from tsg_insights.data.utils import get_identifier_schemes
+from tsg_insights_dash.data.filters import (
+    FILTERS,
+    get_filter_columns,
+    get_filtered_cube,
+    get_filtered_df,
+    get_filtered_results,
+    get_filters_key,
+)
 from tsg_insights_dash.data.results import *
 
 
@@ -54,3 +70,277 @@ def test_get_ctry_rgn():
     # check sort order
     assert ctry_rgn.iloc[0].name == ("Scotland", "Scotland")
     assert ctry_rgn.iloc[-2].name == ("England", "South East")
+
+
+def test_categorical_columns():
+    # columns stored as categories give the same results as text columns
+    df = pd.DataFrame(
+        {
+            "__geo_ctry": ["England", "England", None, "Scotland"],
+            "__geo_rgn": ["London", None, None, None],
+            "__org_org_type": [None, "Registered Charity", None, None],
+            "Recipient Org:0:Identifier": [
+                "GB-CHC-123456",
+                "GB-COH-123456",
+                "360G-abc",
+                "XI-ABC-123",
+            ],
+            "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder A"],
+            "Currency": ["GBP", "GBP", "GBP", "USD"],
+            "Title": ["A", "B", "C", "D"],
+            "Amount Awarded": [100, 200, 300, 400],
+            "Award Date": pd.to_datetime(["2019-01-01"] * 4),
+        }
+    )
+    categorical_df = df.astype(
+        {
+            c: "category"
+            for c in [
+                "__geo_ctry",
+                "__geo_rgn",
+                "__org_org_type",
+                "Funding Org:0:Name",
+                "Currency",
+            ]
+        }
+    )
+
+    assert get_ctry_rgn(categorical_df).equals(get_ctry_rgn(df))
+    assert get_identifier_schemes(categorical_df).equals(get_identifier_schemes(df))
+
+    # categories that have been filtered out aren't included
+    filtered_df = categorical_df[categorical_df["Currency"] == "GBP"].iloc[:2]
+    assert CHARTS["funders"]["get_results"](filtered_df).to_dict() == {"Funder A": 2}
+    assert get_statistics(filtered_df)["currencies"].keys() == {"GBP"}
+
+
+@pytest.fixture
+def grants_df():
+    df = pd.DataFrame(
+        {
+            "__geo_ctry": ["England", "England", "None", "Scotland", "England"],
+            "__geo_rgn": ["London", "Unknown", None, None, "London"],
+            "__geo_imd": [100, 20000, None, 5000, 32000],
+            "__org_org_type": [None, "Registered Charity", None, None, None],
+            "Recipient Org:0:Identifier": [
+                "GB-CHC-123456",
+                "GB-COH-123456",
+                "360G-abc",
+                "XI-ABC-123",
+                "GB-CHC-123456",
+            ],
+            "Funding Org:0:Name": ["Funder A", "Funder A", "Funder B", "Funder A", "B"],
+            "Grant Programme:0:Title": ["P1", "P1", "P2", "P2", "P2"],
+            "Currency": ["GBP", "GBP", "GBP", "USD", "GBP"],
+            "Title": ["A", "B", "C", "D", "E"],
+            "Amount Awarded": [100, 200, 300, 400, 5000],
+            "Award Date": pd.to_datetime(
+                ["2019-01-01", "2019-01-20", "2019-03-01", "2020-06-01", "2021-01-01"],
+                utc=True,
+            ),
+            "__org_latest_income": [5000, None, 500000, None, 5000],
+            "__org_age_bands": pd.Categorical(
+                ["Under 1 year", None, "Over 25 years", None, "Under 1 year"],
+                categories=AddExtraFieldsExternal.AGE_BIN_LABELS,
+            ),
+        }
+    )
+    df = AddExtraFieldsExternal(df, None, None).run()
+    return AddDerivedColumns(df, None, None).run()
+
+
+def test_cube_results(grants_df):
+    # results from the cube are the same as the results from the dataframe
+    df = grants_df
+    cube = build_cube(grants_df)
+    assert len(cube) == 5
+
+    for chart_id in CHARTS:
+        df_results = get_chart_results(chart_id, df)
+        cube_results = get_chart_results(chart_id, cube)
+        if chart_id == "award_date":
+            for bins in ["months", "quarters", "years"]:
+                assert cube_results[bins].to_dict() == df_results[bins].to_dict()
+            assert cube_results["min"] == df_results["min"] == 2019
+            assert cube_results["max"] == df_results["max"] == 2021
+        elif isinstance(df_results, pd.DataFrame):
+            assert cube_results.to_dict() == df_results.to_dict()
+        else:
+            assert sorted(cube_results.to_dict().items()) == sorted(
+                df_results.to_dict().items()
+            )
+
+    assert get_statistics(cube) == get_statistics(df)
+
+
+def test_award_date_bins(grants_df):
+    award_dates = get_chart_results("award_date", grants_df)
+    assert award_dates["months"].to_dict() == {
+        "2019-01-01": 2,
+        "2019-03-01": 1,
+        "2020-06-01": 1,
+        "2021-01-01": 1,
+    }
+    assert award_dates["quarters"].to_dict() == {
+        "2019-01-01": 3,
+        "2020-04-01": 1,
+        "2021-01-01": 1,
+    }
+    assert award_dates["years"].to_dict() == {
+        "2019-01-01": 3,
+        "2020-01-01": 1,
+        "2021-01-01": 1,
+    }
+
+
+@pytest.mark.parametrize("copies", [2, 3])
+def test_cube_amounts(grants_df, copies):
+    # only the distinct amounts in each cell are kept
+    df = pd.concat([grants_df] * copies, ignore_index=True)
+    cube = build_cube(df)
+    assert len(cube) == 5 * copies
+    assert len(cube.amounts) == 5
+    assert cube.amount_counts.sum() == 5 * copies
+    assert get_statistics(cube) == get_statistics(df)
+
+
+def test_cube_select(grants_df):
+    cube = build_cube(grants_df)
+    df = grants_df[grants_df["Currency"] == "GBP"]
+    selected = cube.select(cube.cells["Currency"] == "GBP")
+    assert len(selected) == 4
+    assert get_statistics(selected) == get_statistics(df)
+    assert get_statistics(selected)["recipients"] == 3
+    assert get_statistics(selected)["currencies"]["GBP"]["median"] == 250
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {},
+        {"funders": ["Funder A"]},
+        {"award_dates": [2019, 2020], "orgtype": ["Registered Charity (E&W)"]},
+        {"area": ["England##London"], "org_size": ["Under £10k"]},
+        {"grant_programmes": ["P2"], "award_amount": ["Under £500"]},
+    ],
+)
+def test_filtered_cube(tmp_path, grants_df, filters):
+    app = create_app({"REQUESTS_CACHE_ON": False, "UPLOADS_FOLDER": str(tmp_path)})
+    with app.app_context():
+        save_to_cache("test-cube", grants_df)
+        cube = get_filtered_cube("test-cube", **filters)
+        df = get_filtered_df("test-cube", **filters)
+        assert len(cube) == len(df)
+        assert get_statistics(cube) == get_statistics(df)
+        assert (
+            get_chart_results("funders", cube).to_dict()
+            == get_chart_results("funders", df).to_dict()
+        )
+
+        # rows found through the cube are the same as applying each filter
+        expected = grants_df
+        for filter_id, filter_def in FILTERS.items():
+            filtered = filter_def["apply_filter"](
+                expected, filters.get(filter_id), filter_def
+            )
+            if filtered is not None:
+                expected = filtered
+        assert df.index.tolist() == expected.index.tolist()
+
+        # only the columns asked for are loaded
+        df = get_filtered_df("test-cube", columns=["Title"], **filters)
+        assert df.columns.tolist() == ["Title"]
+        assert df["Title"].tolist() == expected["Title"].tolist()
+        delete_from_cache("test-cube")
+
+
+def test_filter_values(grants_df):
+    # the filter values can be found using only the filter columns
+    df = grants_df[[c for c in grants_df.columns if c in get_filter_columns()]]
+    values = {f: FILTERS[f]["get_values"](df) for f in FILTERS}
+    assert values["award_dates"] == {"min": 2019, "max": 2021}
+    assert {"label": "Funder A (3)", "value": "Funder A"} in values["funders"]
+    assert {"label": "England - London (2)", "value": "England##London"} in values[
+        "area"
+    ]
+    assert {
+        "label": "Registered Charity (E&W) (2)",
+        "value": "Registered Charity (E&W)",
+    } in values["orgtype"]
+
+
+@pytest.mark.parametrize("file_cache", ["filesystem", "parquet", "arrow"])
+def test_legacy_file(tmp_path, grants_df, file_cache):
+    # files saved before the derived columns were added when processing
+    legacy_df = grants_df.drop(columns=["__org_type"]).assign(
+        __geo_ctry=["England", "England", "None", "Scotland", "England"],
+        __geo_rgn=["London", "Unknown", None, None, "London"],
+    )
+    app = create_app(
+        {
+            "REQUESTS_CACHE_ON": False,
+            "UPLOADS_FOLDER": str(tmp_path),
+            "FILE_CACHE": file_cache,
+        }
+    )
+    with app.app_context():
+        save_to_cache("test-legacy", legacy_df)
+
+        df = get_from_cache("test-legacy", columns=["__org_type", "__geo_rgn"])
+        assert df.columns.tolist() == ["__geo_rgn", "__org_type"]
+        assert df["__org_type"].tolist() == grants_df["__org_type"].tolist()
+        assert df["__geo_rgn"].isnull().tolist() == [False, True, True, True, False]
+
+        df = get_filtered_df("test-legacy", columns=get_filter_columns())
+        assert get_org_type(df).to_dict() == get_org_type(grants_df).to_dict()
+        assert FILTERS["orgtype"]["get_values"](df)
+        assert get_ctry_rgn(df).to_dict() == get_ctry_rgn(grants_df).to_dict()
+
+        df = get_filtered_df("test-legacy", orgtype=["Registered Charity (E&W)"])
+        assert df["Title"].tolist() == ["A", "E"]
+        delete_from_cache("test-legacy")
+
+
+def test_filtered_results(tmp_path, grants_df):
+    app = create_app({"REQUESTS_CACHE_ON": False, "UPLOADS_FOLDER": str(tmp_path)})
+    filters = {"funders": ["Funder A", "B"], "award_dates": [2019, 2021]}
+    with app.app_context():
+        save_to_cache("test-results", grants_df)
+        cube = get_filtered_cube("test-results", **filters)
+        results = get_filtered_results("test-results", **filters)
+        assert len(results) == len(cube) == 4
+        assert get_statistics(results) == get_statistics(cube)
+        assert (
+            get_chart_results("funders", results).to_dict()
+            == get_chart_results("funders", cube).to_dict()
+        )
+
+        # the results are cached, so the cube isn't used again
+        with mock.patch(
+            "tsg_insights_dash.data.filters.get_filtered_cube"
+        ) as filtered_cube:
+            cached = get_filtered_results(
+                "test-results",
+                funders=["B", "Funder A"],
+                award_dates=["2019", "2021"],
+                area=["__all"],
+            )
+            assert not filtered_cube.called
+        assert get_statistics(cached) == get_statistics(results)
+        assert cached.columns == results.columns
+
+        # saving the file again means the results are worked out again
+        save_to_cache("test-results", grants_df[grants_df["Currency"] == "GBP"])
+        assert len(get_filtered_results("test-results", **filters)) == 3
+        delete_from_cache("test-results")
+        assert get_filtered_results("test-results", **filters) is None
+
+
+def test_filters_key():
+    assert get_filters_key({}) == get_filters_key({"funders": ["__all"]})
+    assert get_filters_key({"funders": ["A", "B"]}) == get_filters_key(
+        {"funders": ["B", "A"], "orgtype": []}
+    )
+    assert get_filters_key({"award_dates": [2019, 2020]}) != get_filters_key(
+        {"award_dates": [2020, 2019]}
+    )